@@ -0,0 +1,357 @@
+'''fake_influx
+
+An in-memory stand-in for InfluxDB 1.x that understands just the writes and
+queries Chain makes, so benchmarks can run without an Influx server. It keeps
+each series sorted by time, so range queries stay fast with millions of
+points, but it isn't meant to tell you how fast Influx is, only to take it out
+of the picture when measuring Chain itself.
+
+Usage:
+    fake_influx.py [--port=<port>]
+
+Options:
+    --port=<port>  Port to listen on [default: 8086]
+'''
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qsl
+from datetime import datetime
+from docopt import docopt
+import calendar
+import threading
+import math
+import bisect
+import heapq
+import json
+import time
+import re
+
+PRECISIONS = {'ns': 1, 'n': 1, 'u': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9}
+ROLLUP_WIDTHS = {'1h': 3600, '1d': 86400, '1w': 604800}
+
+# database -> measurement -> series key (sorted tag items) -> Series
+databases = {}
+lock = threading.Lock()
+
+
+class Series(object):
+    def __init__(self, tags):
+        self.tags = tags
+        self.times = []
+        self.fields = []
+
+    def add(self, timestamp, fields):
+        if not self.times or timestamp > self.times[-1]:
+            self.times.append(timestamp)
+            self.fields.append(fields)
+            return
+        index = bisect.bisect_left(self.times, timestamp)
+        if index < len(self.times) and self.times[index] == timestamp:
+            self.fields[index] = dict(self.fields[index], **fields)
+        else:
+            self.times.insert(index, timestamp)
+            self.fields.insert(index, fields)
+
+    def rows(self, start, end):
+        '''Returns (time, tags, fields) for the points in [start, end)'''
+        first = bisect.bisect_left(self.times, start)
+        last = bisect.bisect_left(self.times, end)
+        return [(self.times[i], self.tags, self.fields[i])
+                for i in xrange(first, last)]
+
+
+def format_time(timestamp):
+    seconds, nanoseconds = divmod(timestamp, 10 ** 9)
+    formatted = datetime.utcfromtimestamp(seconds).strftime(
+        '%Y-%m-%dT%H:%M:%S')
+    if nanoseconds:
+        formatted += ('.%09d' % nanoseconds).rstrip('0')
+    return formatted + 'Z'
+
+
+def parse_time(value):
+    value = value.strip()
+    if not value.startswith("'"):
+        return int(value)
+    value = value.strip("'").rstrip('Z')
+    for time_format in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                        '%Y-%m-%d']:
+        try:
+            parsed = datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return calendar.timegm(parsed.utctimetuple()) * 10 ** 9 + \
+            parsed.microsecond * 1000
+    raise ValueError('unsupported time %s' % value)
+
+
+def parse_field_value(value):
+    if value.endswith('i'):
+        return int(value[:-1])
+    if value.startswith('"'):
+        return value.strip('"')
+    if value in ('t', 'T', 'true', 'True'):
+        return True
+    if value in ('f', 'F', 'false', 'False'):
+        return False
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError('invalid number %s' % value)
+    return value
+
+
+def write(database, body, precision):
+    multiplier = PRECISIONS[precision]
+    now = int(time.time() * 10 ** 9)
+    # like Influx, a batch with any bad lines isn't written at all
+    points = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(' ')
+        key = parts[0].split(',')
+        tags = dict(tag.split('=', 1) for tag in key[1:])
+        fields = dict((name, parse_field_value(value)) for name, value in
+                      (field.split('=', 1) for field in parts[1].split(',')))
+        timestamp = int(parts[2]) * multiplier if len(parts) > 2 else now
+        points.append((key[0], tags, fields, timestamp))
+    measurements = databases.setdefault(database, {})
+    for measurement, tags, fields, timestamp in points:
+        series = measurements.setdefault(measurement, {})
+        series_key = tuple(sorted(tags.items()))
+        if series_key not in series:
+            series[series_key] = Series(tags)
+        series[series_key].add(timestamp, fields)
+
+
+def parse_where(where):
+    '''Splits a WHERE clause into a time range and a list of tag conditions,
+    each a function taking the tags'''
+    start, end = 0, 2 ** 63
+    conditions = []
+    if not where:
+        return start, end, conditions
+    for condition in re.split(r'\s+AND\s+', where.strip(), flags=re.I):
+        match = re.match(r'"?(\w+)"?\s*(=~|>=|<=|=|<|>)\s*(.+)$',
+                         condition.strip())
+        name, op, value = match.groups()
+        if name == 'time':
+            value = parse_time(value)
+            if op == '>=':
+                start = max(start, value)
+            elif op == '>':
+                start = max(start, value + 1)
+            elif op == '<':
+                end = min(end, value)
+            elif op == '<=':
+                end = min(end, value + 1)
+        elif op == '=~':
+            pattern = re.compile(value.strip().strip('/'))
+            conditions.append(
+                lambda tags, name=name, pattern=pattern:
+                pattern.search(tags.get(name, '')) is not None)
+        else:
+            value = value.strip().strip("'")
+            conditions.append(
+                lambda tags, name=name, value=value: tags.get(name) == value)
+    return start, end, conditions
+
+
+def matching_series(database, measurement, conditions):
+    series = databases.get(database, {}).get(measurement, {})
+    return [s for s in series.values()
+            if all(condition(s.tags) for condition in conditions)]
+
+
+def select(database, columns, measurement, where, group_by, order, limit,
+           offset):
+    start, end, conditions = parse_where(where)
+    group_tags = [tag.strip().strip('"') for tag in group_by.split(',')
+                  if tag.strip() and tag.strip() != '*'] if group_by else []
+    groups = {}
+    for series in matching_series(database, measurement, conditions):
+        group = tuple(series.tags.get(tag, '') for tag in group_tags)
+        groups.setdefault(group, []).append(series.rows(start, end))
+    # FIRST(), LAST() and COUNT() ignore the order and limit
+    is_function = re.match(r'(FIRST|LAST|COUNT)\(', columns, re.I)
+    result = []
+    for group in sorted(groups):
+        rows = list(heapq.merge(*groups[group]))
+        if order and order.upper() == 'DESC' and not is_function:
+            rows.reverse()
+        if offset and not is_function:
+            rows = rows[int(offset):]
+        if limit and not is_function:
+            rows = rows[:int(limit)]
+        series = format_rows(measurement, columns, rows, group_tags)
+        if series is None:
+            continue
+        if group_tags:
+            series['tags'] = dict(zip(group_tags, group))
+        result.append(series)
+    return result
+
+
+def format_rows(measurement, columns, rows, group_tags):
+    if not rows:
+        return None
+    function = re.match(r'(FIRST|LAST|COUNT)\((\*|"?\w+"?)\)$', columns, re.I)
+    if function:
+        function_name = function.group(1).lower()
+        field = function.group(2).strip('"')
+        if function_name == 'count':
+            values = [[format_time(0), len(rows)]]
+            return {'name': measurement, 'columns': ['time', 'count'],
+                    'values': values}
+        timestamp, tags, fields = \
+            rows[0] if function_name == 'first' else rows[-1]
+        if field == '*':
+            names = sorted(fields)
+            return {'name': measurement,
+                    'columns': ['time'] + [function_name + '_' + f
+                                           for f in names],
+                    'values': [[format_time(timestamp)] +
+                               [fields[f] for f in names]]}
+        return {'name': measurement, 'columns': ['time', function_name],
+                'values': [[format_time(timestamp), fields.get(field)]]}
+    if columns.strip() == '*':
+        names = set()
+        for timestamp, tags, fields in rows:
+            names.update(fields)
+            names.update(tag for tag in tags if tag not in group_tags)
+        names = sorted(names)
+    else:
+        names = [name.strip().strip('"') for name in columns.split(',')]
+    return {'name': measurement, 'columns': ['time'] + names,
+            'values': [[format_time(timestamp)] +
+                       [fields.get(name, tags.get(name)) for name in names]
+                       for timestamp, tags, fields in rows]}
+
+
+def select_into(database, destination, source, where, group_by):
+    '''Rolls up the source measurement into the destination by sensor and
+    time, like the continuous queries (see backfill.sh)'''
+    start, end, conditions = parse_where(where)
+    width = ROLLUP_WIDTHS[re.search(r'time\((\w+)\)', group_by).group(1)] * \
+        10 ** 9
+    rollups = databases.setdefault(database, {}).setdefault(destination, {})
+    written = 0
+    for series in matching_series(database, source, conditions):
+        buckets = {}
+        for timestamp, tags, fields in series.rows(start, end):
+            buckets.setdefault(timestamp // width * width, []).append(fields)
+        series_key = tuple(sorted(series.tags.items()))
+        if series_key not in rollups:
+            rollups[series_key] = Series(series.tags)
+        for bucket, points in sorted(buckets.items()):
+            if 'value' in points[0]:
+                values = [point['value'] for point in points]
+                rollup = {'max': max(values), 'min': min(values),
+                          'count': len(values), 'sum': sum(values)}
+            else:
+                rollup = {'max': max(point['max'] for point in points),
+                          'min': min(point['min'] for point in points),
+                          'count': sum(point['count'] for point in points),
+                          'sum': sum(point['sum'] for point in points)}
+            rollup['mean'] = rollup['sum'] / rollup['count']
+            rollups[series_key].add(bucket, rollup)
+            written += 1
+    return [{'name': 'result', 'columns': ['time', 'written'],
+             'values': [[format_time(0), written]]}]
+
+
+def query(database, statement):
+    statement = ' '.join(statement.split()).rstrip(';')
+    if re.match(r'SHOW DATABASES$', statement, re.I):
+        series = {'name': 'databases', 'columns': ['name']}
+        if databases:
+            series['values'] = [[name] for name in sorted(databases)]
+        return [series]
+    match = re.match(r'CREATE DATABASE "?(\w+)"?$', statement, re.I)
+    if match:
+        databases.setdefault(match.group(1), {})
+        return []
+    match = re.match(r'DROP DATABASE "?(\w+)"?$', statement, re.I)
+    if match:
+        databases.pop(match.group(1), None)
+        return []
+    match = re.match(r'DROP SERIES WHERE (.+)$', statement, re.I)
+    if match:
+        conditions = parse_where(match.group(1))[2]
+        for measurement in databases.get(database, {}).values():
+            for key, series in measurement.items():
+                if all(condition(series.tags) for condition in conditions):
+                    del measurement[key]
+        return []
+    match = re.match(r'SELECT .+? INTO "?(\w+)"? FROM "?(\w+)"? '
+                     r'WHERE (.+?) GROUP BY (.+)$', statement, re.I)
+    if match:
+        return select_into(database, *match.groups())
+    match = re.match(r'SELECT (.+?) FROM "?(\w+)"?(?: WHERE (.+?))?'
+                     r'(?: GROUP BY (.+?))?(?: ORDER BY time (ASC|DESC))?'
+                     r'(?: LIMIT (\d+))?(?: OFFSET (\d+))?$', statement, re.I)
+    if match:
+        return select(database, *match.groups())
+    raise ValueError('unsupported query: %s' % statement)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path == '/ping':
+            return self.respond(204)
+        if url.path == '/write':
+            try:
+                with lock:
+                    write(params.get('db'), body,
+                          params.get('precision', 'ns'))
+            except (ValueError, IndexError) as e:
+                return self.respond(400, {'error': 'unable to parse: %s' % e})
+            return self.respond(204)
+        if url.path == '/query':
+            if self.command == 'POST' and body:
+                params.update(parse_qsl(body))
+            try:
+                with lock:
+                    series = query(params.get('db'), params['q'])
+            except (ValueError, KeyError, AttributeError) as e:
+                return self.respond(400, {'error': str(e)})
+            result = {'statement_id': 0}
+            if series:
+                result['series'] = series
+            return self.respond(200, {'results': [result]})
+        self.respond(404, {'error': 'not found'})
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    args = docopt(__doc__)
+    server = ThreadingHTTPServer(('127.0.0.1', int(args['--port'])), Handler)
+    print 'Fake Influx listening on port %s' % args['--port']
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# run with
+#   DJANGO_SETTINGS_MODULE=chain.settings python -m benchmarks.generate [options]
+# from the top of the repository, so it uses the same database and Influx as
+# the server under test.
+
+'''generate
+
+Builds a synthetic deployment to benchmark against: sites with devices, each
+device with sensors, metadata on all of them, and days of sensor data written
+to Influx and rolled up like the continuous queries would. Sensors report at
+different rates, with some jitter, and now and then a sensor goes quiet for a
+while, so the data has about the density and gaps of a real deployment.
+
+Everything created is named "Benchmark Site ..." and can be removed again
+with --clear.
+
+Usage:
+    generate.py [options]
+    generate.py --clear
+
+Options:
+    --sites=<n>       Number of sites [default: 2]
+    --devices=<n>     Devices at each site [default: 20]
+    --sensors=<n>     Sensors on each device [default: 5]
+    --days=<n>        Days of data, up to now [default: 7]
+    --interval=<s>    Seconds between the data points of the busiest
+                      sensors [default: 300]
+    --seed=<n>        Seed for the random data, so runs can be repeated
+                      [default: 1]
+    --clear           Delete the sites generated before (and their data)
+'''
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+from docopt import docopt
+from chain.core.models import Site, Device, ScalarSensor, Metric, Unit, \
+    Metadata
+from chain.core import resources, response_cache
+from chain.influx_client import InfluxClient
+from chain.localsettings import INFLUX_MEASUREMENT
+from datetime import timedelta
+import itertools
+import random
+import math
+import sys
+
+SITE_PREFIX = 'Benchmark Site'
+
+# (metric, unit, typical value, daily swing, noise, how many times less often
+# than the busiest sensors it reports)
+SENSOR_TYPES = [
+    ('temperature', 'celsius', 21.0, 4.0, 0.2, 1),
+    ('relative_humidity', 'percent', 45.0, 10.0, 1.0, 1),
+    ('illuminance', 'lux', 300.0, 300.0, 20.0, 1),
+    ('pressure', 'kPa', 101.3, 0.5, 0.05, 2),
+    ('sound_level', 'dB', 40.0, 10.0, 3.0, 1),
+    ('co2', 'ppm', 600.0, 200.0, 20.0, 2),
+    ('battery_voltage', 'V', 3.7, 0.1, 0.01, 12),
+    ('soil_moisture', 'percent', 30.0, 2.0, 0.5, 6),
+]
+
+# points written to Influx in each request
+BATCH_SIZE = 5000
+
+ROLLUPS = [
+    ('1h', '', 'max("value"), min("value"), mean("value"), count("value"), '
+     'sum("value")'),
+    ('1d', '_1h', 'max("max"), min("min"), sum("sum")/sum("count") as '
+     '"mean", sum("count") as "count", sum("sum")'),
+    ('1w', '_1d', 'max("max"), min("min"), sum("sum")/sum("count") as '
+     '"mean", sum("count") as "count", sum("sum")'),
+]
+
+
+def sensor_types(count):
+    '''The (name, type) of each sensor on a device. Once every type is used
+    the names get a number, so a device can have any number of sensors'''
+    for i in range(count):
+        sensor_type = SENSOR_TYPES[i % len(SENSOR_TYPES)]
+        name = sensor_type[0]
+        if i >= len(SENSOR_TYPES):
+            name += '_%d' % (i // len(SENSOR_TYPES) + 1)
+        yield name, sensor_type
+
+
+def create_deployment(site_count, device_count, sensor_count):
+    '''Creates the sites, devices and sensors with their metadata, and returns
+    a list of (sensor, sensor type) for all the sensors'''
+    metrics, units = {}, {}
+    types = list(sensor_types(sensor_count))
+    for name, (_, unit, _, _, _, _) in types:
+        metrics[name] = Metric.objects.get_or_create(name=name)[0]
+        units[unit] = Unit.objects.get_or_create(name=unit)[0]
+    first_site = Site.objects.filter(name__startswith=SITE_PREFIX).count()
+    sensors = []
+    metadata = []
+    for site_number in range(first_site, first_site + site_count):
+        site = Site.objects.create(name='%s %d' % (SITE_PREFIX, site_number))
+        metadata.append(Metadata(content_object=site, key='deployment',
+                                 value='benchmark'))
+        Device.objects.bulk_create([
+            Device(site=site, name='device-%04d' % i,
+                   description='Synthetic device %d' % i,
+                   building='Building %d' % (i // 50),
+                   floor=str(i // 10 % 5), room='Room %d' % i)
+            for i in range(device_count)])
+        devices = list(site.devices.all())
+        ScalarSensor.objects.bulk_create([
+            ScalarSensor(device=device, metric=metrics[name],
+                         unit=units[sensor_type[1]])
+            for device in devices for name, sensor_type in types])
+        sensor_type_by_metric = dict(
+            (metrics[name].id, sensor_type) for name, sensor_type in types)
+        for sensor in ScalarSensor.objects.filter(
+                device__site=site).select_related('device'):
+            sensors.append((sensor, sensor_type_by_metric[sensor.metric_id]))
+        for device in devices:
+            metadata.append(Metadata(content_object=device, key='firmware',
+                                     value='1.%d' % random.randint(0, 9)))
+            metadata.append(Metadata(content_object=device, key='serial',
+                                     value='%08x' % random.getrandbits(32)))
+    for sensor, _ in sensors:
+        metadata.append(Metadata(content_object=sensor, key='calibrated',
+                                 value='2017-01-01'))
+    Metadata.objects.bulk_create(metadata)
+    return sensors
+
+
+def invalidate_cached_responses(site_ids=(), device_ids=(), sensor_ids=()):
+    '''Invalidates the cached API responses that list sites, devices or
+    sensors, and those of the objects with the given ids, as posting them
+    through the API would. bulk_create and deleting a queryset don't publish
+    anything'''
+    tags = [resources.SiteResource.resource_name,
+            resources.DeviceResource.resource_name,
+            resources.ScalarSensorResource.resource_name]
+    for resource_class, ids in [(resources.SiteResource, site_ids),
+                                (resources.DeviceResource, device_ids),
+                                (resources.ScalarSensorResource, sensor_ids)]:
+        tags.extend('%s-%d' % (resource_class.resource_type, obj_id)
+                    for obj_id in ids)
+    response_cache.invalidate(tags)
+
+
+def sensor_points(sensor, sensor_type, start, end, interval):
+    '''Yields the (site_id, device_id, sensor_id, value, timestamp) data points
+    of a sensor from start to end'''
+    _, _, typical, swing, noise, slowdown = sensor_type
+    step = interval * slowdown
+    phase = random.uniform(0, step)
+    timestamp = start + timedelta(seconds=phase)
+    while timestamp < end:
+        # every day or so a sensor stops reporting for up to a few hours
+        if random.random() < step / 86400.0:
+            timestamp += timedelta(seconds=random.uniform(0, 4 * 3600))
+            continue
+        hour = timestamp.hour + timestamp.minute / 60.0
+        value = typical + swing * math.sin((hour - 9) / 24.0 * 2 * math.pi) + \
+            random.gauss(0, noise)
+        yield (sensor.device.site_id, sensor.device_id, sensor.id,
+               round(value, 3), timestamp)
+        timestamp += timedelta(seconds=step * random.uniform(0.9, 1.1))
+
+
+def write_data(sensors, start, end, interval):
+    points = itertools.chain.from_iterable(
+        sensor_points(sensor, sensor_type, start, end, interval)
+        for sensor, sensor_type in sensors)
+    written = 0
+    while True:
+        batch = list(itertools.islice(points, BATCH_SIZE))
+        if not batch:
+            break
+        resources.influx_client.post_data_batch(batch)
+        written += len(batch)
+        sys.stdout.write('\rWrote %d data points' % written)
+        sys.stdout.flush()
+    print
+    return written
+
+
+def roll_up(site_ids, start, end):
+    '''Fills the rollup measurements for the generated data, as backfill.sh
+    does for real data'''
+    site_pattern = '|'.join(str(site_id) for site_id in sorted(site_ids))
+    for width, source, columns in ROLLUPS:
+        response = resources.influx_client.post('query', '''
+            SELECT {0} INTO "{1}_{2}" FROM "{1}{3}"
+            WHERE "time" >= {4} AND "time" < {5}
+            AND "site_id" =~ /^({6})$/
+            GROUP BY "sensor_id", time({2}), *'''.format(
+            columns, INFLUX_MEASUREMENT, width, source,
+            InfluxClient.convert_timestamp(start),
+            InfluxClient.convert_timestamp(end), site_pattern), True)
+        response.raise_for_status()
+
+
+def clear():
+    sites = Site.objects.filter(name__startswith=SITE_PREFIX)
+    for site in sites:
+        resources.influx_client.post(
+            'query', "DROP SERIES WHERE site_id = '%d'" % site.id, True)
+    site_type = ContentType.objects.get_for_model(Site)
+    device_type = ContentType.objects.get_for_model(Device)
+    sensor_type = ContentType.objects.get_for_model(ScalarSensor)
+    with transaction.atomic():
+        Metadata.objects.filter(
+            content_type=sensor_type, object_id__in=ScalarSensor.objects.filter(
+                device__site__in=sites).values('id')).delete()
+        Metadata.objects.filter(
+            content_type=device_type, object_id__in=Device.objects.filter(
+                site__in=sites).values('id')).delete()
+        Metadata.objects.filter(content_type=site_type,
+                                object_id__in=sites.values('id')).delete()
+        deleted = (
+            list(sites.values_list('id', flat=True)),
+            list(Device.objects.filter(
+                site__in=sites).values_list('id', flat=True)),
+            list(ScalarSensor.objects.filter(
+                device__site__in=sites).values_list('id', flat=True)))
+        sites.delete()
+    invalidate_cached_responses(*deleted)
+    print 'Deleted %d sites' % len(deleted[0])
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--clear']:
+        clear()
+        return
+    random.seed(int(args['--seed']))
+    end = timezone.now()
+    start = end - timedelta(days=int(args['--days']))
+    with transaction.atomic():
+        sensors = create_deployment(int(args['--sites']),
+                                    int(args['--devices']),
+                                    int(args['--sensors']))
+    invalidate_cached_responses()
+    print 'Created %d sensors' % len(sensors)
+    write_data(sensors, start, end, int(args['--interval']))
+    # the rollups only cover whole hours, like the continuous queries
+    rolled_up_until = end.replace(minute=0, second=0, microsecond=0)
+    roll_up(set(sensor.device.site_id for sensor, _ in sensors),
+            start.replace(minute=0, second=0, microsecond=0)
+            - timedelta(days=7), rolled_up_until)
+    print 'Rolled up the data until %s' % rolled_up_until
+
+
+if __name__ == '__main__':
+    main()
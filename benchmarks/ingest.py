@@ -0,0 +1,197 @@
+# run with
+#   DJANGO_SETTINGS_MODULE=chain.settings python -m benchmarks.ingest <url>
+# from the top of the repository, with the Chain server at <url> using the
+# same database and Influx.
+
+'''ingest
+
+Measures the TidMarsh ingest chain end to end: made-up TidMarsh reports go
+out on a ZMQ stream (see tidmarsh_traffic.py), collectors/tidpost posts them
+to the Chain server's REST API, and the server writes them to Influx. This
+creates a site for the run whose raw ZMQ stream is the generator's, starts
+tidpost for it, and then counts the data points that make it into Influx
+every second.
+
+The API pushes every posted data point to the websocket streams, and blocks
+once a thousand of them are queued for a websocketd that isn't there, so
+unless one is running this stands in for it and throws the messages away.
+
+It reports how many points per second got through, how far behind the
+stream the chain fell (the backlog of points sent but not written yet), and
+how many points never arrived once the backlog had drained. ZMQ drops
+messages once a subscriber falls too far behind, so those are the points
+tidpost couldn't keep up with.
+
+Usage:
+    ingest.py <url> [options]
+
+Options:
+    --devices=<n>      Number of devices reporting [default: 50]
+    --rate=<n>         Reports per second from all the devices [default: 20]
+    --legacy=<f>       The fraction of reports in the legacy format
+                       [default: 0.2]
+    --duration=<s>     Seconds to send reports for [default: 60]
+    --drain=<s>        The most seconds to wait for the backlog to drain
+                       afterwards [default: 30]
+    --stream=<addr>    ZMQ address to publish the reports on
+                       [default: tcp://127.0.0.1:5560]
+    --log=<file>       Save tidpost's log to this file
+    --keep             Keep the site and its data afterwards
+    --json=<file>      Save the results to this file
+'''
+
+from docopt import docopt
+from chain.core.models import Site
+from chain.core import resources
+from chain.localsettings import INFLUX_MEASUREMENT
+from chain.settings import ZMQ_PASSTHROUGH_URL_PULL
+from benchmarks.tidmarsh_traffic import TrafficGenerator
+from datetime import datetime
+import subprocess
+import threading
+import json
+import time
+import zmq
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# how long tidpost gets to load the site and subscribe to the stream before
+# the reports start, since ZMQ drops messages sent before that
+STARTUP_WAIT = 5
+# the drain is over once no more points arrive for this many seconds
+IDLE_SECONDS = 3
+
+
+def count_written(site_id):
+    response = resources.influx_client.get(
+        "SELECT COUNT(value) FROM {0} WHERE site_id = '{1}'".format(
+            INFLUX_MEASUREMENT, site_id), True)
+    result = resources.influx_client.get_values(response)
+    return result[0]['count'] if result else 0
+
+
+def discard_stream_messages():
+    '''Takes the messages the API pushes to the streams, if websocketd
+    isn't running to take them'''
+    zmq_ctx = zmq.Context()
+    puller = zmq_ctx.socket(zmq.PULL)
+    try:
+        puller.bind(ZMQ_PASSTHROUGH_URL_PULL)
+    except zmq.ZMQError:
+        # websocketd has it
+        puller.close()
+        return
+
+    def discard():
+        while True:
+            puller.recv()
+    thread = threading.Thread(target=discard)
+    thread.daemon = True
+    thread.start()
+
+
+def start_tidpost(site_url, log):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with open(log or os.devnull, 'w') as output:
+        return subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'collectors', 'tidpost'),
+             site_url], stdout=output, stderr=subprocess.STDOUT, env=env)
+
+
+def sample(generator, site_id, start, samples):
+    '''Records the points sent and written so far, and prints them with the
+    rates since the last sample'''
+    now = time.time()
+    sent, written = generator.points, count_written(site_id)
+    if samples:
+        last_time, last_sent, last_written = samples[-1]
+        elapsed = now - last_time
+        print '%6.0fs  sent %7.1f/s  written %7.1f/s  backlog %7d' % (
+            now - start, (sent - last_sent) / elapsed,
+            (written - last_written) / elapsed, sent - written)
+    samples.append((now, sent, written))
+    return written
+
+
+def main():
+    args = docopt(__doc__)
+    duration = float(args['--duration'])
+    site = Site.objects.create(name='Benchmark Site TidMarsh',
+                               raw_zmq_stream=args['--stream'])
+    site_url = '%s/sites/%d' % (args['<url>'].rstrip('/'), site.id)
+    generator = TrafficGenerator(args['--stream'], int(args['--devices']),
+                                 float(args['--rate']),
+                                 float(args['--legacy']))
+    discard_stream_messages()
+    tidpost = start_tidpost(site_url, args['--log'])
+    samples = []
+    try:
+        time.sleep(STARTUP_WAIT)
+        if tidpost.poll() is not None:
+            sys.exit('tidpost exited, is the server running at %s?' %
+                     args['<url>'])
+        sender = threading.Thread(target=generator.run, args=(duration,))
+        sender.daemon = True
+        start = time.time()
+        sender.start()
+        while sender.is_alive():
+            time.sleep(1)
+            sample(generator, site.id, start, samples)
+        send_time = time.time() - start
+        print 'Stopped sending, waiting for the backlog'
+        drain_deadline = time.time() + float(args['--drain'])
+        idle = 0
+        while time.time() < drain_deadline and idle < IDLE_SECONDS and \
+                samples[-1][2] < generator.points:
+            time.sleep(1)
+            last_written = samples[-1][2]
+            idle = idle + 1 if sample(generator, site.id, start,
+                                      samples) == last_written else 0
+    finally:
+        tidpost.terminate()
+        tidpost.wait()
+        generator.stop()
+        if not args['--keep']:
+            resources.influx_client.post(
+                'query', "DROP SERIES WHERE site_id = '%d'" % site.id, True)
+            site.delete()
+
+    sent = generator.points
+    written = samples[-1][2]
+    # the sustained rate is the rate while reports were coming in, ignoring
+    # the first second while tidpost creates the devices and sensors
+    steady = [s for s in samples if s[0] - start <= send_time + 0.5][1:]
+    throughput = (steady[-1][2] - steady[0][2]) / (steady[-1][0] -
+                                                   steady[0][0]) \
+        if len(steady) > 1 else 0
+    results = {
+        'reports': generator.reports,
+        'points_sent': sent,
+        'points_written': written,
+        'points_dropped': sent - written,
+        'throughput': throughput,
+        'max_backlog': max(s[1] - s[2] for s in samples),
+        'drain_time': samples[-1][0] - start - send_time,
+    }
+    print 'Sent %d reports with %d data points in %.0fs' % (
+        generator.reports, sent, send_time)
+    print 'Wrote %d points, %.1f points/s sustained' % (written, throughput)
+    print 'Backlog peaked at %d points, dropped %d points (%.1f%%)' % (
+        results['max_backlog'], results['points_dropped'],
+        100.0 * results['points_dropped'] / sent if sent else 0)
+    if args['--json']:
+        with open(args['--json'], 'w') as f:
+            json.dump({
+                'url': args['<url>'],
+                'devices': int(args['--devices']),
+                'rate': float(args['--rate']),
+                'legacy': float(args['--legacy']),
+                'date': datetime.utcnow().isoformat() + 'Z',
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+'''load
+
+Sends a mix of API requests to a running Chain server from a number of
+threads, and reports the throughput and latency percentiles for each kind of
+request. It finds the sites, devices and sensors to use by following the
+links from the entry point, so run it against a deployment made with
+generate.py, or any other.
+
+The mixes are:
+    read    site summaries, device lists, single sensors and ranges of their
+            data
+    write   device data and bulk CSV uploads
+    mixed   mostly reads, with some writes
+
+With --json the results are also saved, and --compare prints how each kind of
+request changed from results saved before, e.g. by the previous release.
+
+Usage:
+    load.py <url> [options]
+
+Options:
+    --mix=<mix>          read, write or mixed [default: read]
+    --threads=<n>        Number of concurrent clients [default: 8]
+    --duration=<s>       Seconds to send requests for [default: 30]
+    --devices=<n>        Most devices to find and use [default: 50]
+    --site-name=<name>   Only use the sites whose names start with this,
+                         e.g. "Benchmark Site"
+    --days=<n>           Data ranges are picked from this many days back
+                         [default: 7]
+    --bulk-size=<n>      Data points in each bulk upload [default: 1000]
+    --auth=<user:pass>   Basic auth for the writes, e.g. through nginx
+    --json=<file>        Save the results to this file
+    --compare=<file>     Compare the results to ones saved before
+'''
+
+from docopt import docopt
+from datetime import datetime
+import threading
+import requests
+import random
+import json
+import math
+import time
+import sys
+
+HAL_HEADERS = {'Accept': 'application/hal+json'}
+
+# the weight of each kind of request in each mix
+MIXES = {
+    'read': {'site_summary': 1, 'device_list': 2, 'sensor': 4,
+             'sensor_data': 4},
+    'write': {'device_data': 4, 'bulk_upload': 1},
+    'mixed': {'site_summary': 1, 'device_list': 2, 'sensor': 4,
+              'sensor_data': 4, 'device_data': 2, 'bulk_upload': 1},
+}
+
+PERCENTILES = [50, 95, 99]
+
+
+def get_links(session, href, rel):
+    response = session.get(href, headers=HAL_HEADERS)
+    response.raise_for_status()
+    links = response.json()['_links'].get(rel, [])
+    return links if isinstance(links, list) else [links]
+
+
+def discover(session, url, max_devices, site_name=None):
+    '''Follows the links from the entry point to find the sites, devices and
+    sensors to request'''
+    sites = []
+    devices = []
+    sites_href = get_links(session, url, 'ch:sites')[0]['href']
+    for site_link in get_links(session, sites_href, 'items'):
+        if len(devices) >= max_devices:
+            break
+        if site_name and not site_link['title'].startswith(site_name):
+            continue
+        site = session.get(site_link['href'], headers=HAL_HEADERS).json()
+        sites.append({
+            'summary': site['_links']['ch:siteSummary']['href'],
+            'devices': site['_links']['ch:devices']['href'],
+        })
+        for device_link in get_links(session, sites[-1]['devices'], 'items'):
+            if len(devices) >= max_devices:
+                break
+            device = session.get(device_link['href'],
+                                 headers=HAL_HEADERS).json()
+            sensors = []
+            sensors_href = device['_links']['ch:sensors']['href']
+            for item in get_links(session, sensors_href, 'items'):
+                sensor = session.get(item['href'], headers=HAL_HEADERS).json()
+                sensors.append({
+                    'href': item['href'],
+                    'id': item['href'].rstrip('/').rsplit('/', 1)[1],
+                    'metric': sensor['metric'],
+                    'data': sensor['_links']['ch:dataHistory']['href'],
+                })
+            if sensors:
+                devices.append({
+                    'data': device['_links']['ch:deviceData']['href'],
+                    'sensors': sensors,
+                })
+    if not devices:
+        raise ValueError('No devices with sensors found at %s' % url)
+    # the bulk endpoint sits next to the sensors' data collections
+    bulk = devices[0]['sensors'][0]['data'].split('?')[0] + 'bulk'
+    return sites, devices, bulk
+
+
+class Client(threading.Thread):
+    '''Sends requests from the mix until the deadline, recording how long
+    each took and whether it failed'''
+
+    def __init__(self, plan, mix, deadline, args):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.sites, self.devices, self.bulk = plan
+        self.kinds = []
+        for kind, weight in sorted(mix.items()):
+            self.kinds.extend([kind] * weight)
+        self.deadline = deadline
+        self.days = int(args['--days'])
+        self.bulk_size = int(args['--bulk-size'])
+        self.session = requests.Session()
+        if args['--auth']:
+            self.session.auth = tuple(args['--auth'].split(':', 1))
+        self.latencies = dict((kind, []) for kind in mix)
+        self.errors = dict((kind, 0) for kind in mix)
+
+    def run(self):
+        while time.time() < self.deadline:
+            kind = random.choice(self.kinds)
+            start = time.time()
+            try:
+                response = getattr(self, kind)()
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            self.latencies[kind].append(time.time() - start)
+            if failed:
+                self.errors[kind] += 1
+
+    def site_summary(self):
+        return self.session.get(random.choice(self.sites)['summary'],
+                                headers=HAL_HEADERS)
+
+    def device_list(self):
+        return self.session.get(random.choice(self.sites)['devices'],
+                                headers=HAL_HEADERS)
+
+    def sensor(self):
+        sensor = random.choice(random.choice(self.devices)['sensors'])
+        return self.session.get(sensor['href'], headers=HAL_HEADERS)
+
+    def sensor_data(self):
+        '''A random range of a few hours to a day of a sensor's data'''
+        sensor = random.choice(random.choice(self.devices)['sensors'])
+        now = time.time()
+        hours = random.choice([1, 6, 24])
+        end = random.uniform(now - self.days * 86400 + hours * 3600, now)
+        return self.session.get(sensor['data'], headers=HAL_HEADERS, params={
+            'timestamp__gte': int(end - hours * 3600),
+            'timestamp__lt': int(end)})
+
+    def device_data(self):
+        device = random.choice(self.devices)
+        data = dict((sensor['metric'], {'value': random.uniform(0, 100)})
+                    for sensor in device['sensors'])
+        return self.session.post(device['data'], headers=HAL_HEADERS,
+                                 data=json.dumps({'data': data}))
+
+    def bulk_upload(self):
+        '''Bulk points for random sensors over the last few minutes'''
+        now = int(time.time())
+        sensors = [sensor for device in self.devices
+                   for sensor in device['sensors']]
+        lines = ['%s,%d,%.3f' % (random.choice(sensors)['id'],
+                                 now - random.randint(0, 600),
+                                 random.uniform(0, 100))
+                 for _ in range(self.bulk_size)]
+        return self.session.post(
+            self.bulk, data='\n'.join(lines),
+            headers={'Content-Type': 'text/csv',
+                     'Accept': 'application/json'})
+
+
+def percentile(latencies, percent):
+    '''The nearest-rank percentile of a sorted list'''
+    index = int(math.ceil(percent / 100.0 * len(latencies))) - 1
+    return latencies[max(0, min(index, len(latencies) - 1))]
+
+
+def summarize(clients, duration):
+    results = {}
+    for kind in clients[0].latencies:
+        latencies = sorted(latency for client in clients
+                           for latency in client.latencies[kind])
+        if not latencies:
+            continue
+        result = {
+            'requests': len(latencies),
+            'errors': sum(client.errors[kind] for client in clients),
+            'throughput': len(latencies) / duration,
+            'max': latencies[-1],
+        }
+        for percent in PERCENTILES:
+            result['p%d' % percent] = percentile(latencies, percent)
+        results[kind] = result
+    return results
+
+
+def print_results(results, duration, previous=None):
+    print '%-14s %8s %7s %9s %9s %9s %9s %9s' % (
+        'request', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'max ms')
+    for kind, result in sorted(results.items()):
+        print '%-14s %8d %7d %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+            kind, result['requests'], result['errors'], result['throughput'],
+            result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000,
+            result['max'] * 1000)
+        if previous and kind in previous:
+            # improvements are more requests per second, in less time
+            print '%-14s %8s %7s %+8.0f%% %+8.0f%% %+8.0f%% %+8.0f%%' % (
+                '  change', '', '',
+                change(result['throughput'], previous[kind]['throughput']),
+                change(result['p50'], previous[kind]['p50']),
+                change(result['p95'], previous[kind]['p95']),
+                change(result['p99'], previous[kind]['p99']))
+    total = sum(result['requests'] for result in results.values())
+    print 'Total: %d requests in %.0fs, %.1f req/s' % (
+        total, duration, total / duration)
+
+
+def change(new, old):
+    '''How much larger new is than old, in percent'''
+    return (new - old) / old * 100 if old else 0
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--mix'] not in MIXES:
+        sys.exit('--mix must be one of %s' % ', '.join(sorted(MIXES)))
+    session = requests.Session()
+    plan = discover(session, args['<url>'], int(args['--devices']),
+                    args['--site-name'])
+    print 'Found %d sites and %d devices with %d sensors' % (
+        len(plan[0]), len(plan[1]),
+        sum(len(device['sensors']) for device in plan[1]))
+
+    duration = float(args['--duration'])
+    start = time.time()
+    clients = [Client(plan, MIXES[args['--mix']], start + duration, args)
+               for _ in range(int(args['--threads']))]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.time() - start
+    results = summarize(clients, duration)
+
+    previous = None
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            previous = json.load(f)['results']
+    print_results(results, duration, previous)
+    if args['--json']:
+        with open(args['--json'], 'w') as f:
+            json.dump({
+                'url': args['<url>'],
+                'mix': args['--mix'],
+                'threads': int(args['--threads']),
+                'date': datetime.utcnow().isoformat() + 'Z',
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
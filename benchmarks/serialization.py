@@ -0,0 +1,227 @@
+# run with
+#   python -m benchmarks.serialization [options]
+# from the top of the repository. It always uses benchmarks/settings.py, so
+# nothing else needs to be running.
+
+'''serialization
+
+Microbenchmarks for the CPU-bound core of an API request: serializing
+resources on their own and in pages of 30, 300 and 3000, building the page
+links, rendering the serialized data as JSON and HTML, parsing it back into a
+HALDoc and building the mixed sensor schema.
+
+The fixtures are made in an in-memory sqlite database, and the sensors'
+latest values are put in the latest value store up front, so nothing goes
+over the network. The pages are fetched from the database before timing
+starts, so the times are just the serialization and not the queries.
+
+Each benchmark is timed like timeit does it, with the garbage collector off:
+one call warms up the caches, then the number of calls in a run is picked so
+a run takes at least --min-time seconds. The best time per call of --repeat
+runs is the one to compare, the median shows how noisy the runs were.
+
+With --json the results are also saved, and --compare prints how each
+benchmark changed from results saved before.
+
+Usage:
+    serialization.py [options]
+
+Options:
+    --repeat=<n>       Runs of each benchmark [default: 7]
+    --min-time=<s>     Shortest time for one run [default: 0.2]
+    --only=<text>      Only run the benchmarks whose names contain this
+    --json=<file>      Save the results to this file
+    --compare=<file>   Compare the results to ones saved before
+'''
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+
+from django.core.management import call_command
+from django.test.client import RequestFactory
+from docopt import docopt
+from chain.core.models import Site, Device, ScalarSensor, Metric, Unit
+from chain.core.resources import DeviceResource, ScalarSensorResource, \
+    MixedSensorResource, json_merge
+from chain.core.api import render_json
+from chain.core.hal import HALDoc
+from chain.core import latest_values
+from benchmarks.generate import SENSOR_TYPES
+from benchmarks.load import change
+from datetime import datetime
+import timeit
+import math
+import json
+
+SIZES = [30, 300, 3000]
+# when the fixtures' latest values were updated, in Influx's format
+UPDATED = '2015-03-04T12:00:00.25Z'
+
+
+def create_fixtures(count):
+    '''Creates a site with count devices, each with one sensor, and returns
+    the devices and sensors with their related objects already fetched'''
+    call_command('syncdb', interactive=False, verbosity=0)
+    site = Site.objects.create(name='Benchmark Site 0',
+                               url='http://example.com/')
+    Device.objects.bulk_create([
+        Device(name='Device %d' % i, site=site, description='A device',
+               building='E14', floor='5', room='Room %d' % (i % 20))
+        for i in range(count)])
+    devices = list(Device.objects.select_related('site').order_by('id'))
+    stubs = [(Metric.objects.get_or_create(name=metric)[0],
+              Unit.objects.get_or_create(name=unit)[0], typical)
+             for metric, unit, typical, _, _, _ in SENSOR_TYPES]
+    ScalarSensor.objects.bulk_create([
+        ScalarSensor(device=device, metric=stubs[i % len(stubs)][0],
+                     unit=stubs[i % len(stubs)][1])
+        for i, device in enumerate(devices)])
+    sensors = list(ScalarSensor.objects.select_related('device')
+                   .order_by('id'))
+    latest_values.get_backend().set_many(dict(
+        (latest_values.value_key(sensor.id),
+         latest_values.make_entry(stubs[i % len(stubs)][2], UPDATED))
+        for i, sensor in enumerate(sensors)), timeout=86400)
+    return devices, sensors
+
+
+def page(resource_class, objs, request, total=None, offset=0, **kwargs):
+    '''A collection resource for a page of objects that were already fetched,
+    so serializing it doesn't query the database'''
+    resource = resource_class(is_list=True, request=request, limit=len(objs),
+                              offset=offset, **kwargs)
+    resource.get_queryset = lambda: objs
+    # the mixed sensors look their items up again for the item links
+    resource.query_models = lambda: objs
+    resource._total_count = total if total is not None else len(objs)
+    return resource
+
+
+def serialize_page(resource_class, objs, request, **kwargs):
+    return lambda: page(resource_class, objs, request).serialize(**kwargs)
+
+
+def make_benchmarks(devices, sensors):
+    '''Returns a list of (name, function) for all the benchmarks'''
+    factory = RequestFactory(HTTP_HOST='localhost')
+    request = factory.get('/')
+    embed_items = {'embedded_rels': set(['items'])}
+    benchmarks = [
+        ('serialize_device', lambda: DeviceResource(
+            obj=devices[0], request=request).serialize()),
+        ('serialize_sensor', lambda: ScalarSensorResource(
+            obj=sensors[0], request=request).serialize()),
+    ]
+    for size in SIZES:
+        benchmarks.extend([
+            ('serialize_devices_%d' % size,
+             serialize_page(DeviceResource, devices[:size], request)),
+            ('serialize_devices_embedded_%d' % size,
+             serialize_page(DeviceResource, devices[:size], request,
+                            **embed_items)),
+            ('serialize_sensors_embedded_%d' % size,
+             serialize_page(MixedSensorResource, sensors[:size], request,
+                            **embed_items)),
+        ])
+
+    # a page in the middle of a collection, so it gets all four page links
+    middle = page(DeviceResource, devices[:30], request, total=len(devices),
+                  offset=300, filters={'site_id': devices[0].site_id})
+    href = middle.get_list_href()
+    benchmarks.extend([
+        ('add_page_links',
+         lambda: middle.add_page_links({'_links': {}}, href)),
+        ('update_href',
+         lambda: middle.update_href(href, offset=330, limit=30)),
+    ])
+
+    for size in SIZES:
+        data = page(DeviceResource, devices[:size], request).serialize(
+            **embed_items)
+        for name, accept in [('json', 'application/json'),
+                             ('html', 'text/html')]:
+            accept_request = factory.get('/', HTTP_ACCEPT=accept)
+            benchmarks.append((
+                'render_%s_%d' % (name, size),
+                lambda data=data, accept_request=accept_request:
+                DeviceResource.render_response(data, accept_request)))
+        # the clients build HALDocs from the parsed response
+        parsed = json.loads(render_json(data, DeviceResource))
+        benchmarks.append(('haldoc_%d' % size,
+                           lambda parsed=parsed: HALDoc(parsed)))
+
+    schema = {
+        'required': ['sensor-type'],
+        'type': 'object',
+        'properties': {
+            'sensor-type': {
+                'type': 'string',
+                'title': 'sensor-type',
+                'enum': MixedSensorResource.available_sensor_types.keys()
+            }
+        },
+        'title': 'Create Sensor'
+    }
+    sub_schema = ScalarSensorResource.get_schema()
+    benchmarks.extend([
+        ('json_merge_sensor_schema', lambda: json_merge(schema, sub_schema)),
+        ('mixed_sensor_schema', MixedSensorResource.get_schema),
+    ])
+    return benchmarks
+
+
+def time_calls(function, repeat, min_time):
+    '''Returns the number of calls in each run, and the times per call of
+    each run'''
+    function()
+    timer = timeit.Timer(function)
+    once = timer.timeit(1)
+    number = max(1, int(math.ceil(min_time / once))) if once > 0 else 1000
+    return number, [elapsed / number for elapsed in
+                    timer.repeat(repeat, number)]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    args = docopt(__doc__)
+    previous = None
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            previous = json.load(f)['results']
+
+    devices, sensors = create_fixtures(max(SIZES))
+    results = {}
+    print '%-32s %8s %12s %12s' % ('benchmark', 'calls', 'best us',
+                                   'median us')
+    for name, function in make_benchmarks(devices, sensors):
+        if args['--only'] and args['--only'] not in name:
+            continue
+        number, times = time_calls(function, int(args['--repeat']),
+                                   float(args['--min-time']))
+        result = {'calls': number, 'best': min(times),
+                  'median': median(times)}
+        results[name] = result
+        line = '%-32s %8d %12.1f %12.1f' % (
+            name, number, result['best'] * 1e6, result['median'] * 1e6)
+        if previous and name in previous:
+            line += ' %+6.0f%%' % change(result['best'],
+                                         previous[name]['best'])
+        print line
+    if args['--json']:
+        with open(args['--json'], 'w') as f:
+            json.dump({
+                'repeat': int(args['--repeat']),
+                'date': datetime.utcnow().isoformat() + 'Z',
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
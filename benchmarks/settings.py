@@ -0,0 +1,42 @@
+'''Settings for the benchmarks that run Chain's code in-process rather than
+against a server, e.g. serialization.py. The database is an in-memory sqlite
+one and the caches are local memory, so they don't touch the deployment's
+data and don't need anything else running.'''
+
+from chain.settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+    },
+    'site_summaries': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'site_summaries',
+    },
+    'latest_values': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'latest_values',
+        # room for the latest value of every sensor in the fixtures
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    'sensor_map': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sensor_map',
+    },
+}
+
+# the tables are made with syncdb rather than the migrations
+INSTALLED_APPS = tuple(app for app in INSTALLED_APPS if app != 'south')
+
+ALLOWED_HOSTS = ['*']
@@ -0,0 +1,166 @@
+# run with
+#   python -m benchmarks.soak <url> [options]
+# from the top of the repository, on the machine the server runs on (the
+# memory reports are only served to it). The server should use
+# benchmarks/fake_influx.py as its Influx, and have MEMORY_SNAPSHOT_INTERVAL
+# and MEMORY_DIAGNOSTICS_DIR set.
+
+'''soak
+
+Drives a Chain server with load.py's mixes of requests for hours, and follows
+the memory of its web workers through /debug/memory, to find the leaks that
+recycling the workers (gunicorn's --max-requests) hides. Run the server
+without --max-requests, so the workers live through the whole soak.
+
+Every --interval seconds it prints each worker's requests, resident memory
+and how much that grew since the worker's baseline (its first snapshot after
+MEMORY_WARMUP_REQUESTS). At the end it reports, for each worker, how much it
+grew per thousand requests and per hour, and the types of objects that grew
+the most, followed by the load driver's results. With --json the memory
+reports of the last sample are saved with them.
+
+Usage:
+    soak.py <url> [options]
+
+Options:
+    --hours=<h>          Hours to send requests for [default: 4]
+    --mix=<mix>          read, write or mixed [default: mixed]
+    --threads=<n>        Number of concurrent clients [default: 4]
+    --interval=<s>       Seconds between memory samples [default: 60]
+    --memory-url=<url>   Where the memory reports are, if not at
+                         debug/memory under <url>
+    --devices=<n>        Most devices to find and use [default: 50]
+    --site-name=<name>   Only use the sites whose names start with this,
+                         e.g. "Benchmark Site"
+    --days=<n>           Data ranges are picked from this many days back
+                         [default: 7]
+    --bulk-size=<n>      Data points in each bulk upload [default: 100]
+    --auth=<user:pass>   Basic auth for the writes, e.g. through nginx
+    --json=<file>        Save the results to this file
+'''
+
+from docopt import docopt
+from datetime import datetime
+from urlparse import urljoin
+from benchmarks.load import MIXES, Client, discover, summarize, print_results
+import requests
+import json
+import time
+import sys
+
+# how many of the types that grew the most are listed for each worker
+TOP_TYPES = 10
+MB = 1024.0 * 1024
+
+
+def get_reports(url):
+    '''The memory reports of the server's workers, by pid, or None if they
+    couldn't be fetched'''
+    try:
+        response = requests.get(url, timeout=60)
+        response.raise_for_status()
+        return dict((report['pid'], report)
+                    for report in response.json()['workers'])
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print 'Could not get the memory reports: %s' % e
+        return None
+
+
+def rss_growth(report):
+    '''How much a worker's memory grew since its baseline, in bytes, and the
+    requests and seconds it grew over'''
+    baseline = report['baseline']
+    if report['rss'] is None or baseline['rss'] is None:
+        return None, 0, 0
+    latest = report['trend'][-1]
+    return (report['rss'] - baseline['rss'],
+            latest['requests'] - baseline['requests'],
+            latest['time'] - baseline['time'])
+
+
+def print_sample(reports, elapsed):
+    for pid, report in sorted(reports.items()):
+        grown, _, _ = rss_growth(report)
+        print '%7.0fs  worker %6d %9d requests %8.1f MB %+8.1f MB%s' % (
+            elapsed, pid, report['requests'], (report['rss'] or 0) / MB,
+            (grown or 0) / MB, '' if report['running'] else '  (exited)')
+    sys.stdout.flush()
+
+
+def print_growth(reports):
+    for pid, report in sorted(reports.items()):
+        grown, requests_made, seconds = rss_growth(report)
+        print 'Worker %d%s: %d requests' % (
+            pid, '' if report['running'] else ' (exited)',
+            report['requests'])
+        if grown is None or not requests_made:
+            print '  not warmed up, or no memory figures'
+            continue
+        print '  grew %.1f MB over %d requests since its baseline: ' \
+            '%.1f KB per 1000 requests, %.1f MB per hour' % (
+                grown / MB, requests_made,
+                grown / 1024.0 / requests_made * 1000,
+                grown / MB / seconds * 3600 if seconds else 0)
+        print '  caches: %s' % ', '.join(
+            '%s %d' % item for item in sorted(report['caches'].items()))
+        for change in report['growth'][:TOP_TYPES]:
+            print '  %+9d %9d  %s' % (change['change'], change['count'],
+                                      change['type'])
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--mix'] not in MIXES:
+        sys.exit('--mix must be one of %s' % ', '.join(sorted(MIXES)))
+    memory_url = args['--memory-url'] or \
+        urljoin(args['<url>'], 'debug/memory')
+    if get_reports(memory_url) is None:
+        sys.exit('The memory reports need to be served to this machine')
+    session = requests.Session()
+    plan = discover(session, args['<url>'], int(args['--devices']),
+                    args['--site-name'])
+    print 'Found %d sites and %d devices with %d sensors' % (
+        len(plan[0]), len(plan[1]),
+        sum(len(device['sensors']) for device in plan[1]))
+
+    interval = float(args['--interval'])
+    start = time.time()
+    deadline = start + float(args['--hours']) * 3600
+    clients = [Client(plan, MIXES[args['--mix']], deadline, args)
+               for _ in range(int(args['--threads']))]
+    for client in clients:
+        client.start()
+    # workers that exit keep their last report
+    reports = {}
+    while True:
+        time.sleep(max(0, min(interval, deadline - time.time())))
+        sample = get_reports(memory_url)
+        if sample:
+            reports.update(sample)
+            print_sample(sample, time.time() - start)
+        if time.time() >= deadline:
+            break
+    for client in clients:
+        client.join()
+    duration = time.time() - start
+
+    print
+    print_growth(reports)
+    print
+    results = summarize(clients, duration)
+    print_results(results, duration)
+    if args['--json']:
+        with open(args['--json'], 'w') as f:
+            json.dump({
+                'url': args['<url>'],
+                'mix': args['--mix'],
+                'threads': int(args['--threads']),
+                'hours': duration / 3600,
+                'date': datetime.utcnow().isoformat() + 'Z',
+                'results': results,
+                'workers': reports.values(),
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
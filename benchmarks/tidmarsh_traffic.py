@@ -0,0 +1,131 @@
+'''tidmarsh_traffic
+
+Publishes made-up TidMarsh sensor reports on a ZMQ PUB socket, like the
+TidMarsh gateways' raw stream that collectors/tidpost listens to. Each device
+reports in turn, at the given overall rate, either in the v2 format, with a
+"data" map of self-describing readings, or in the legacy flat format.
+
+Usage:
+    tidmarsh_traffic.py [options]
+
+Options:
+    --bind=<address>   ZMQ address to publish on [default: tcp://127.0.0.1:5560]
+    --devices=<n>      Number of devices reporting [default: 50]
+    --rate=<n>         Reports per second, from all the devices together
+                       [default: 20]
+    --legacy=<f>       The fraction of reports in the legacy format
+                       [default: 0.2]
+    --duration=<s>     Seconds to publish for, or forever if left out
+'''
+
+from docopt import docopt
+import threading
+import random
+import json
+import time
+import zmq
+
+# the readings every device reports: (metric, unit, low, high)
+READINGS = [
+    ('sht_temperature', u'\N{DEGREE SIGN}C', 5.0, 30.0),
+    ('sht_humidity', 'percent', 20.0, 100.0),
+    ('bmp_temperature', u'\N{DEGREE SIGN}C', 5.0, 30.0),
+    ('bmp_pressure', 'hPa', 990.0, 1030.0),
+    ('illuminance', 'lux', 0.0, 2000.0),
+    ('battery_voltage', 'volts', 3.5, 4.7),
+]
+
+
+def v2_report(device):
+    return {
+        'src': device,
+        'via': '0x0000',
+        'version': 2,
+        'data': dict((metric, {'value': round(random.uniform(low, high), 2),
+                               'unit': unit})
+                     for metric, unit, low, high in READINGS),
+    }
+
+
+def legacy_report(device):
+    '''A report in the old format, where the units are implied by the metric
+    names and nested values become separate metrics (e.g. charge_flags_fault,
+    see tidpost's get_legacy_readings)'''
+    report = dict((metric, round(random.uniform(low, high), 2))
+                  for metric, unit, low, high in READINGS)
+    report['src'] = device
+    report['via'] = '0x0000'
+    report['charge_flags'] = {'fault': False,
+                              'charge': random.random() < 0.5}
+    return report
+
+
+def count_points(report):
+    '''The number of data points tidpost posts for a report'''
+    if 'data' in report:
+        return len(report['data'])
+    return sum(count_points(value) if isinstance(value, dict) else 1
+               for key, value in report.items()
+               if key not in ('src', 'via'))
+
+
+class TrafficGenerator(object):
+    '''Publishes reports from each device in turn, keeping count of how many
+    reports and data points have been sent'''
+
+    def __init__(self, address, devices, rate, legacy):
+        self.zmq_ctx = zmq.Context()
+        self.publisher = self.zmq_ctx.socket(zmq.PUB)
+        self.publisher.bind(address)
+        self.devices = ['0x%04x' % (0x8100 + i) for i in range(devices)]
+        self.rate = rate
+        self.legacy = legacy
+        self.reports = 0
+        self.points = 0
+        self.stopped = threading.Event()
+
+    def run(self, duration=None):
+        start = time.time()
+        n = 0
+        while not self.stopped.is_set():
+            if duration is not None and time.time() - start >= duration:
+                break
+            # wait for the report's turn, rather than sleeping a fixed time,
+            # so the rate holds even if sending is slow
+            delay = start + n / self.rate - time.time()
+            if delay > 0:
+                self.stopped.wait(delay)
+                continue
+            device = self.devices[n % len(self.devices)]
+            if random.random() < self.legacy:
+                report = legacy_report(device)
+            else:
+                report = v2_report(device)
+            self.publisher.send(json.dumps(report))
+            self.reports += 1
+            self.points += count_points(report)
+            n += 1
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main():
+    args = docopt(__doc__)
+    generator = TrafficGenerator(args['--bind'], int(args['--devices']),
+                                 float(args['--rate']),
+                                 float(args['--legacy']))
+    thread = threading.Thread(
+        target=generator.run,
+        args=(float(args['--duration']) if args['--duration'] else None,))
+    thread.daemon = True
+    thread.start()
+    print 'Publishing on %s' % args['--bind']
+    while thread.is_alive():
+        thread.join(5)
+        print '%d reports, %d data points' % (generator.reports,
+                                              generator.points)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+'''websocket_fanout
+
+Measures how fast chain.websocketd fans messages out to its clients. It
+starts a websocketd (or uses one that's already running), connects lots of
+websocket clients spread over a number of tags, then pushes timestamped
+messages into the ZMQ passthrough (ZMQ_PASSTHROUGH_URL_PULL) just like the API
+does. It reports how long each message took to reach each client, how many
+deliveries per second got through and how much memory each connection costs
+websocketd.
+
+The clients are greenlets rather than threads, so tens of thousands of them
+fit in this one process. Each connection uses a file descriptor on both ends,
+so the open file limit (ulimit -n) has to be above the number of connections.
+Memory is read from /proc, so it's only measured on Linux.
+
+Usage:
+    websocket_fanout.py [options]
+
+Options:
+    --connections=<n>  Websocket clients to connect [default: 10000]
+    --tags=<n>         Tags to spread the clients over [default: 100]
+    --messages=<n>     Messages to push, to each tag in turn [default: 1000]
+    --rate=<n>         Messages pushed per second [default: 100]
+    --concurrency=<n>  Connections to open at once [default: 200]
+    --port=<port>      Port to start websocketd on [default: 8101]
+    --url=<url>        Use the websocketd running here instead of starting
+                       one, e.g. ws://127.0.0.1:8001/
+    --pid=<pid>        The process id of that websocketd, to measure its
+                       memory
+    --wait=<s>         Seconds to wait for deliveries after the last message
+                       [default: 10]
+    --json=<file>      Save the results to this file
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+import gevent.lock
+import zmq.green as zmq
+from docopt import docopt
+from websocket import create_connection
+from chain.settings import ZMQ_PASSTHROUGH_URL_PULL
+from benchmarks.load import percentile, PERCENTILES
+from datetime import datetime
+import subprocess
+import resource
+import socket
+import json
+import time
+import sys
+import os
+
+# how long a started websocketd gets to come up, and how long the ZMQ
+# subscriptions for newly connected tags get before messages are pushed
+STARTUP_TIMEOUT = 30
+SUBSCRIBE_WAIT = 2
+# how long a client waits to connect before it counts as failed
+CONNECT_TIMEOUT = 30
+
+
+def start_websocketd(port, connections):
+    '''Runs websocketd under gunicorn the way supervisor does, and waits for it
+    to take connections. Gunicorn's gevent workers only handle 1000
+    connections at a time by default, so this raises the limit to fit'''
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn.app.wsgiapp',
+             '-k', 'flask_sockets.worker', '-b', '127.0.0.1:%d' % port,
+             '--worker-connections', str(max(connections + 100, 1000)),
+             'chain.websocketd:app'], stdout=devnull, stderr=devnull)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except socket.error:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError('websocketd didn\'t start on port %d' %
+                                   port)
+            gevent.sleep(0.2)
+
+
+def rss(pid):
+    '''The resident memory in bytes of a process and its children, which for
+    gunicorn are the workers'''
+    pids = set([pid])
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # the command is in parentheses and might have spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.add(int(entry))
+    total = 0
+    for process_id in pids:
+        try:
+            with open('/proc/%d/status' % process_id) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except IOError:
+            continue
+    return total
+
+
+class Subscribers(object):
+    '''The websocket clients, and the latencies of the messages they got'''
+
+    def __init__(self, url, concurrency):
+        self.url = url
+        self.connecting = gevent.lock.Semaphore(concurrency)
+        self.tag_counts = {}
+        self.failed = 0
+        self.latencies = []
+        self.last_received = None
+        self.greenlets = []
+
+    def connect(self, tag):
+        with self.connecting:
+            try:
+                ws = create_connection(self.url + tag,
+                                       timeout=CONNECT_TIMEOUT)
+            except Exception:
+                self.failed += 1
+                return
+        ws.settimeout(None)
+        self.tag_counts[tag] = self.tag_counts.get(tag, 0) + 1
+        while True:
+            try:
+                message = ws.recv()
+            except Exception:
+                break
+            if not message:
+                break
+            now = time.time()
+            self.latencies.append(now - json.loads(message)['sent'])
+            self.last_received = now
+
+    def connect_all(self, tags, count):
+        self.greenlets = [gevent.spawn(self.connect, tags[i % len(tags)])
+                          for i in range(count)]
+        # wait until every client has either connected or failed
+        while sum(self.tag_counts.values()) + self.failed < count:
+            gevent.sleep(0.1)
+
+    def close(self):
+        gevent.killall(self.greenlets, block=False)
+
+
+def push_messages(tags, count, rate):
+    '''Pushes the messages into the passthrough at the given rate, and returns
+    when the first one was sent'''
+    zmq_ctx = zmq.Context()
+    push = zmq_ctx.socket(zmq.PUSH)
+    push.connect(ZMQ_PASSTHROUGH_URL_PULL)
+    start = time.time()
+    for n in range(count):
+        gevent.sleep(max(0, start + n / rate - time.time()))
+        push.send('%s %s' % (tags[n % len(tags)], json.dumps(
+            {'sent': time.time(), 'sequence': n})))
+    push.close(linger=1000)
+    return start
+
+
+def main():
+    args = docopt(__doc__)
+    connections = int(args['--connections'])
+    message_count = int(args['--messages'])
+    rate = float(args['--rate'])
+    # every tag has the same length, since ZMQ subscriptions match prefixes
+    tags = ['bench-%06d' % i for i in range(int(args['--tags']))]
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if connections + 100 > hard:
+        print 'Warning: the open file limit of %d is too low for %d ' \
+            'connections' % (hard, connections)
+
+    process = None
+    if args['--url']:
+        url = args['--url'].rstrip('/') + '/'
+        pid = int(args['--pid']) if args['--pid'] else None
+    else:
+        process = start_websocketd(int(args['--port']), connections)
+        url = 'ws://127.0.0.1:%s/' % args['--port']
+        pid = process.pid
+    try:
+        memory_before = rss(pid) if pid else None
+        subscribers = Subscribers(url, int(args['--concurrency']))
+        start = time.time()
+        subscribers.connect_all(tags, connections)
+        connect_time = time.time() - start
+        connected = sum(subscribers.tag_counts.values())
+        print 'Connected %d of %d clients over %d tags in %.1fs' % (
+            connected, connections, len(tags), connect_time)
+        gevent.sleep(SUBSCRIBE_WAIT)
+        memory_after = rss(pid) if pid else None
+
+        expected = sum(subscribers.tag_counts.get(tags[n % len(tags)], 0)
+                       for n in range(message_count))
+        first_sent = push_messages(tags, message_count, rate)
+        deadline = time.time() + float(args['--wait'])
+        while len(subscribers.latencies) < expected and \
+                time.time() < deadline:
+            gevent.sleep(0.1)
+        subscribers.close()
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    latencies = sorted(subscribers.latencies)
+    delivered = len(latencies)
+    results = {
+        'connections': connected,
+        'failed_connections': subscribers.failed,
+        'connect_time': connect_time,
+        'tags': len(tags),
+        'messages': message_count,
+        'expected_deliveries': expected,
+        'deliveries': delivered,
+    }
+    if memory_before is not None:
+        results['memory_before'] = memory_before
+        results['memory_after'] = memory_after
+        results['memory_per_connection'] = \
+            (memory_after - memory_before) / max(connected, 1)
+        print 'Memory: %.1f MB before, %.1f MB after, %.1f KB per ' \
+            'connection' % (memory_before / 2.0 ** 20,
+                            memory_after / 2.0 ** 20,
+                            results['memory_per_connection'] / 1024.0)
+    print 'Pushed %d messages at %.0f/s, %d of %d deliveries' % (
+        message_count, rate, delivered, expected)
+    if latencies:
+        results['throughput'] = \
+            delivered / (subscribers.last_received - first_sent)
+        for percent in PERCENTILES:
+            results['p%d' % percent] = percentile(latencies, percent)
+        results['max'] = latencies[-1]
+        print '%.0f deliveries/s, latency p50 %.1f ms, p95 %.1f ms, ' \
+            'p99 %.1f ms, max %.1f ms' % (
+                results['throughput'], results['p50'] * 1000,
+                results['p95'] * 1000, results['p99'] * 1000,
+                results['max'] * 1000)
+    if args['--json']:
+        with open(args['--json'], 'w') as f:
+            json.dump({
+                'url': url,
+                'rate': rate,
+                'date': datetime.utcnow().isoformat() + 'Z',
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
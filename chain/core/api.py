@@ -4,19 +4,33 @@ import logging
 from django.conf.urls import patterns, url
 from django.db import models
 import json
-from django.http import HttpResponse
+import hashlib
+from django.http import HttpResponse, HttpResponseNotModified
 from django.core.urlresolvers import reverse
 from django.views.decorators.csrf import csrf_exempt
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
+from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save
 from datetime import datetime
 from jinja2 import Environment, PackageLoader
 from urlparse import urlparse, urlunparse, parse_qs
 from urllib import urlencode
 from chain.core.models import GeoLocation
+from chain.core import response_cache
+from chain.core.stub_cache import get_stub_cache
+from chain.core import stub_cache
+from chain.core import site_summary
+from chain.core.sensor_map import sensor_map
+from chain.core import timing
+from chain.core import metrics
 from chain.settings import WEBSOCKET_PATH, WEBSOCKET_HOST, \
     ZMQ_PASSTHROUGH_URL_PULL
 import zmq
 import re
+import csv
+import msgpack
+from cStringIO import StringIO
+from functools import wraps
 from pytz import AmbiguousTimeError
 from django.contrib.contenttypes.models import ContentType
 from django.utils import six
@@ -52,9 +66,12 @@ CHAIN_CURIES = [{
 
 HTTP_STATUS_SUCCESS = 200
 HTTP_STATUS_CREATED = 201
+HTTP_STATUS_ACCEPTED = 202
 HTTP_STATUS_NOT_FOUND = 404
+HTTP_STATUS_METHOD_NOT_ALLOWED = 405
 HTTP_STATUS_NOT_ACCEPTABLE = 406
 HTTP_STATUS_BAD_REQUEST = 400
+HTTP_STATUS_BAD_GATEWAY = 502
 
 jinja_env = Environment(loader=PackageLoader('chain.core', 'templates'))
 
@@ -64,6 +81,208 @@ zmq_socket = zmq_ctx.socket(zmq.PUSH)
 zmq_socket.connect(ZMQ_PASSTHROUGH_URL_PULL)
 
 
+def parse_accept_header(accept):
+    '''Parses an HTTP Accept header into a list of (type, subtype, q) tuples,
+    in the order they were given. Media ranges that can't be parsed are
+    skipped'''
+    media_ranges = []
+    for media_range in accept.split(','):
+        parts = media_range.split(';')
+        full_type = parts[0].strip().lower()
+        # some clients send a bare "*" to mean "*/*"
+        if full_type == '*':
+            full_type = '*/*'
+        if full_type.count('/') != 1:
+            continue
+        range_type, range_subtype = full_type.split('/')
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    pass
+        media_ranges.append((range_type, range_subtype, q))
+    return media_ranges
+
+
+def subtype_matches(range_type, range_subtype, subtype):
+    '''How closely a media range's subtype matches a type's: 1 if it's the
+    same, 0.5 if the range is like */json and json is the structured syntax
+    suffix of the subtype (e.g. hal+json), 0 for *, or None if it doesn't
+    match. application/json doesn't cover application/hal+json'''
+    if range_subtype == subtype:
+        return 1
+    if range_type == '*' and '+' in subtype and \
+            range_subtype == subtype.rsplit('+', 1)[1]:
+        return 0.5
+    if range_subtype == '*':
+        return 0
+    return None
+
+
+def negotiate_mime_type(supported, accept):
+    '''Picks the supported MIME type the client prefers given its Accept
+    header. Each type gets the q-value of the most specific media range that
+    matches it, where a range like */json also matches types with the +json
+    suffix. Ties go to the range listed first in the header, and then to the
+    order of the supported list, so wildcards resolve to the first supported
+    type that matches. Returns None if the client accepts none of them'''
+    media_ranges = parse_accept_header(accept)
+    best_type = None
+    best_rank = None
+    for pos, mime_type in enumerate(supported):
+        mtype, subtype = mime_type.split('/')
+        match = None
+        for index, (range_type, range_subtype, q) in enumerate(media_ranges):
+            subtype_match = subtype_matches(range_type, range_subtype,
+                                            subtype)
+            if range_type not in (mtype, '*') or subtype_match is None:
+                continue
+            specificity = (range_type == mtype) + subtype_match
+            if match is None or specificity > match[0]:
+                match = (specificity, index, q)
+        if match is None or match[2] == 0:
+            continue
+        rank = (match[2], -match[1], -pos)
+        if best_rank is None or rank > best_rank:
+            best_type = mime_type
+            best_rank = rank
+    return best_type
+
+
+# Renderers turn serialized resource data into a response body. They're
+# registered by MIME type, and each resource lists the types it supports in
+# its mime_types attribute
+renderers = {}
+
+
+def register_renderer(mime_type, renderer, includes_links=True):
+    '''Registers a renderer function for the given MIME type. The function
+    takes the serialized data and the resource class and returns the response
+    body. If the format has no room for the hal+json links, set
+    includes_links=False and the pagination links will be sent in a Link
+    header instead'''
+    renderers[mime_type] = (renderer, includes_links)
+
+
+def render_json(data, resource_class):
+    return json.dumps(data)
+
+
+def render_html(data, resource_class):
+    context = {'resource': data,
+               'json_str': json.dumps(data, indent=2)}
+    template = jinja_env.get_template('resource.html')
+    return template.render(**context)
+
+
+def render_msgpack(data, resource_class):
+    return msgpack.packb(data)
+
+
+def render_csv(data, resource_class):
+    '''Renders a page of sensor data as CSV, one row per data point with a
+    header row of field names. A single data point (e.g. the response to a
+    POST) is rendered as a single row'''
+    if isinstance(data, dict):
+        rows = data.get('data', [data])
+    else:
+        rows = data
+    columns = resource_class.model_fields
+    body = StringIO()
+    writer = csv.writer(body)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([row.get(column, '') for column in columns])
+    return body.getvalue()
+
+
+register_renderer('application/hal+json', render_json)
+register_renderer('application/json', render_json)
+register_renderer('text/html', render_html)
+register_renderer('application/x-msgpack', render_msgpack)
+register_renderer('text/csv', render_csv, includes_links=False)
+
+
+def link_header(data):
+    '''Builds an HTTP Link header value from the navigation links in the given
+    serialized data, for formats that can't carry the links themselves'''
+    if not isinstance(data, dict):
+        return None
+    links = data.get('_links', {})
+    values = []
+    for rel in ['self', 'first', 'previous', 'next', 'last']:
+        if rel in links:
+            values.append('<%s>; rel="%s"' % (links[rel]['href'], rel))
+    return ', '.join(values) or None
+
+
+def etag_matches(etag, if_none_match):
+    '''Checks whether the given ETag is in the list of ETags from an
+    If-None-Match header. As per RFC 7232 this is a weak comparison'''
+    if if_none_match.strip() == '*':
+        return True
+    strip_weak = lambda tag: tag.strip()[2:] if tag.strip().startswith('W/') \
+        else tag.strip()
+    return strip_weak(etag) in [strip_weak(tag)
+                                for tag in if_none_match.split(',')]
+
+
+def conditional_response(request, response):
+    '''Adds a strong ETag to a successful GET response. If the client's
+    cached copy is still current according to its If-None-Match header, a 304
+    Not Modified response is returned instead. An ETag already set on the
+    response (e.g. from the response cache) is kept.
+
+    There's no Last-Modified: data can be backfilled with timestamps older
+    than a page's newest point, so no time we have says when a page last
+    changed'''
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+        return response
+    if response.has_header('ETag'):
+        etag = response['ETag']
+    else:
+        etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+        response['ETag'] = etag
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is None or not etag_matches(etag, if_none_match):
+        return response
+
+    not_modified_response = HttpResponseNotModified()
+    for header in ['ETag', 'Vary', 'Cache-Control']:
+        if response.has_header(header):
+            not_modified_response[header] = response[header]
+    return not_modified_response
+
+
+def cached_response(view):
+    '''Decorates a resource view classmethod so that its successful GET
+    responses are kept in the response cache, tagged with the tags of every
+    resource serialized to build them. Cache hits skip serialization entirely,
+    and still get answered with a 304 if the client's copy is current'''
+    @wraps(view)
+    def wrapper(cls, request, *args, **kwargs):
+        if request.method != 'GET' or not response_cache.enabled() or \
+                getattr(request, 'skip_response_cache', False):
+            return view(cls, request, *args, **kwargs)
+        entry = response_cache.lookup(request)
+        if entry is not None:
+            response = HttpResponse(entry['content'],
+                                    content_type=entry['content_type'])
+            for header, value in entry['headers'].items():
+                response[header] = value
+            return conditional_response(request, response)
+        response_cache.start(request)
+        response = view(cls, request, *args, **kwargs)
+        if response.status_code == 200:
+            response_cache.store(request, response,
+                                 cls.response_cache_timeout)
+        return response
+    return wrapper
+
+
 def full_reverse(view_name, request, *args, **kwargs):
     partial_reverse = reverse(view_name, *args, **kwargs)
     return request.build_absolute_uri(partial_reverse)
@@ -114,16 +333,16 @@ class CollectionField(object):
     def create_parent_filter(self, parent):
         return {self._reverse_name + '_id': parent._obj.id}
 
-    def serialize(self, parent, request, cache):
-        queryset = self._child_resource_class.queryset
-
+    def serialize(self, parent, request, cache, embed=None):
         # generate a filter on the child collection so we get the actual
         # children, and not all the resources
 
         parent_filter = self.create_parent_filter(parent)
+        if embed is None:
+            embed = self._embed
         return self._child_resource_class(is_list=True, request=request,
                                           filters=parent_filter).serialize(
-                                              embed=self._embed, cache=cache)
+                                              embed=embed, cache=cache)
 
 class MetadataCollectionField(CollectionField):
 
@@ -148,13 +367,15 @@ class ResourceField(object):
         self._parent_field_name = parent_field_name
         self._embed = embed
 
-    def serialize(self, parent, request, cache):
+    def serialize(self, parent, request, cache, embed=None):
         self._related_resource_class = unlazy(self._related_resource_class)
         # TODO: shouldn't be reaching directly into parent._obj! refactor
         obj = getattr(parent._obj, self._parent_field_name)
+        if embed is None:
+            embed = self._embed
         return self._related_resource_class(obj=obj,
                                             request=request).serialize(
-                                                embed=self._embed, cache=cache)
+                                                embed=embed, cache=cache)
 
 
 def serialize_geo_location(loc):
@@ -165,6 +386,84 @@ def serialize_geo_location(loc):
     }
 
 
+# collection filters that correspond to a stream tag, e.g. site_id=3 -> site-3
+filter_tag_pattern = re.compile(r'^(site|device|sensor)(?:_id)?$')
+
+
+def reserve_ids(model, count):
+    '''Takes count ids from the sequence of the model's table. Django 1.6's
+    bulk_create doesn't set the ids of the objects it creates, so we give
+    them ids up front instead. Postgres only'''
+    if count == 0:
+        return []
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                   "FROM generate_series(1, %s)",
+                   [model._meta.db_table, count])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def bulk_create_with_ids(model, objs):
+    '''Creates the objects in bulk, with their ids set. bulk_create doesn't
+    send post_save, so we send it ourselves to keep the in-process caches
+    that listen for it up to date'''
+    for obj, id in zip(objs, reserve_ids(model, len(objs))):
+        obj.id = id
+    model.objects.bulk_create(objs)
+    for obj in objs:
+        post_save.send(sender=model, instance=obj, created=True,
+                       update_fields=None, raw=False, using=connection.alias)
+
+
+def create_or_get(model, field, value):
+    '''Creates the object with the given value of a unique field, or gets
+    the one another request created first'''
+    try:
+        with transaction.atomic():
+            return model.objects.create(**{field: value})
+    except IntegrityError:
+        return model.objects.get(**{field: value})
+
+
+# query parameters that control what gets serialized, rather than filtering
+# the collection
+SERIALIZE_PARAMS = ['fields', 'links', 'embed', 'include_data']
+
+
+def pop_serialize_params(params):
+    '''Removes the serialization query parameters from the given dict of
+    query parameters and returns them as a dict'''
+    return dict((name, params.pop(name)) for name in SERIALIZE_PARAMS
+                if name in params)
+
+
+def parse_serialize_params(params):
+    '''Turns serialization query parameters into keyword arguments for
+    Resource.serialize. fields and links are sets of the field names and
+    link rels to include, where links=none gives no links at all. embed is a
+    list of link rels to embed instead (including "items" for collections),
+    and include_data=false skips looking up the latest sensor values'''
+    def split(value):
+        return set(name.strip() for name in value.split(',') if name.strip())
+    options = {}
+    if 'fields' in params:
+        options['fields'] = split(params['fields'])
+    if 'links' in params:
+        options['links'] = split(params['links']) - set(['none'])
+    if 'embed' in params:
+        options['embedded_rels'] = split(params['embed'])
+    if 'include_data' in params:
+        options['include_data'] = \
+            params['include_data'].lower() not in ['false', '0', 'no']
+    return options
+
+
+def wanted(name, names):
+    '''Checks whether the given field or rel was asked for, where names is
+    None if everything was'''
+    return names is None or name in names
+
+
 def get_filtered_fields(filters):
     filtered_fields = set()
     regex_id = r'(.*)_id$'
@@ -185,9 +484,14 @@ class Resource(object):
     stub_fields = {}
     required_fields = []
     page_size = 30
+    # MIME types this resource can be rendered as, in order of preference
+    mime_types = ['application/hal+json', 'application/json', 'text/html']
+    # how long (in seconds) responses can stay in the response cache, if None
+    # settings.RESPONSE_CACHE_TIMEOUT is used
+    response_cache_timeout = None
 
     def __init__(self, obj=None, is_list=None, data=None, request=None,
-                 filters=None, limit=None, offset=None):
+                 filters=None, limit=None, offset=None, params=None):
         if len([arg for arg in [obj, is_list, data] if arg]) != 1:
             logging.error(
                 'Exactly 1 object, queryset, or primitive data is required')
@@ -202,6 +506,8 @@ class Resource(object):
             self._data = data
 
         self._filters = filters or {}
+        # serialization query parameters, which need to be kept in links
+        self._params = params or {}
         self._request = request
         self._limit = limit or self.page_size
         self._offset = offset or 0
@@ -217,25 +523,30 @@ class Resource(object):
         '''Serializes this object, assuming that there is a single instance to
         be serialized. Note that this only gets called from the top-level
         serialize() method, which handles checking whether we're in the
-        cache'''
+        cache. The fields, links and embedded_rels keyword arguments limit
+        what gets serialized, see parse_serialize_params'''
         data = {}
         if not embed:
             # this is just a link, don't embed the full object
             data['href'] = self.get_single_href()
             data['title'] = self.get_title()
             return data
+        fields = kwargs.get('fields')
+        links = kwargs.get('links')
+        embedded_rels = kwargs.get('embedded_rels') or set()
         if rels:
-            data['_links'] = {
-                'self': {
+            data['_links'] = {}
+            if wanted('self', links):
+                data['_links']['self'] = {
                     'href': self.get_single_href(),
-                },
-                'ch:websocketStream': {
+                    'title': self.get_title(),
+                }
+            if wanted('ch:websocketStream', links):
+                data['_links']['ch:websocketStream'] = {
                     'href': self.get_websocket_href(),
                     'title': 'Websocket Stream'
-                },
-                'curies': CHAIN_CURIES
-            }
-            if kwargs.get('edit', True):
+                }
+            if kwargs.get('edit', True) and wanted('editForm', links):
                 data['_links']['editForm'] = {
                     'href': self.get_edit_href(),
                     'title': 'Edit %s' % capitalize(self.resource_type)
@@ -243,20 +554,31 @@ class Resource(object):
 
             for field_name, collection in self.related_fields.items():
                 # collection is a CollectionField or ResourceField here
-                data['_links'][field_name] = collection.serialize(
-                    self, self._request, cache)
-
-            data['_links']['self']['title'] = self.get_title()
+                if field_name in embedded_rels:
+                    data.setdefault('_embedded', {})[field_name] = \
+                        collection.serialize(self, self._request, cache,
+                                             embed=True)
+                if wanted(field_name, links):
+                    data['_links'][field_name] = collection.serialize(
+                        self, self._request, cache)
+
+            if data['_links']:
+                data['_links']['curies'] = CHAIN_CURIES
+            else:
+                del data['_links']
 
         for field_name in self.model_fields:
-            data[field_name] = self.serialize_field(
-                getattr(self._obj, field_name))
+            if wanted(field_name, fields):
+                data[field_name] = self.serialize_field(
+                    getattr(self._obj, field_name))
         for stub in self.stub_fields.keys():
-            stub_data = getattr(self._obj, stub)
-            data[stub] = getattr(stub_data, self.stub_fields[stub])
+            if wanted(stub, fields):
+                stub_data = self.get_stub_object(stub)
+                data[stub] = getattr(stub_data, self.stub_fields[stub])
         # check to see whether this object has a geolocation
         try:
-            loc = self._obj.geo_location
+            loc = self._obj.geo_location if wanted('geoLocation', fields) \
+                else None
             if loc is not None:
                 data['geoLocation'] = serialize_geo_location(loc)
         except AttributeError:
@@ -264,6 +586,21 @@ class Resource(object):
             pass
         return data
 
+    def filter_serialized(self, data, fields=None, links=None, **kwargs):
+        '''Removes any fields or links that weren't asked for from serialized
+        data, including ones added by subclasses'''
+        if fields is not None:
+            for key in data.keys():
+                if key not in fields and not key.startswith('_'):
+                    del data[key]
+        if links is not None and '_links' in data:
+            for rel in data['_links'].keys():
+                if rel not in links and rel != 'curies':
+                    del data['_links'][rel]
+            if set(data['_links'].keys()) <= set(['curies']):
+                del data['_links']
+        return data
+
     def serialize_stream(self):
         '''By default resources are serialized for streams in their normal
         format. Resource subclasses can override this if they want a different
@@ -296,7 +633,7 @@ class Resource(object):
         if tfield in self.model_fields:
             return self.serialize_field(getattr(self._obj, tfield))
         elif tfield in self.stub_fields.keys():
-            stub_data = getattr(self._obj, tfield)
+            stub_data = self.get_stub_object(tfield)
             return getattr(stub_data, self.stub_fields[tfield])
         else:
             raise NotImplementedError(
@@ -351,7 +688,7 @@ class Resource(object):
         and pagination query parameters'''
         # TODO: use this for single views as well
         href = full_reverse(self.resource_name + '-list', self._request)
-        query_params = self._filters.items()
+        query_params = self._filters.items() + self._params.items()
         href += '?' + urlencode(query_params)
         return href
 
@@ -368,6 +705,47 @@ class Resource(object):
         or editing an existing one'''
         return []
 
+    def get_cache_tags(self):
+        '''Returns the tags of cached responses that include this resource, so
+        they can be invalidated when one of the tags gets published to.
+        Objects are tagged like their streams. Collections are tagged with the
+        objects they're filtered on, or with the resource name if they aren't
+        filtered on any, so that new items show up'''
+        if self._state == 'object' and self.model is not None:
+            return ['%s-%s' % (self.resource_type, self._obj.id)]
+        elif self._state == 'list':
+            tags = []
+            for field, value in self._filters.items():
+                match = filter_tag_pattern.match(field)
+                if match and str(value).isdigit():
+                    tags.append('%s-%s' % (match.group(1), value))
+            return tags or [self.resource_name]
+        return []
+
+    def publish(self, extra_tags=None):
+        '''Pushes this resource to its streams and invalidates any cached
+        responses that include it. This gets called after POSTing (either
+        creating a new resource or editing an existing one). extra_tags are
+        only used for invalidation'''
+        type(self).publish_list([self], extra_tags)
+
+    @classmethod
+    def publish_list(cls, resources, extra_tags=None):
+        '''Publishes a batch of resources, invalidating the cached responses
+        for all of them at once'''
+        invalidated = set(extra_tags or [])
+        invalidated.add(cls.resource_name)
+        for resource in resources:
+            tags = resource.get_tags()
+            if tags:
+                stream_data = json.dumps(resource.serialize_stream())
+            for tag in tags:
+                with timing.phase('zmq'):
+                    zmq_socket.send_string(tag + ' ' + stream_data)
+                metrics.STREAM_MESSAGES.inc()
+            invalidated.update(tags)
+        response_cache.invalidate(invalidated)
+
     def add_page_links(self, data, href):
         offset = self._offset
         limit = self._limit
@@ -410,9 +788,23 @@ class Resource(object):
             }
         return data
 
-    def serialize_list(self, embed, cache):
+    def get_item_resource(self, obj):
+        '''Returns a resource for an item in this collection'''
+        return self.__class__(obj=obj, request=self._request)
+
+    @classmethod
+    def prepare_items(cls, objs, **kwargs):
+        '''Called with the items of a collection before they're embedded, with
+        the keyword arguments they'll be serialized with. Subclasses can look
+        up whatever the items need for all of them at once here, rather than
+        with a query per item'''
+        pass
+
+    def serialize_list(self, embed, cache, *args, **kwargs):
         '''Serializes this object, assuming that there is a queryset that needs
-        to be serialized as a collection'''
+        to be serialized as a collection. If "items" is in the embedded_rels
+        keyword argument the items are embedded, and serialized with the rest
+        of the keyword arguments'''
 
         href = self.get_list_href()
 
@@ -436,10 +828,23 @@ class Resource(object):
             },
             'totalCount': self.get_total_count()
         }
+        if not wanted('createForm', kwargs.get('links')):
+            del serialized_data['_links']['createForm']
         queryset = self.get_queryset()
-        serialized_data['_links']['items'] = [
-            self.__class__(obj=obj, request=self._request).
-            serialize(cache=cache, embed=False) for obj in queryset]
+        embedded_rels = kwargs.get('embedded_rels') or set()
+        if 'items' in embedded_rels:
+            item_kwargs = dict(kwargs,
+                               embedded_rels=embedded_rels - set(['items']))
+            self.prepare_items(queryset, **item_kwargs)
+            serialized_data['_embedded'] = {'items': [
+                self.get_item_resource(obj).serialize(cache=cache,
+                                                      **item_kwargs)
+                for obj in queryset]}
+        if wanted('items', kwargs.get('links')):
+            serialized_data['_links']['items'] = [
+                self.get_item_resource(obj).serialize(cache=cache,
+                                                      embed=False)
+                for obj in queryset]
 
         serialized_data = self.add_page_links(serialized_data, href)
         return serialized_data
@@ -448,6 +853,9 @@ class Resource(object):
         '''Serializes this instance into a dictionary that can be rendered'''
         if cache is None:
             cache = {}
+        # a collection that's just linked to doesn't depend on its contents
+        if self._state != 'list' or embed:
+            response_cache.add_tags(self._request, self.get_cache_tags())
 
         # first check to see if we're already in the cache, in which case we
         # can just return what was already calculated. Note that the key for
@@ -459,6 +867,10 @@ class Resource(object):
             # we don't currently handle cacheing whole collection lists.
             self._data = self.serialize_list(embed, cache,
                                              *args, **kwargs)
+            # fields apply to the items, but links to the collection too
+            if embed:
+                self.filter_serialized(self._data,
+                                       links=kwargs.get('links'))
 
         elif self._state == 'object':
             cache_key = self.get_cache_key()
@@ -467,6 +879,8 @@ class Resource(object):
             else:
                 self._data = self.serialize_single(embed, cache,
                                                    *args, **kwargs)
+                if embed:
+                    self.filter_serialized(self._data, **kwargs)
                 cache[(cache_key, embed)] = self._data
         return self._data
 
@@ -475,24 +889,100 @@ class Resource(object):
 
     def stub_object_finding(self, obj, field_name, field_value):
         '''Looks up the matching related field, and creates it if it doesn't
-        already exist.'''
-        stub_field = self.stub_fields[field_name]
-        field = getattr(self.model, field_name).field
-        # so now we have a model we can run queries against
-        related_class = field.rel.to
-
-        query_args = {stub_field: field_value}
+        already exist. If the related objects were already looked up for a
+        whole batch (see find_stub_objects) they're used instead'''
         try:
-            matching_related_obj = related_class.objects.get(**query_args)
-        except related_class.DoesNotExist:
+            return self._stub_objects[field_name][field_value]
+        except (AttributeError, KeyError, TypeError):
+            pass
+        stub_field = self.stub_fields[field_name]
+        related_cache = self.get_stub_cache(field_name)
+        matching_related_obj = related_cache.get_by_value(field_value)
+        if matching_related_obj is None:
             # a matching object doesn't exist, so we'll create it
             # TODO: this will crash if we can't build up an object based on the
             # given data
-            matching_related_obj = related_class(**query_args)
-            matching_related_obj.save()
+            related_class = getattr(self.model, field_name).field.rel.to
+            query_args = {stub_field: field_value}
+            try:
+                with transaction.atomic():
+                    matching_related_obj = related_class(**query_args)
+                    matching_related_obj.save()
+            except IntegrityError:
+                # another process created it since we warmed up the cache
+                matching_related_obj = related_class.objects.get(**query_args)
+                related_cache.add(matching_related_obj)
 
         return matching_related_obj
 
+    @classmethod
+    def get_stub_cache(cls, field_name):
+        '''Returns the cache of the objects the given stub field points to'''
+        related_class = getattr(cls.model, field_name).field.rel.to
+        return get_stub_cache(related_class, cls.stub_fields[field_name])
+
+    def get_stub_object(self, field_name):
+        '''Returns the object a stub field of this object points to, from the
+        stub cache rather than the database'''
+        field = getattr(self.model, field_name).field
+        return self.get_stub_cache(field_name).get_by_id(
+            getattr(self._obj, field.attname))
+
+    @classmethod
+    def find_stub_objects(cls, items):
+        '''Looks up the related objects for the stub fields of all the given
+        items with one query per stub field, creating any that don't exist
+        yet. Returns a dict mapping stub field names to dicts of objects keyed
+        by the given values'''
+        stub_objects = {}
+        for field_name, stub_field in cls.stub_fields.items():
+            related_class = getattr(cls.model, field_name).field.rel.to
+            related_cache = cls.get_stub_cache(field_name)
+            values = set()
+            for item in items:
+                try:
+                    values.add(item[field_name])
+                except (KeyError, TypeError):
+                    # bad items get reported by deserialization
+                    pass
+            names = set(smart_text(value) for value in values)
+            by_name = related_cache.get_many_by_value(names)
+            missing = names - set(by_name.keys())
+            if missing:
+                new_objs = [related_class(**{stub_field: name})
+                            for name in missing]
+                try:
+                    with transaction.atomic():
+                        bulk_create_with_ids(related_class, new_objs)
+                except IntegrityError:
+                    # another request created some of them in the meantime
+                    new_objs = [create_or_get(related_class, stub_field, name)
+                                for name in missing]
+                by_name.update((getattr(obj, stub_field), obj)
+                               for obj in new_objs)
+            stub_objects[field_name] = dict(
+                (value, by_name[smart_text(value)]) for value in values)
+        return stub_objects
+
+    @classmethod
+    def find_filter_objects(cls, filters):
+        '''Looks up the objects a collection is filtered on, e.g. the device
+        for ?device_id=4, so they can be shared by a batch of new items'''
+        filter_objects = {}
+        for key, value in filters.items():
+            if not key.endswith('_id') or not cls.model_has_field(key[:-3]):
+                continue
+            field = cls.model._meta.get_field_by_name(key[:-3])[0]
+            if field.__class__ != models.ForeignKey:
+                continue
+            try:
+                filter_objects[field.name] = field.rel.to.objects.get(
+                    id=value)
+            except (field.rel.to.DoesNotExist, ValueError):
+                raise BadRequestException(
+                    "The %s to add to does not exist." % field.name)
+        return filter_objects
+
     @classmethod
     def model_has_field(cls, field_name):
         try:
@@ -604,7 +1094,7 @@ class Resource(object):
             props[field]['default'] = self.serialize_field(
                 getattr(self._obj, field))
         for stub in self.stub_fields.keys():
-            stub_data = getattr(self._obj, stub)
+            stub_data = self.get_stub_object(stub)
             props[stub]['default'] = getattr(stub_data, self.stub_fields[stub])
         try:
             geo_loc = self._obj.geo_location
@@ -624,42 +1114,35 @@ class Resource(object):
 
     @classmethod
     def render_response(cls, data, request, status=None):
-        # TODO: there's got to be a more robust library to parse accept headers
-        if 'HTTP_ACCEPT' not in request.META:
-            request.META['HTTP_ACCEPT'] = 'application/json'
-        for accept in request.META['HTTP_ACCEPT'].split(','):
-            accept = accept.strip()
-            # first handle possible wildcards
-            if accept in ['*/*', 'application/*', '*/json', '*/hal+json']:
-                accept = 'application/hal+json'
-            if accept in ['application/hal+json', 'application/json']:
-                resp = HttpResponse(json.dumps(data), status=status,
-                                    content_type=accept)
-                patch_vary_headers(resp, ['Accept'])
-                return resp
-            elif accept == 'text/html':
-                context = {'resource': data,
-                           'json_str': json.dumps(data, indent=2)}
-                template = jinja_env.get_template('resource.html')
-                resp = HttpResponse(template.render(**context),
-                                    status=status,
-                                    content_type=accept)
-                patch_vary_headers(resp, ['Accept'])
-                return resp
-        err_data = {
-            'message': "MIME type not supported.\ Try text/html, \
-            application/json, or application/hal+json",
-        }
-        return HttpResponse(json.dumps(err_data),
-                            status=HTTP_STATUS_NOT_ACCEPTABLE,
-                            content_type="application/hal+json")
+        accept = request.META.get('HTTP_ACCEPT', 'application/json')
+        mime_type = negotiate_mime_type(cls.mime_types, accept)
+        if mime_type is None:
+            err_data = {
+                'message': "MIME type not supported. Try %s" %
+                ', '.join(cls.mime_types),
+            }
+            return HttpResponse(json.dumps(err_data),
+                                status=HTTP_STATUS_NOT_ACCEPTABLE,
+                                content_type="application/hal+json")
+        renderer, includes_links = renderers[mime_type]
+        with timing.phase('render'):
+            body = renderer(data, cls)
+        resp = HttpResponse(body, status=status, content_type=mime_type)
+        if not includes_links:
+            links = link_header(data)
+            if links:
+                resp['Link'] = links
+        patch_vary_headers(resp, ['Accept'])
+        return resp
 
     @classmethod
     @csrf_exempt
+    @cached_response
     def list_view(cls, request):
         offset = None
         limit = None
         filters = request.GET.dict()
+        params = pop_serialize_params(filters)
         if 'offset' in filters:
             try:
                 offset = int(filters.pop('offset'))
@@ -671,10 +1154,12 @@ class Resource(object):
             except ValueError:
                 pass
         try:
-            response_data = cls(is_list=True, request=request,
-                                filters=filters, offset=offset,
-                                limit=limit).serialize()
-            return cls.render_response(response_data, request)
+            resource = cls(is_list=True, request=request, filters=filters,
+                           offset=offset, limit=limit, params=params)
+            response_data = resource.serialize(
+                **parse_serialize_params(params))
+            response = cls.render_response(response_data, request)
+            return conditional_response(request, response)
         except BadRequestException as e:
             return render_error(HTTP_STATUS_BAD_REQUEST, e.message, request)
 
@@ -736,11 +1221,15 @@ class Resource(object):
         return schema
 
     @classmethod
+    @cached_response
     def single_view(cls, request, id):
         try:
-            response_data = cls(obj=cls.get_object_by_id(id),
-                                request=request).serialize()
-            return cls.render_response(response_data, request)
+            resource = cls(obj=cls.get_object_by_id(id), request=request)
+            params = pop_serialize_params(request.GET.dict())
+            response_data = resource.serialize(
+                **parse_serialize_params(params))
+            response = cls.render_response(response_data, request)
+            return conditional_response(request, response)
         except cls.model.DoesNotExist:
             return handle404(request)
 
@@ -756,6 +1245,9 @@ class Resource(object):
             # if not request.user.is_authenticated():
             #    return render_401(request)
             resource = cls(obj=cls.get_object_by_id(id), request=request)
+            # the object may move (e.g. to a different site), so responses
+            # that included it where it was are invalidated as well
+            old_tags = resource.get_tags()
             try:
                 data = json.loads(request.body)
             except ValueError:
@@ -772,11 +1264,7 @@ class Resource(object):
                     request)
             response_data = resource.serialize()
             # push to the appropriate streams
-            tags = resource.get_tags()
-            if tags:
-                stream_data = json.dumps(resource.serialize_stream())
-            for tag in tags:
-                zmq_socket.send_string(tag + ' ' + stream_data)
+            resource.publish(extra_tags=old_tags)
             return cls.render_response(response_data, request)
 
     @classmethod
@@ -807,11 +1295,7 @@ class Resource(object):
         new_resource = cls(data=data, request=request, filters=obj_params)
         new_resource.save()
         response_data = new_resource.serialize()
-        tags = new_resource.get_tags()
-        if tags:
-            stream_data = json.dumps(new_resource.serialize_stream())
-        for tag in tags:
-            zmq_socket.send_string(tag + ' ' + stream_data)
+        new_resource.publish()
         return response_data
 
     @classmethod
@@ -827,10 +1311,121 @@ class Resource(object):
             return render_error(
                 400, 'Error storing object. Timestamp is ambiguous',
                 request)
+        except BadRequestException as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST, e.message, request)
         return cls.render_response(response_data, request,
                                    status=HTTP_STATUS_CREATED)
     @classmethod
     def create_list(cls, data, request):
+        '''Creates all the items in the given list, or none of them. Model
+        resources are created in bulk in a single transaction, if any items
+        are bad a 400 response is returned listing the errors by index'''
+        if cls.model is None:
+            return cls.create_each(data, request)
+        try:
+            with site_summary.changes_in_transaction():
+                with transaction.atomic():
+                    try:
+                        resources = cls.bulk_create_resources(data, request)
+                    except Exception:
+                        # the objects created in the transaction are gone,
+                        # but the caches were told about them
+                        stub_cache.clear()
+                        sensor_map.clear()
+                        raise
+        except ItemErrors as e:
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST, 'Error storing objects. None of '
+                'the given objects were created', request, errors=e.errors)
+        except BadRequestException as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST, e.message, request)
+        cache = {}
+        # new objects don't have any sensor data yet, so don't look for it
+        response_data = [resource.serialize(cache=cache, include_data=False)
+                         for resource in resources]
+        cls.publish_list(resources)
+        return cls.render_response(response_data, request,
+                                   status=HTTP_STATUS_CREATED)
+
+    @classmethod
+    def bulk_create_resources(cls, data, request):
+        '''Deserializes and saves all the given items with a handful of
+        queries. Needs to be called in a transaction, which should be rolled
+        back if ItemErrors is raised'''
+        if not isinstance(data, list):
+            raise BadRequestException('Expected a list of objects.')
+        obj_params = request.GET.dict()
+        filtered_fields = get_filtered_fields(obj_params)
+        required_fields = [field for field in cls.required_fields
+                           if field not in filtered_fields]
+        errors = []
+        for index, item in enumerate(data):
+            if not isinstance(item, dict):
+                errors.append({'index': index,
+                               'message': 'Expected an object.'})
+                continue
+            for field in required_fields:
+                if field not in item:
+                    errors.append({'index': index, 'message':
+                                   'Missing required field %s.' % field})
+        if errors:
+            raise ItemErrors(errors)
+
+        stub_objects = cls.find_stub_objects(data)
+        filter_objects = cls.find_filter_objects(obj_params)
+        has_geo_location = cls.model_has_field('geo_location')
+        resources = []
+        locations = []
+        for index, item in enumerate(data):
+            item = dict(item)
+            loc_data = item.pop('geoLocation', None)
+            resource = cls(data=item, request=request, filters=obj_params)
+            resource._stub_objects = stub_objects
+            try:
+                obj = resource.deserialize()
+                if has_geo_location and loc_data is not None:
+                    obj.geo_location = GeoLocation(
+                        elevation=loc_data.get('elevation', None),
+                        latitude=loc_data['latitude'],
+                        longitude=loc_data['longitude'])
+                    locations.append(obj.geo_location)
+            except (BadRequestException, ValidationError, KeyError,
+                    ValueError, TypeError, AttributeError) as e:
+                errors.append({'index': index, 'message':
+                               'Error reading object: %s' % e})
+                continue
+            for field_name, related_obj in filter_objects.items():
+                setattr(obj, field_name, related_obj)
+            resources.append(resource)
+        if errors:
+            raise ItemErrors(errors)
+
+        bulk_create_with_ids(GeoLocation, locations)
+        objs = [new_resource._obj for new_resource in resources]
+        for obj in objs:
+            if has_geo_location and obj.geo_location is not None:
+                # re-assign so the id we just gave the location gets copied
+                obj.geo_location = obj.geo_location
+        try:
+            with transaction.atomic():
+                bulk_create_with_ids(cls.model, objs)
+        except IntegrityError:
+            # find out which objects are the problem, one savepoint each
+            for index, obj in enumerate(objs):
+                try:
+                    with transaction.atomic():
+                        obj.save(force_insert=True)
+                except IntegrityError:
+                    errors.append({'index': index, 'message':
+                                   'Either required fields are missing data '
+                                   'or a matching object already exists.'})
+            raise ItemErrors(errors or [{
+                'index': None, 'message': 'Error storing objects.'}])
+        return resources
+
+    @classmethod
+    def create_each(cls, data, request):
+        '''Creates the items in the given list one at a time'''
         response_data = []
         for item in data:
             try:
@@ -844,6 +1439,9 @@ class Resource(object):
                 return render_error(
                     400, 'Error storing object. Timestamp is ambiguous',
                     request)
+            except BadRequestException as e:
+                return render_error(HTTP_STATUS_BAD_REQUEST, e.message,
+                                    request)
         return cls.render_response(response_data, request,
                                    status=HTTP_STATUS_CREATED)
 
@@ -916,11 +1514,25 @@ class BadRequestException(Exception):
         return "[Bad Request: " + repr(self.message) + "]"
 
 
-def render_error(status, msg, request):
+class ItemErrors(Exception):
+
+    '''Raised when some of the items in a list can't be created. errors is a
+    list of dicts with the index of the bad item and a message'''
+
+    def __init__(self, errors):
+        self.errors = errors
+
+    def __str__(self):
+        return "[Item Errors: " + repr(self.errors) + "]"
+
+
+def render_error(status, msg, request, errors=None):
     err_data = {
         'status': status,
         'message': msg,
     }
+    if errors is not None:
+        err_data['errors'] = errors
     return HttpResponse(json.dumps(err_data), status=status,
                         content_type="application/json")
 
@@ -0,0 +1,214 @@
+'''Bulk upload of scalar sensor data, for gateways replaying readings they
+buffered while offline.
+
+The body is either CSV with sensor_id,timestamp,value rows or a subset of the
+Influx line protocol, one point per line:
+
+    <measurement>,sensor_id=<id>[,<tag>=<value>...] value=<value> [<time>]
+
+Only the sensor_id tag and the value field are used, the measurement and the
+site and device tags are always the ones Chain uses. The body is read a line
+at a time and points are written to Influx BULK_UPLOAD_BATCH_SIZE at a time, so
+memory use doesn't depend on the size of the upload. Lines that can't be
+parsed or are for sensors that don't exist are skipped and reported, the rest
+of the upload is still written.'''
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from chain.core import latest_values, response_cache
+from chain.core.models import ScalarSensor
+from chain.core.sensor_map import sensor_map
+from datetime import datetime
+from pytz import AmbiguousTimeError
+import csv
+import math
+
+# line protocol timestamps are in nanoseconds unless the precision parameter
+# says otherwise
+PRECISIONS = {'n': 1e9, 'ns': 1e9, 'u': 1e6, 'ms': 1e3, 's': 1}
+
+
+class LineError(ValueError):
+    pass
+
+
+def from_epoch(seconds):
+    return datetime.utcfromtimestamp(seconds).replace(tzinfo=timezone.utc)
+
+
+def parse_sensor_id(sensor_id):
+    try:
+        sensor_id = int(sensor_id)
+    except ValueError:
+        raise LineError('Invalid sensor id %r' % sensor_id)
+    if sensor_id <= 0:
+        raise LineError('Invalid sensor id %r' % sensor_id)
+    return sensor_id
+
+
+def parse_value(value):
+    try:
+        value = float(value)
+    except ValueError:
+        raise LineError('Invalid value %r' % value)
+    # Influx can't store these, and would reject the whole batch
+    if math.isnan(value) or math.isinf(value):
+        raise LineError('Invalid value %r' % value)
+    return value
+
+
+def parse_csv_timestamp(timestamp):
+    '''Parses an ISO 8601 timestamp or unix time in seconds. Timestamps
+    without a timezone are in the server's timezone, as when posting JSON'''
+    if not timestamp:
+        return timezone.now()
+    try:
+        return from_epoch(float(timestamp))
+    except (ValueError, OverflowError):
+        pass
+    try:
+        parsed = parse_datetime(timestamp)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise LineError('Invalid timestamp %r' % timestamp)
+    if timezone.is_aware(parsed):
+        return parsed
+    try:
+        return timezone.make_aware(parsed, timezone.get_current_timezone())
+    except AmbiguousTimeError:
+        raise LineError('Timestamp %r is ambiguous' % timestamp)
+
+
+def parse_csv_line(line, precision):
+    try:
+        row = next(csv.reader([line]))
+    except csv.Error as e:
+        raise LineError(str(e))
+    if len(row) != 3:
+        raise LineError('Expected sensor_id,timestamp,value')
+    sensor_id, timestamp, value = [field.strip() for field in row]
+    return (parse_sensor_id(sensor_id), parse_csv_timestamp(timestamp),
+            parse_value(value))
+
+
+def parse_line_protocol_line(line, precision):
+    parts = line.split()
+    if len(parts) not in (2, 3):
+        raise LineError('Expected <measurement>,sensor_id=<id> '
+                        'value=<value> [<time>]')
+    tags = dict(tag.split('=', 1) for tag in parts[0].split(',')[1:]
+                if '=' in tag)
+    fields = dict(field.split('=', 1) for field in parts[1].split(',')
+                  if '=' in field)
+    if 'sensor_id' not in tags:
+        raise LineError('Missing sensor_id tag')
+    if 'value' not in fields:
+        raise LineError('Missing value field')
+    if len(parts) == 3:
+        try:
+            timestamp = from_epoch(int(parts[2]) / precision)
+        except (ValueError, OverflowError):
+            raise LineError('Invalid timestamp %r' % parts[2])
+    else:
+        timestamp = timezone.now()
+    return (parse_sensor_id(tags['sensor_id']), timestamp,
+            parse_value(fields['value']))
+
+
+class BulkUpload(object):
+    '''Parses uploaded lines and writes them to Influx in batches, keeping
+    track of what's been written and which lines had errors'''
+
+    def __init__(self, influx_client, format='line', precision='ns'):
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision %r' % precision)
+        self._influx_client = influx_client
+        self._parse_line = parse_csv_line if format == 'csv' \
+            else parse_line_protocol_line
+        self._precision = PRECISIONS[precision]
+        self._csv = format == 'csv'
+        self._batch = []
+        self._tags = set()
+        self.lines = 0
+        # every line up to this one has been written (or skipped), so an
+        # upload that failed can be resumed from the next one
+        self.completed_lines = 0
+        self.written = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line_number, message):
+        self.error_count += 1
+        if len(self.errors) < settings.BULK_UPLOAD_MAX_ERRORS:
+            self.errors.append({'line': line_number, 'message': message})
+
+    def add_line(self, line):
+        self.lines += 1
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return
+        if self._csv and self.lines == 1 and line.startswith('sensor_id'):
+            # header row
+            return
+        try:
+            sensor_id, timestamp, value = self._parse_line(
+                line, self._precision)
+            device_id, site_id = sensor_map.get(sensor_id)
+        except LineError as e:
+            self.add_error(self.lines, str(e))
+            return
+        except ScalarSensor.DoesNotExist:
+            self.add_error(self.lines, 'No sensor with id %d' % sensor_id)
+            return
+        self._batch.append((site_id, device_id, sensor_id, value, timestamp))
+        if len(self._batch) >= settings.BULK_UPLOAD_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        '''Writes the current batch to Influx, then updates the latest values
+        of its sensors. Raises IntegrityError if Influx rejects it'''
+        if not self._batch:
+            self.completed_lines = self.lines
+            return
+        self._influx_client.post_data_batch(self._batch)
+        # only the newest point of each sensor can be its latest value
+        newest = {}
+        for site_id, device_id, sensor_id, value, timestamp in self._batch:
+            if sensor_id not in newest or newest[sensor_id][1] < timestamp:
+                newest[sensor_id] = (value, timestamp)
+            self._tags.update(['sensor-%d' % sensor_id,
+                               'device-%d' % device_id,
+                               'site-%d' % site_id])
+        for sensor_id, (value, timestamp) in newest.items():
+            latest_values.store(sensor_id, value, timestamp)
+        self.written += len(self._batch)
+        self.completed_lines = self.lines
+        self._batch = []
+
+    def finish(self):
+        '''Invalidates the cached responses for the sensors that got data.
+        Called once at the end, whether or not all the data was written'''
+        if self._tags:
+            self._tags.add('scalar_data')
+            response_cache.invalidate(self._tags)
+
+    def run(self, lines):
+        '''Writes all the given lines, returning the summary of the upload'''
+        try:
+            for line in lines:
+                self.add_line(line)
+            self.flush()
+        finally:
+            self.finish()
+        return self.summary()
+
+    def summary(self):
+        return {
+            'lines': self.lines,
+            'completedLines': self.completed_lines,
+            'written': self.written,
+            'errorCount': self.error_count,
+            'errors': self.errors,
+        }
@@ -0,0 +1,165 @@
+'''Streaming exports of sensor data over long timespans, e.g. years of history
+for a whole site in one request rather than thousands of pages.
+
+The timespan is walked in slices, with one influx query per slice, and each
+slice is sent to the client before the next one is fetched, so the memory
+used doesn't depend on the length of the export. Slices are cut to hold
+about the same number of data points, however sparse or dense the data is:
+the hourly rollup tells where to cut raw data, and what it doesn't cover yet
+(or aggregated data) is counted with one query and cut evenly. An hour with
+more data points than a slice holds is cut evenly as well.
+
+Data points come out in time order, so an export that got cut off can be
+resumed by starting a new one at the timestamp of the last data point
+received (that data point's timestamp is included again).'''
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import datetime, timedelta
+from cStringIO import StringIO
+import csv
+import json
+import math
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# how many rows of the hourly rollup are read at a time to plan the slices
+ROLLUP_ROWS = 10000
+
+RAW_COLUMNS = ['sensor_id', 'timestamp', 'value']
+AGGREGATE_COLUMNS = ['sensor_id', 'timestamp', 'max', 'min', 'mean', 'count']
+
+
+def parse_bound(value):
+    '''Parses a bound of the exported timespan, either in unix time (like the
+    other sensor data filters) or ISO 8601 (like the exported timestamps, for
+    resuming). Returns None if it isn't either'''
+    try:
+        return datetime.utcfromtimestamp(float(value)).replace(
+            tzinfo=timezone.utc)
+    except (ValueError, OverflowError):
+        pass
+    try:
+        timestamp = parse_datetime(value)
+    except ValueError:
+        return None
+    if timestamp is not None and not timezone.is_aware(timestamp):
+        timestamp = timezone.make_aware(timestamp, timezone.utc)
+    return timestamp
+
+
+def iter_slices(start, end, slice_length):
+    while start < end:
+        slice_end = min(start + slice_length, end)
+        yield start, slice_end
+        start = slice_end
+
+
+def iter_even_slices(start, end, count, slice_points):
+    '''Cuts a timespan holding count data points into slices of the same
+    length, enough of them to hold about slice_points each'''
+    slices = max(int(math.ceil(count / float(slice_points))), 1)
+    # rounded up, so there isn't a sliver left over
+    slice_length = (end - start) / slices + timedelta(microseconds=1)
+    return iter_slices(start, end, slice_length)
+
+
+def iter_hourly_counts(influx_client, sensor_ids, start, end):
+    '''Yields how many data points the sensors have in each hour from the
+    one start is in until end, as (hour, count) tuples, from the hourly
+    rollup. Hours without data, or that haven't been rolled up yet, are
+    left out'''
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    # there's a row per sensor for each hour, so the limit can't cut off all
+    # of an hour's rows
+    limit = ROLLUP_ROWS + len(sensor_ids)
+    while True:
+        rows = influx_client.get_many_sensors_hourly_counts(
+            sensor_ids, limit, start=hour, end=end)
+        counts = []
+        for row in rows:
+            row_hour = parse_datetime(row['time'])
+            if counts and counts[-1][0] == row_hour:
+                counts[-1][1] += row['count']
+            else:
+                counts.append([row_hour, row['count']])
+        if len(rows) < limit:
+            for row_hour, count in counts:
+                yield row_hour, count
+            return
+        # the last hour's rows may have been cut off, so it's read again
+        for row_hour, count in counts[:-1]:
+            yield row_hour, count
+        hour = counts[-1][0]
+
+
+def iter_density_slices(influx_client, sensor_ids, filters, start, end,
+                        slice_points):
+    '''Yields the slices of the timespan, each holding about slice_points
+    data points at most'''
+    slice_start = start
+    if 'aggtime' not in filters:
+        total = 0
+        for hour, count in iter_hourly_counts(influx_client, sensor_ids,
+                                              start, end):
+            hour_start = max(hour, slice_start)
+            hour_end = min(hour + timedelta(hours=1), end)
+            if total and total + count > slice_points:
+                yield slice_start, hour_start
+                slice_start = hour_start
+                total = 0
+            if count > slice_points:
+                # too much for one slice, so the hour is cut evenly, and the
+                # first cut also takes the hours without data before it
+                for cut_start, cut_end in iter_even_slices(
+                        hour_start, hour_end, count, slice_points):
+                    yield slice_start, cut_end
+                    slice_start = cut_end
+            else:
+                total += count
+        if total:
+            yield slice_start, hour_end
+            slice_start = hour_end
+    if slice_start >= end:
+        return
+    count = influx_client.count_many_sensors_points(sensor_ids, filters,
+                                                    slice_start, end)
+    for time_slice in iter_even_slices(slice_start, end, count,
+                                       slice_points):
+        yield time_slice
+
+
+def format_csv(rows, columns):
+    buf = StringIO()
+    csv.writer(buf).writerows([row[column] for column in columns]
+                              for row in rows)
+    return buf.getvalue()
+
+
+def format_ndjson(rows, columns):
+    return ''.join(json.dumps(dict((column, row[column])
+                                   for column in columns)) + '\n'
+                   for row in rows)
+
+
+def iter_export(influx_client, sensor_ids, filters, start, end, slice_points,
+                format):
+    '''Yields the export in chunks of one slice each'''
+    columns = AGGREGATE_COLUMNS if 'aggtime' in filters else RAW_COLUMNS
+    formatter = format_csv if format == 'csv' else format_ndjson
+    if format == 'csv':
+        yield ','.join(columns) + '\r\n'
+    for slice_start, slice_end in iter_density_slices(
+            influx_client, sensor_ids, filters, start, end, slice_points):
+        slice_filters = dict(filters, timestamp__gte=slice_start,
+                             timestamp__lt=slice_end)
+        rows = influx_client.get_many_sensors_data_by_time(sensor_ids,
+                                                           slice_filters)
+        for row in rows:
+            row['sensor_id'] = int(row['sensor_id'])
+            row['timestamp'] = row['time']
+        if rows:
+            yield formatter(rows, columns)
@@ -0,0 +1,152 @@
+'''A log of the requests the API makes to Influx, so that when Influx gets
+slow we can tell which queries (and which API requests) are making it slow.
+
+Every request to Influx is timed. The ones that take longer than
+INFLUX_SLOW_QUERY_TIME are logged to the chain.core.influx_log logger, along
+with the API request that made them (its URL and the name of the view, e.g.
+scalar_data-list), the InfluxQL, the number of rows that came back and the
+size of the response. A random sample of the faster ones is logged as well,
+with the INFLUX_QUERY_LOG_RATE they were sampled at, so a report can tell how
+much time the fast but frequent queries add up to. Like the timing log, each
+entry is one JSON object per line.
+
+The influx_top_queries management command reads these logs and reports the
+queries that took the most time, with the numbers in them taken out so that
+the same query for different sensors counts as one.'''
+
+from django.conf import settings
+import threading
+import logging
+import random
+import json
+import re
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# the parts of a query that change from one request to the next: strings,
+# regular expressions (e.g. lists of sensor ids) and numbers
+QUERY_VALUES = re.compile(r"'(?:[^'\\]|\\.)*'|/\^?\(.*?\)\$?/|\b\d+(?:\.\d+)?\b")
+
+
+class InfluxLogMiddleware(object):
+    '''Keeps track of the API request being handled, so the requests to
+    Influx can be logged with the request that made them'''
+
+    def process_request(self, request):
+        _local.request = request
+
+    def process_response(self, request, response):
+        _local.request = None
+        # a streaming response (e.g. an export) makes its queries as it's
+        # sent, after the middleware is done with it
+        if response.streaming:
+            response.streaming_content = with_request(
+                request, response.streaming_content)
+        return response
+
+
+def with_request(request, content):
+    '''Yields the content of a streaming response, with the request it
+    answers as the one being handled while the content is made'''
+    _local.request = request
+    try:
+        for chunk in content:
+            yield chunk
+    finally:
+        _local.request = None
+
+
+def count_rows(results):
+    '''The number of rows in the series of a parsed query response, or None
+    if it isn't one'''
+    if not isinstance(results, dict):
+        return None
+    return sum(len(series.get('values', []))
+               for result in results.get('results', [])
+               for series in result.get('series', []))
+
+
+def record(endpoint, params, data, response, seconds, error=None,
+           results=None):
+    '''Logs a request to Influx if it was slow, or if it's in the sample of
+    the rest. results is the response of a query as parsed for the caller,
+    so it doesn't have to be parsed again to count its rows. Nothing else is
+    done for requests that aren't logged'''
+    slow_time = settings.INFLUX_SLOW_QUERY_TIME
+    if slow_time is not None and seconds >= slow_time:
+        entry = {'slow': True}
+    elif random.random() < settings.INFLUX_QUERY_LOG_RATE:
+        entry = {'slow': False, 'rate': settings.INFLUX_QUERY_LOG_RATE}
+    else:
+        return
+    entry['endpoint'] = endpoint
+    entry['ms'] = round(seconds * 1000, 1)
+    if endpoint == 'write':
+        entry['points'] = data.count('\n') + 1 if data else 0
+    else:
+        entry['query'] = (params or {}).get('q') or \
+            (data.get('q') if isinstance(data, dict) else None)
+    if response is not None:
+        entry['status'] = response.status_code
+        entry['bytes'] = len(response.content)
+        if endpoint == 'query':
+            entry['rows'] = count_rows(results)
+    if error is not None:
+        entry['error'] = error
+    request = getattr(_local, 'request', None)
+    if request is not None:
+        match = getattr(request, 'resolver_match', None)
+        entry['view'] = match.url_name if match else None
+        entry['method'] = request.method
+        entry['path'] = request.get_full_path()
+    logger.info(json.dumps(entry))
+
+
+def query_pattern(entry):
+    '''The query of a log entry with the values in it replaced with ?'''
+    if entry.get('endpoint') == 'write':
+        return 'write'
+    return QUERY_VALUES.sub('?', entry.get('query') or '')
+
+
+def read_entries(lines):
+    '''Yields the log entries in the given lines, skipping any other lines
+    that ended up in the same log, and the logger's prefix if it has one'''
+    for line in lines:
+        start = line.find('{')
+        if start < 0:
+            continue
+        try:
+            entry = json.loads(line[start:])
+        except ValueError:
+            continue
+        if isinstance(entry, dict) and 'endpoint' in entry and 'ms' in entry:
+            yield entry
+
+
+def top_queries(entries):
+    '''Adds up the log entries by query pattern, and returns a list of dicts
+    with the totals for each pattern, most total time first. The sampled
+    entries are weighted by their sample rate, so the counts and totals are
+    estimates of all the requests, not just the ones logged'''
+    patterns = {}
+    for entry in entries:
+        weight = 1.0 if entry.get('slow', True) else \
+            1.0 / (entry.get('rate') or 1)
+        pattern = query_pattern(entry)
+        totals = patterns.setdefault(pattern, {
+            'query': pattern, 'count': 0.0, 'slow': 0, 'ms': 0.0,
+            'max_ms': 0.0, 'rows': 0.0, 'bytes': 0.0, 'views': {},
+            'example': entry.get('query')})
+        totals['count'] += weight
+        totals['slow'] += 1 if entry.get('slow', True) else 0
+        totals['ms'] += entry['ms'] * weight
+        totals['max_ms'] = max(totals['max_ms'], entry['ms'])
+        totals['rows'] += (entry.get('rows') or entry.get('points') or 0) * \
+            weight
+        totals['bytes'] += (entry.get('bytes') or 0) * weight
+        view = entry.get('view') or 'none'
+        totals['views'][view] = totals['views'].get(view, 0) + weight
+    return sorted(patterns.values(), key=lambda totals: -totals['ms'])
@@ -0,0 +1,66 @@
+'''Queueing posted sensor data for the ingest workers (see chain/ingestd.py),
+rather than writing it to Influx while the client waits.
+
+Async ingest is turned on by listing the addresses of the workers in the
+ASYNC_INGEST_URLS setting. Each data point goes to the worker for its sensor
+(the sensor id modulo the number of workers), so a sensor's points are written
+in order and its latest value is only updated by one worker. If that worker
+isn't running or has fallen too far behind the point isn't queued, and the
+view writes it itself.'''
+
+from django.conf import settings
+from chain.core import timing
+from chain.core import metrics
+import json
+import zmq
+
+_sockets = None
+
+
+def enabled():
+    return bool(settings.ASYNC_INGEST_URLS)
+
+
+def get_sockets():
+    global _sockets
+    if _sockets is None:
+        context = zmq.Context()
+        _sockets = []
+        for url in settings.ASYNC_INGEST_URLS:
+            socket = context.socket(zmq.PUSH)
+            # only queue messages for workers that are actually connected,
+            # otherwise they pile up here while the worker is down
+            socket.setsockopt(zmq.IMMEDIATE, 1)
+            socket.setsockopt(zmq.SNDHWM, settings.ASYNC_INGEST_QUEUE_SIZE)
+            socket.connect(url)
+            _sockets.append(socket)
+    return _sockets
+
+
+def make_message(resource):
+    '''Serializes a ScalarSensorDataResource for the ingest worker, including
+    its stream message, which needs the request to build links'''
+    return json.dumps({
+        'site_id': resource.site_id,
+        'device_id': resource.device_id,
+        'sensor_id': int(resource.sensor_id),
+        'value': resource.value,
+        'timestamp': resource.timestamp.isoformat(),
+        'tags': resource.get_tags(),
+        'stream': json.dumps(resource.serialize_stream()),
+    })
+
+
+def enqueue(resource):
+    '''Queues a data point for its ingest worker. Returns False if it
+    couldn't be queued'''
+    sockets = get_sockets()
+    socket = sockets[int(resource.sensor_id) % len(sockets)]
+    message = make_message(resource)
+    try:
+        with timing.phase('zmq'):
+            socket.send(message, zmq.NOBLOCK)
+    except zmq.Again:
+        return False
+    metrics.POINTS_QUEUED.inc()
+    return True
@@ -0,0 +1,149 @@
+'''The latest value of each scalar sensor, kept up to date as data is posted so
+that reading a sensor's current value doesn't need a LAST() query in Influx.
+
+Values are stored in the Django cache chosen with the LATEST_VALUE_CACHE
+setting, memcached by default. It needs to be shared by all the worker
+processes, or a value posted through one of them won't be seen by the others.
+With LATEST_VALUE_CACHE set to None every value is looked up in Influx.
+
+Influx is only used when a sensor's value isn't in the store yet, e.g. after a
+restart. Until then we can't tell whether a posted point is newer than what's
+already in Influx, so posting doesn't store anything for those sensors.
+Sensors without any data are stored as well (as an empty entry), so they don't
+get looked up over and over again.
+
+Django's caches can't compare and set at once, so points are stored while
+holding a lock on the sensor, taken with add. Otherwise two workers storing
+points of the same sensor could both find the older value, and the older of
+their points could be written last.'''
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import calendar
+import time
+
+# stands in for the store when it's turned off, so nothing is ever found
+DUMMY_CACHE = 'django.core.cache.backends.dummy.DummyCache'
+
+# seconds a lock on a sensor's value is held for at most, in case the worker
+# holding it dies before releasing it
+LOCK_TIMEOUT = 2
+# seconds between attempts to take a lock held by another worker
+LOCK_RETRY_INTERVAL = 0.005
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = get_cache(settings.LATEST_VALUE_CACHE or DUMMY_CACHE)
+    return _backend
+
+
+def value_key(sensor_id):
+    return 'sensor-value:%s' % sensor_id
+
+
+def lock_key(sensor_id):
+    return 'sensor-value-lock:%s' % sensor_id
+
+
+def to_epoch(timestamp):
+    return calendar.timegm(timestamp.utctimetuple()) + \
+        timestamp.microsecond / 1e6
+
+
+def format_time(timestamp):
+    '''Formats a timestamp the way Influx does, e.g.
+    2015-03-04T12:00:00.25Z'''
+    timestamp = timestamp.astimezone(timezone.utc)
+    formatted = timestamp.strftime('%Y-%m-%dT%H:%M:%S')
+    if timestamp.microsecond:
+        formatted += ('.%06d' % timestamp.microsecond).rstrip('0')
+    return formatted + 'Z'
+
+
+def make_entry(value, updated):
+    '''Makes a store entry from a value and the Influx-formatted time it was
+    updated'''
+    return {'value': value, 'updated': updated,
+            'time': to_epoch(parse_datetime(updated))}
+
+
+def get_influx_client():
+    # the tests swap out the client in resources, so always use that one
+    from chain.core import resources
+    return resources.influx_client
+
+
+def get(sensor_id):
+    '''Returns the latest value of the given sensor as a dict with value and
+    updated, or an empty dict if the sensor doesn't have any data'''
+    backend = get_backend()
+    entry = backend.get(value_key(sensor_id))
+    if entry is None:
+        last_data = get_influx_client().get_last_sensor_data(sensor_id)
+        # column name returned by last() selector is last
+        entry = make_entry(last_data[0]['last'], last_data[0]['time']) \
+            if last_data else {}
+        # a value posted in the meantime wins
+        backend.add(value_key(sensor_id), entry,
+                    settings.LATEST_VALUE_TIMEOUT)
+    return entry
+
+
+def get_many(sensor_ids, site_id=None):
+    '''Returns a dict of the latest values of the given sensors, keyed by id.
+    If they're all in the given site, any that aren't in the store are looked
+    up with a single query for the whole site'''
+    backend = get_backend()
+    keys = dict((value_key(sensor_id), sensor_id) for sensor_id in sensor_ids)
+    values = dict((keys[key], entry)
+                  for key, entry in backend.get_many(keys.keys()).items())
+    missing = [sensor_id for sensor_id in sensor_ids
+               if sensor_id not in values]
+    if missing and site_id is None:
+        for sensor_id in missing:
+            values[sensor_id] = get(sensor_id)
+    elif missing:
+        last_values = {}
+        for data_point in \
+                get_influx_client().get_last_data_from_all_sensors(site_id):
+            last_values[int(data_point['sensor_id'])] = make_entry(
+                data_point['last_value'], data_point['time'])
+        for sensor_id in missing:
+            values[sensor_id] = last_values.get(sensor_id, {})
+            backend.add(value_key(sensor_id), values[sensor_id],
+                        settings.LATEST_VALUE_TIMEOUT)
+    return values
+
+
+def store(sensor_id, value, timestamp):
+    '''Records a data point that was just posted, if it's newer than the
+    sensor's latest value'''
+    backend = get_backend()
+    deadline = time.time() + LOCK_TIMEOUT * 2
+    while not backend.add(lock_key(sensor_id), True, LOCK_TIMEOUT):
+        if time.time() > deadline:
+            # the cache isn't behaving, so have the value looked up again
+            backend.delete(value_key(sensor_id))
+            return
+        time.sleep(LOCK_RETRY_INTERVAL)
+    try:
+        entry = backend.get(value_key(sensor_id))
+        epoch = to_epoch(timestamp)
+        if entry is None or entry.get('time', 0) > epoch:
+            return
+        backend.set(value_key(sensor_id),
+                    {'value': value, 'updated': format_time(timestamp),
+                     'time': epoch},
+                    settings.LATEST_VALUE_TIMEOUT)
+    finally:
+        backend.delete(lock_key(sensor_id))
+
+
+def clear():
+    get_backend().clear()
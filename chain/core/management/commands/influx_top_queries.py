@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from chain.core.influx_log import read_entries, top_queries
+from optparse import make_option
+import sys
+
+SORT_KEYS = {
+    'total': 'ms',
+    'count': 'count',
+    'max': 'max_ms',
+    'rows': 'rows',
+    'bytes': 'bytes',
+}
+
+
+class Command(BaseCommand):
+    args = '<log file> [<log file> ...]'
+    help = 'Reports the queries that took Influx the most time, from the ' \
+        'log entries of chain.core.influx_log in the given files (or stdin)'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=20,
+                    help='How many queries to report [default: 20]'),
+        make_option('--sort', default='total',
+                    help='Sort by the total time, count, max time, rows or '
+                    'bytes [default: total]'),
+    )
+
+    def handle(self, *paths, **options):
+        if options['sort'] not in SORT_KEYS:
+            raise CommandError('--sort must be one of %s' %
+                               ', '.join(sorted(SORT_KEYS)))
+        entries = []
+        for path in paths or ['-']:
+            if path == '-':
+                entries.extend(read_entries(sys.stdin))
+                continue
+            try:
+                with open(path) as f:
+                    entries.extend(read_entries(f))
+            except IOError as e:
+                raise CommandError('Can\'t read %s: %s' % (path, e))
+        if not entries:
+            self.stdout.write('No Influx log entries found')
+            return
+
+        queries = sorted(top_queries(entries),
+                         key=lambda totals: -totals[SORT_KEYS[options['sort']]])
+        self.stdout.write('%d log entries, %d slow, %d different queries' % (
+            len(entries), sum(totals['slow'] for totals in queries),
+            len(queries)))
+        self.stdout.write('%10s %8s %6s %9s %9s %9s %9s' % (
+            'total s', 'count', 'slow', 'mean ms', 'max ms', 'mean rows',
+            'mean KB'))
+        for totals in queries[:options['limit']]:
+            count = totals['count']
+            self.stdout.write('%10.1f %8.0f %6d %9.1f %9.1f %9.0f %9.1f' % (
+                totals['ms'] / 1000, count, totals['slow'],
+                totals['ms'] / count, totals['max_ms'],
+                totals['rows'] / count, totals['bytes'] / count / 1024))
+            self.stdout.write('    %s' % totals['query'])
+            views = sorted(totals['views'].items(), key=lambda item: -item[1])
+            self.stdout.write('    from %s' % ', '.join(
+                '%s (%.0f)' % (view, view_count)
+                for view, view_count in views[:5]))
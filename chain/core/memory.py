@@ -0,0 +1,204 @@
+'''Memory diagnostics for the web workers, to find out whether (and where)
+they grow, so they don't have to be recycled every few hundred requests.
+
+Once MEMORY_SNAPSHOT_INTERVAL is set, each worker takes a snapshot at the end
+of the first request after every interval: its resident memory (from /proc,
+so only on Linux), the number of objects of each type the garbage collector
+tracks, and the sizes of the caches Chain keeps in each process. Python 2
+can't tell where objects were allocated, so growth is reported by type, with
+the module that defines it: the types whose counts grew the most since the
+baseline, and since the snapshot before. The baseline is the first snapshot
+after the worker has handled MEMORY_WARMUP_REQUESTS, so filling the caches
+doesn't count as growth. Strings and numbers aren't tracked by the garbage
+collector, but the lists, dicts and objects holding them are.
+
+/debug/memory takes a snapshot of the worker that handles it and shows the
+report, to the INTERNAL_IPS only (and nginx only serves it to the machine
+itself). With MEMORY_DIAGNOSTICS_DIR set every worker also writes its latest
+report there, and the page shows the reports of all of them, otherwise just
+the one worker's.
+
+Counting the objects goes through every one of them, which takes a fraction
+of a second in a big worker, so keep the interval in minutes.'''
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from collections import deque
+import errno
+import json
+import time
+import gc
+import os
+
+# how many snapshots of each worker the RSS trend goes back
+TREND_LENGTH = 120
+# how many types are listed in each ranking of the report
+REPORT_TYPES = 25
+
+_started = time.time()
+_requests = 0
+_trend = deque(maxlen=TREND_LENGTH)
+_baseline = None
+_previous = None
+_latest = None
+
+
+def rss():
+    '''The resident memory of this process in bytes, or None where there's
+    no /proc'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def type_name(obj_type):
+    module = getattr(obj_type, '__module__', None)
+    if module in (None, '__builtin__'):
+        return obj_type.__name__
+    return '%s.%s' % (module, obj_type.__name__)
+
+
+def count_objects():
+    '''The number of objects the garbage collector tracks, by type'''
+    counts = {}
+    for obj in gc.get_objects():
+        obj_type = type(obj)
+        counts[obj_type] = counts.get(obj_type, 0) + 1
+    return dict((type_name(obj_type), count)
+                for obj_type, count in counts.items())
+
+
+def cache_sizes():
+    '''The number of entries in each of the caches kept in the process'''
+    from chain.core import api, stub_cache
+    from chain.core.sensor_map import sensor_map
+    sizes = {
+        'lazy_refs': len(api._lazy_refs),
+        'url_resource_map': len(api.url_resource_map),
+        'jinja_templates': len(api.jinja_env.cache or ()),
+        'stub_cache': sum(len(cache._by_id or ())
+                          for cache in stub_cache._caches.values()),
+        'sensor_map': len(sensor_map._device_ids or ()) +
+        len(sensor_map._site_ids or ()),
+    }
+    if settings.DEBUG:
+        from django.db import connection
+        sizes['db_queries'] = len(connection.queries)
+    return sizes
+
+
+def growth(old, new, limit=REPORT_TYPES):
+    '''The types whose counts grew the most from one snapshot to another, as
+    a list of dicts, most growth first'''
+    changes = [{'type': name, 'count': count,
+                'change': count - old['objects'].get(name, 0)}
+               for name, count in new['objects'].items()]
+    changes = [change for change in changes if change['change'] > 0]
+    changes.sort(key=lambda change: (-change['change'], change['type']))
+    return changes[:limit]
+
+
+def take_snapshot():
+    '''Takes a snapshot of this worker, and returns its report'''
+    global _baseline, _previous, _latest
+    gc.collect()
+    snapshot = {
+        'time': time.time(),
+        'requests': _requests,
+        'rss': rss(),
+        'objects': count_objects(),
+        'caches': cache_sizes(),
+    }
+    _trend.append({
+        'time': snapshot['time'],
+        'requests': snapshot['requests'],
+        'rss': snapshot['rss'],
+        'objects': sum(snapshot['objects'].values()),
+    })
+    # the baseline moves along until the worker has warmed up
+    if _baseline is None or \
+            _baseline['requests'] < settings.MEMORY_WARMUP_REQUESTS:
+        _baseline = snapshot
+    _previous = _latest or snapshot
+    _latest = snapshot
+    report = make_report()
+    if settings.MEMORY_DIAGNOSTICS_DIR:
+        save_report(report, settings.MEMORY_DIAGNOSTICS_DIR)
+    return report
+
+
+def make_report():
+    '''The report of this worker's snapshots so far'''
+    return {
+        'pid': os.getpid(),
+        'started': _started,
+        'requests': _requests,
+        'rss': _latest['rss'],
+        'objects': sum(_latest['objects'].values()),
+        'caches': _latest['caches'],
+        'baseline': {
+            'time': _baseline['time'],
+            'requests': _baseline['requests'],
+            'rss': _baseline['rss'],
+            'objects': sum(_baseline['objects'].values()),
+        },
+        'trend': list(_trend),
+        'growth': growth(_baseline, _latest),
+        'recent_growth': growth(_previous, _latest),
+    }
+
+
+def save_report(report, directory):
+    '''Writes a worker's report to <pid>.json in the directory, replacing the
+    one before all at once so readers never see half of it'''
+    path = os.path.join(directory, '%d.json' % report['pid'])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(report, f)
+    os.rename(path + '.tmp', path)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def read_reports(directory):
+    '''The reports saved in the directory, with whether the worker that
+    wrote each one is still running, sorted by pid'''
+    reports = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                report = json.load(f)
+        except (IOError, ValueError):
+            continue
+        report['running'] = is_running(report['pid'])
+        reports.append(report)
+    return sorted(reports, key=lambda report: report['pid'])
+
+
+class MemoryDiagnosticsMiddleware(object):
+    '''Counts the requests each worker handles, and takes a snapshot after
+    the first request of every MEMORY_SNAPSHOT_INTERVAL'''
+
+    def __init__(self):
+        if not settings.MEMORY_SNAPSHOT_INTERVAL:
+            raise MiddlewareNotUsed()
+
+    def process_response(self, request, response):
+        global _requests
+        _requests += 1
+        if _latest is None or time.time() - _latest['time'] >= \
+                settings.MEMORY_SNAPSHOT_INTERVAL:
+            take_snapshot()
+        return response
@@ -0,0 +1,65 @@
+'''Prometheus metrics for the API, served in the Prometheus text format at
+/metrics: requests and their latency for each view, requests to Influx and
+their errors, messages published to the streams and data points ingested.
+
+Each gunicorn worker (and ingest worker) is a separate process with its own
+metrics. To add them all up, set the prometheus_multiproc_dir environment
+variable to a directory they share, which gets cleared of the processes
+that have stopped whenever the server starts. Each process then keeps its
+metrics in memory-mapped files there, and /metrics reads all of them. The
+files of the gunicorn workers that have exited are added up into one (see
+chain/gunicorn_conf.py). Without it /metrics only has the metrics of the
+process that happens to handle the request.'''
+
+from prometheus_client import Counter, Histogram, CollectorRegistry, \
+    REGISTRY, generate_latest
+from prometheus_client import multiprocess
+import time
+import os
+
+REQUESTS = Counter('chain_requests_total', 'API requests handled',
+                   ['view', 'method', 'status'])
+REQUEST_LATENCY = Histogram('chain_request_duration_seconds',
+                            'Time taken to handle API requests', ['view'])
+INFLUX_REQUESTS = Counter('chain_influx_requests_total',
+                          'Requests made to Influx', ['endpoint'])
+INFLUX_ERRORS = Counter('chain_influx_errors_total',
+                        'Requests to Influx that failed or got an error '
+                        'status', ['endpoint'])
+INFLUX_LATENCY = Histogram('chain_influx_request_duration_seconds',
+                           'Time taken by requests to Influx', ['endpoint'])
+STREAM_MESSAGES = Counter('chain_stream_messages_published_total',
+                          'Messages published to the ZMQ streams')
+POINTS_WRITTEN = Counter('chain_points_written_total',
+                         'Sensor data points written to Influx')
+POINTS_QUEUED = Counter('chain_points_queued_total',
+                        'Sensor data points queued for the ingest workers')
+
+
+def render():
+    '''Returns the metrics in the Prometheus text format'''
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+class MetricsMiddleware(object):
+    '''Counts and times the requests to each view, by its URL name'''
+
+    def process_request(self, request):
+        request.metrics_start_time = time.time()
+
+    def process_response(self, request, response):
+        start_time = getattr(request, 'metrics_start_time', None)
+        if start_time is None:
+            return response
+        # requests that didn't match a URL all count as one view, so junk
+        # URLs can't add labels without limit
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unmatched'
+        REQUESTS.labels(view, request.method, response.status_code).inc()
+        REQUEST_LATENCY.labels(view).observe(time.time() - start_time)
+        return response
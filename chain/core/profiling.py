@@ -0,0 +1,126 @@
+'''Profiling of single requests on demand, for the slow requests that only
+reproduce against production data (e.g. the summary of a huge site).
+
+To profile a request, send it with an X-Chain-Profile header holding the
+PROFILING_KEY setting, from one of the INTERNAL_IPS. The view then runs under
+cProfile, and instead of its response you get a plain text report: the time
+spent serializing resources, in requests to Influx, parsing their results
+and rendering, followed by the functions that took the most time. The
+response cache is skipped so the view does its actual work. If PROFILING_DIR
+is set the raw stats are saved there as well, to dig into with pstats or a
+viewer like snakeviz. For example:
+
+    curl -H "X-Chain-Profile: $KEY" http://localhost/sites/1/summary
+
+Profiling is off unless PROFILING_KEY is set, in which case the middleware
+isn't loaded at all.'''
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from cStringIO import StringIO
+import cProfile
+import importlib
+import pstats
+import time
+import os
+
+# the parts of a request the report adds up the time of, as (label, module,
+# function or method in the module). Only those very functions count, not
+# others with the same name, e.g. the fields' serialize methods
+AREAS = [
+    ('Resource.serialize', 'chain.core.api', 'Resource.serialize'),
+    ('InfluxClient.request', 'chain.influx_client', 'InfluxClient.request'),
+    ('InfluxClient.get_values', 'chain.influx_client',
+     'InfluxClient.get_values'),
+    ('rendering JSON', 'chain.core.api', 'render_json'),
+    ('rendering templates', 'chain.core.api', 'render_html'),
+]
+
+# how many functions are listed in each ranking of the report
+REPORT_LINES = 40
+
+
+def client_ip(request):
+    '''The address the request came from. Behind nginx every request comes
+    from 127.0.0.1, and nginx adds the client's address to the end of
+    X-Forwarded-For'''
+    address = request.META.get('REMOTE_ADDR')
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if address in ('127.0.0.1', '::1') and forwarded:
+        address = forwarded.split(',')[-1].strip()
+    return address
+
+
+def stats_key(module_name, path):
+    '''The key of a function or method in the profiler's stats, which is its
+    file, first line and name'''
+    function = importlib.import_module(module_name)
+    for name in path.split('.'):
+        function = getattr(function, name)
+    code = getattr(function, '__func__', function).__code__
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def area_times(stats):
+    '''Returns (label, seconds, calls) for each of the AREAS, where seconds
+    includes the time spent in the functions they call'''
+    times = []
+    for label, module_name, path in AREAS:
+        # functions that weren't called aren't in the stats
+        _, calls, _, seconds, _ = stats.stats.get(
+            stats_key(module_name, path), (0, 0, 0, 0.0, {}))
+        times.append((label, seconds, calls))
+    return times
+
+
+def format_report(request, response, stats, elapsed):
+    report = StringIO()
+    report.write('%s %s\n' % (request.method, request.get_full_path()))
+    report.write('Status %d, %.1f ms in the view under the profiler\n\n' % (
+        response.status_code, elapsed * 1000))
+    for label, seconds, calls in area_times(stats):
+        report.write('%-26s %9.1f ms %7d calls\n' % (label, seconds * 1000,
+                                                     calls))
+    stats.stream = report
+    stats.strip_dirs()
+    report.write('\nBy cumulative time\n')
+    stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+    report.write('\nBy own time\n')
+    stats.sort_stats('time').print_stats(REPORT_LINES)
+    return report.getvalue()
+
+
+class ProfilingMiddleware(object):
+    '''Runs the view of a request under the profiler when it's asked for with
+    the X-Chain-Profile header. It should be the last middleware, as the
+    views of profiled requests are run here'''
+
+    def __init__(self):
+        if not settings.PROFILING_KEY:
+            raise MiddlewareNotUsed()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        key = request.META.get('HTTP_X_CHAIN_PROFILE')
+        if key is None or \
+                not constant_time_compare(key, settings.PROFILING_KEY) or \
+                client_ip(request) not in settings.INTERNAL_IPS:
+            return None
+        # the response cache would skip the work we want to see
+        request.skip_response_cache = True
+        profiler = cProfile.Profile()
+        start = time.time()
+        response = profiler.runcall(view_func, request, *view_args,
+                                    **view_kwargs)
+        elapsed = time.time() - start
+        stats = pstats.Stats(profiler)
+        if settings.PROFILING_DIR:
+            match = request.resolver_match
+            stats.dump_stats(os.path.join(
+                settings.PROFILING_DIR, '%s-%s.prof' % (
+                    time.strftime('%Y%m%d-%H%M%S'),
+                    match.url_name if match and match.url_name
+                    else 'request')))
+        return HttpResponse(format_report(request, response, stats, elapsed),
+                            content_type='text/plain')
@@ -1,20 +1,36 @@
 from chain.core.api import Resource, ResourceField, CollectionField, \
     MetadataCollectionField
-from chain.core.api import full_reverse, render_error
+from chain.core.api import full_reverse, render_error, conditional_response
+from chain.core.api import wanted
+from chain.core import site_summary
+from chain.core import latest_values
+from chain.core import ingest
+from chain.core import bulk_upload
+from chain.core import export
+from chain.core.sensor_map import sensor_map
 from chain.core.api import CHAIN_CURIES
 from chain.core.api import BadRequestException, HTTP_STATUS_BAD_REQUEST
+from chain.core.api import HTTP_STATUS_CREATED, HTTP_STATUS_ACCEPTED
+from chain.core.api import HTTP_STATUS_METHOD_NOT_ALLOWED, \
+    HTTP_STATUS_BAD_GATEWAY, HTTP_STATUS_NOT_FOUND
 from chain.core.api import register_resource
 from chain.core.models import Site, Device, ScalarSensor, \
     PresenceSensor, PresenceData, Person, Metadata
+from django.conf import settings
 from django.conf.urls import include, patterns, url
+from django.http import StreamingHttpResponse
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 from datetime import timedelta, datetime
 import calendar
+import math
+from urllib import urlencode
 from chain.localsettings import INFLUX_HOST, INFLUX_PORT, INFLUX_DATABASE, INFLUX_MEASUREMENT
 from chain.influx_client import InfluxClient
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import cache_control
 from django.utils.dateparse import parse_datetime
+from pytz import AmbiguousTimeError
 import json
 
 
@@ -43,9 +59,10 @@ class MetadataResource(Resource):
         self._total_count = qs.count()
         return self._total_count
 
-    def serialize_list(self, embed, cache):
+    def serialize_list(self, embed, cache, *args, **kwargs):
         if not embed:
-            return super(MetadataResource, self).serialize_list(embed, cache)
+            return super(MetadataResource, self).serialize_list(
+                embed, cache, *args, **kwargs)
 
         href = self.get_list_href()
 
@@ -89,12 +106,25 @@ class MetadataResource(Resource):
 
 class SensorDataResource(Resource):
 
+    # data pages can get big, so offer some compact formats for machine
+    # clients in addition to the usual ones
+    mime_types = Resource.mime_types + ['application/x-msgpack', 'text/csv']
+    # posting data invalidates cached pages, but pages without explicit
+    # timestamps cover the most recent timespan, which keeps moving
+    response_cache_timeout = 60
+
     def __init__(self, *args, **kwargs):
         super(SensorDataResource, self).__init__(*args, **kwargs)
 
     def format_time(self, timestamp):
         return calendar.timegm(timestamp.timetuple())
 
+    def format_exact_time(self, timestamp):
+        '''Like format_time, but keeps the microseconds, for bounds that fall
+        between whole seconds'''
+        return '%d.%06d' % (calendar.timegm(timestamp.utctimetuple()),
+                            timestamp.microsecond)
+
     def add_page_links(self, data, href, page_start, page_end):
         timespan = page_end - page_start
         data['_links']['previous'] = {
@@ -116,6 +146,62 @@ class SensorDataResource(Resource):
         }
         return data
 
+    def add_density_page_links(self, data, href, page_start, page_end):
+        '''The neighbouring pages of a page chosen by its number of points
+        only have the bound they share with it, so they get their other bound
+        the same way'''
+        data['_links']['previous'] = {
+            'href': self.update_href(
+                href, timestamp__gte=[],
+                timestamp__lt=self.format_exact_time(page_start)),
+            'title': 'Before %s' % page_start,
+        }
+        data['_links']['self'] = {
+            'href': self.update_href(
+                href, timestamp__gte=self.format_exact_time(page_start),
+                timestamp__lt=self.format_exact_time(page_end)),
+        }
+        data['_links']['next'] = {
+            'href': self.update_href(
+                href, timestamp__gte=self.format_exact_time(page_end),
+                timestamp__lt=[]),
+            'title': 'From %s' % page_end,
+        }
+        return data
+
+    def get_page_bounds(self):
+        '''Returns the start and end of the requested page of data. If the
+        time filters aren't given then use the most recent timespan, if they
+        are given, then we need to convert them from unix time. The filters
+        are replaced with the bounds, ready for the influx query'''
+        request_time = timezone.now()
+
+        if 'timestamp__gte' in self._filters:
+            try:
+                page_start = datetime.utcfromtimestamp(
+                    float(self._filters['timestamp__gte'])).replace(
+                        tzinfo=timezone.utc)
+            except ValueError:
+                raise BadRequestException(
+                    "Invalid timestamp format for lower bound of date range.")
+        else:
+            page_start = request_time - self.default_timespan()
+
+        if 'timestamp__lt' in self._filters:
+            try:
+                page_end = datetime.utcfromtimestamp(
+                    float(self._filters['timestamp__lt'])).replace(
+                        tzinfo=timezone.utc)
+            except ValueError:
+                raise BadRequestException(
+                    "Invalid timestamp format for upper bound of date range.")
+        else:
+            page_end = request_time
+
+        self._filters['timestamp__gte'] = page_start
+        self._filters['timestamp__lt'] = page_end
+        return page_start, page_end
+
     # shoot to return about 500 values per page
     def default_timespan(self):
         aggtime = self._filters.get('aggtime', None)
@@ -145,19 +231,23 @@ class ScalarSensorDataResource(SensorDataResource):
         if self._state == 'data':
             # deserialize data
             self.sensor_id = self._filters.get('sensor_id')
-            self.value = self.sanitize_field_value('value', self._data.get('value'))
+            try:
+                self.value = self.sanitize_field_value(
+                    'value', self._data.get('value'))
+            except (TypeError, ValueError):
+                raise BadRequestException(
+                    'Invalid value %r' % self._data.get('value'))
             self.timestamp = self.sanitize_field_value('timestamp', self._data.get('timestamp'))
             # add ids up the hierarchy
-            sensor = ScalarSensor.objects.select_related('device').get(id=self.sensor_id)
-            self.device_id = sensor.device.id
-            self.site_id = sensor.device.site_id
+            self.device_id, self.site_id = sensor_map.get(self.sensor_id)
             # treat sensor data like an object
             self._state = 'object'
         if 'queryset' in kwargs:
             # we want to default to the last page, not the first page
             pass
 
-    def serialize_single(self, embed=True, cache=None, rels=True):
+    def serialize_single(self, embed=True, cache=None, rels=True,
+                         *args, **kwargs):
         data = {}
         for field_name in self.model_fields:
             data[field_name] = self.serialize_field(getattr(self, field_name))
@@ -166,7 +256,11 @@ class ScalarSensorDataResource(SensorDataResource):
     @classmethod
     def sanitize_field_value(cls, field_name, value):
         if field_name == 'value':
-            return float(value)
+            value = float(value)
+            # Influx can't store these, and would reject the whole batch
+            if math.isnan(value) or math.isinf(value):
+                raise ValueError('Invalid value %r' % value)
+            return value
         if field_name == 'timestamp':
             from django.db import models
             if value == None:
@@ -179,9 +273,82 @@ class ScalarSensorDataResource(SensorDataResource):
 
     def save(self):
         response = influx_client.post_data(self.site_id, self.device_id, self.sensor_id, self.value, self.timestamp)
+        latest_values.store(self.sensor_id, self.value, self.timestamp)
         return response
 
-    def serialize_list(self, embed, cache):
+    @classmethod
+    def create_single(cls, data, request):
+        if not ingest.enabled():
+            return super(ScalarSensorDataResource, cls).create_single(
+                data, request)
+        return cls.create_queued([data], request, many=False)
+
+    @classmethod
+    def create_list(cls, data, request):
+        if not ingest.enabled():
+            return super(ScalarSensorDataResource, cls).create_list(
+                data, request)
+        return cls.create_queued(data, request, many=True)
+
+    @classmethod
+    def create_queued(cls, data, request, many):
+        '''Queues the given data points for the ingest workers and responds
+        with 202 Accepted. Any points that can't be queued are written
+        here instead, and if none of them could be it's a 201 Created'''
+        response_data = []
+        queued = False
+        for item in data:
+            try:
+                resource = cls(data=item, request=request,
+                               filters=request.GET.dict())
+                if ingest.enqueue(resource):
+                    queued = True
+                else:
+                    resource.save()
+                    resource.publish()
+            except IntegrityError:
+                return render_error(
+                    400, 'Error storing object. Either required fields are '
+                    'missing data or a matching object already exists',
+                    request)
+            except AmbiguousTimeError:
+                return render_error(
+                    400, 'Error storing object. Timestamp is ambiguous',
+                    request)
+            except BadRequestException as e:
+                return render_error(HTTP_STATUS_BAD_REQUEST, e.message,
+                                    request)
+            response_data.append(resource.serialize())
+        if not many:
+            response_data = response_data[0]
+        return cls.render_response(
+            response_data, request,
+            status=HTTP_STATUS_ACCEPTED if queued else HTTP_STATUS_CREATED)
+
+    @classmethod
+    def save_batch(cls, resources):
+        '''Writes the given data points to Influx with one request and
+        publishes them all at once, or queues them for the ingest workers if
+        async ingest is on. Returns whether any of them were queued'''
+        queued = False
+        unqueued = []
+        for resource in resources:
+            if ingest.enabled() and ingest.enqueue(resource):
+                queued = True
+            else:
+                unqueued.append(resource)
+        if unqueued:
+            influx_client.post_data_batch([
+                (resource.site_id, resource.device_id, resource.sensor_id,
+                 resource.value, resource.timestamp)
+                for resource in unqueued])
+            for resource in unqueued:
+                latest_values.store(resource.sensor_id, resource.value,
+                                    resource.timestamp)
+            cls.publish_list(unqueued)
+        return queued
+
+    def serialize_list(self, embed, cache, *args, **kwargs):
         '''a "list" of SensorData resources is actually represented
         as a single resource with a list of data points'''
         if not embed:
@@ -189,7 +356,9 @@ class ScalarSensorDataResource(SensorDataResource):
                 ScalarSensorDataResource,
                 self).serialize_list(
                 embed,
-                cache)
+                cache,
+                *args,
+                **kwargs)
 
         href = self.get_list_href()
 
@@ -203,46 +372,159 @@ class ScalarSensorDataResource(SensorDataResource):
             },
             'dataType': 'float'
         }
-        request_time = timezone.now()
-
-        # if the time filters aren't given then use the most recent timespan,
-        # if they are given, then we need to convert them from unix time to use
-        # in the queryset filter
-
-        if 'timestamp__gte' in self._filters:
-            try:
-                page_start = datetime.utcfromtimestamp(
-                    float(self._filters['timestamp__gte'])).replace(
-                        tzinfo=timezone.utc)
-            except ValueError:
-                raise BadRequestException(
-                    "Invalid timestamp format for lower bound of date range.")
-        else:
-            page_start = request_time - self.default_timespan()
-
-        if 'timestamp__lt' in self._filters:
-            try:
-                page_end = datetime.utcfromtimestamp(
-                    float(self._filters['timestamp__lt'])).replace(
-                        tzinfo=timezone.utc)
-            except ValueError:
-                raise BadRequestException(
-                    "Invalid timestamp format for upper bound of date range.")
+        if 'last' in self._filters:
+            objs = self.get_last_points(serialized_data, href)
+        elif 'points' in self._filters:
+            page_start, page_end = self.get_density_page_bounds()
+            objs = influx_client.get_sensor_data(self._filters)
+            serialized_data = self.add_density_page_links(
+                serialized_data, href, page_start, page_end)
         else:
-            page_end = request_time
-
-        self._filters['timestamp__gte'] = page_start
-        self._filters['timestamp__lt'] = page_end
-
-        objs = influx_client.get_sensor_data(self._filters)
-        serialized_data = self.add_page_links(serialized_data, href,
-                                              page_start, page_end)
+            page_start, page_end = self.get_page_bounds()
+            objs = influx_client.get_sensor_data(self._filters)
+            serialized_data = self.add_page_links(serialized_data, href,
+                                                  page_start, page_end)
         serialized_data['data'] = [{
             'value': obj['value'],
             'timestamp': obj['time']}
             for obj in objs]
         return serialized_data
 
+    def get_point_count(self, name):
+        if 'aggtime' in self._filters:
+            raise BadRequestException(
+                '%s is only supported for raw data, not with aggtime' % name)
+        try:
+            count = int(self._filters[name])
+        except ValueError:
+            raise BadRequestException('%s must be a whole number' % name)
+        if not 0 < count <= settings.DATA_PAGE_MAX_POINTS:
+            raise BadRequestException('%s must be between 1 and %d' % (
+                name, settings.DATA_PAGE_MAX_POINTS))
+        return count
+
+    def get_last_points(self, data, href):
+        '''Gets the newest data points (before timestamp__lt if it's given)
+        with a single query, rather than a page of the most recent timespan,
+        which could be empty or huge depending on how often the sensor
+        reports. Adds a link to the points before them'''
+        count = self.get_point_count('last')
+        self.get_page_bounds()
+        objs = influx_client.get_last_points(self._filters['sensor_id'],
+                                             count, self._filters)
+        objs.reverse()
+        data['_links']['self'] = {'href': href}
+        if len(objs) == count:
+            oldest = parse_datetime(objs[0]['time'])
+            data['_links']['previous'] = {
+                'href': self.update_href(
+                    href, timestamp__lt=self.format_exact_time(oldest)),
+                'title': 'Before %s' % oldest,
+            }
+        return objs
+
+    def get_density_page_bounds(self):
+        '''Like get_page_bounds, but if one of the bounds isn't given it's
+        chosen so the page holds about the requested number of data points.
+        The hourly rollup's counts are used to find it without reading the
+        raw data, which is only counted for the most recent hours that
+        haven't been rolled up yet'''
+        count = self.get_point_count('points')
+        has_start = 'timestamp__gte' in self._filters
+        has_end = 'timestamp__lt' in self._filters
+        page_start, page_end = self.get_page_bounds()
+        sensor_id = self._filters['sensor_id']
+        if has_start and not has_end:
+            page_end = self.find_page_end(sensor_id, page_start, count)
+        elif not has_start:
+            page_start = self.find_page_start(sensor_id, page_end, count)
+        self._filters['timestamp__gte'] = page_start
+        self._filters['timestamp__lt'] = page_end
+        return page_start, page_end
+
+    def find_page_start(self, sensor_id, page_end, count):
+        hours = influx_client.get_hourly_counts(sensor_id, count,
+                                                end=page_end, backward=True)
+        total = 0
+        rolled_up_until = None
+        if hours:
+            rolled_up_until = parse_datetime(hours[0]['time']) + \
+                timedelta(hours=1)
+        if rolled_up_until is None or rolled_up_until < page_end:
+            nth_time = influx_client.get_nth_time(
+                sensor_id, count, rolled_up_until, page_end, backward=True)
+            if nth_time is not None:
+                return parse_datetime(nth_time)
+            if hours:
+                total = influx_client.count_points(sensor_id, rolled_up_until,
+                                                   page_end)
+        for hour in hours:
+            total += hour['count']
+            if total >= count:
+                return parse_datetime(hour['time'])
+        # there aren't that many points, so start at the first one
+        first_time = influx_client.get_first_time([sensor_id], {})
+        if first_time is None:
+            return page_end - self.default_timespan()
+        return min(parse_datetime(first_time), page_end)
+
+    def find_page_end(self, sensor_id, page_start, count):
+        # the first hour's count includes any points before the page start
+        hours = influx_client.get_hourly_counts(
+            sensor_id, count,
+            start=page_start.replace(minute=0, second=0, microsecond=0))
+        total = 0
+        for hour in hours:
+            total += hour['count']
+            if total >= count:
+                return parse_datetime(hour['time']) + timedelta(hours=1)
+        rolled_up_until = page_start
+        if hours:
+            rolled_up_until = max(
+                parse_datetime(hours[-1]['time']) + timedelta(hours=1),
+                page_start)
+        nth_time = influx_client.get_nth_time(sensor_id, count - total,
+                                              start=rolled_up_until)
+        if nth_time is not None:
+            # the end is exclusive, so go just past the last point
+            return parse_datetime(nth_time) + timedelta(microseconds=1)
+        return max(timezone.now(), page_start)
+
+    @classmethod
+    @csrf_exempt
+    def bulk_view(cls, request):
+        '''Takes a CSV or line protocol body with data for any number of
+        sensors (see bulk_upload), and responds with how much of it was
+        written and the errors for any lines that weren't'''
+        if request.method != 'POST':
+            return render_error(HTTP_STATUS_METHOD_NOT_ALLOWED,
+                                'Bulk data has to be POSTed', request)
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0]
+        try:
+            upload = bulk_upload.BulkUpload(
+                influx_client,
+                format='csv' if content_type == 'text/csv' else 'line',
+                precision=request.GET.get('precision', 'ns'))
+        except ValueError as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST, str(e), request)
+        try:
+            # the body is read a line at a time rather than all at once
+            response_data = upload.run(request)
+        except IntegrityError:
+            response_data = upload.summary()
+            response_data['message'] = 'Error storing data. Lines after ' \
+                'line %d were not written' % upload.completed_lines
+            return cls.render_response(response_data, request,
+                                       status=HTTP_STATUS_BAD_GATEWAY)
+        return cls.render_response(response_data, request)
+
+    @classmethod
+    def urls(cls):
+        base_patterns = super(ScalarSensorDataResource, cls).urls()
+        base_patterns.append(
+            url(r'^bulk$', cls.bulk_view, name='scalar_data-bulk'))
+        return base_patterns
+
     def get_cache_key(self):
         return self.sensor_id, self.timestamp
 
@@ -264,11 +546,9 @@ class ScalarSensorDataResource(SensorDataResource):
         if not self.sensor_id:
             raise ValueError(
                 'Tried to called get_tags on a resource without an id')
-        db_sensor = ScalarSensor.objects.select_related('device').get(
-            id=self.sensor_id)
-        return ['sensor-%d' % db_sensor.id,
-                'device-%d' % db_sensor.device_id,
-                'site-%d' % db_sensor.device.site_id]
+        return ['sensor-%d' % int(self.sensor_id),
+                'device-%d' % self.device_id,
+                'site-%d' % self.site_id]
 
     @classmethod
     def get_field_schema_type(cls, field_name):
@@ -300,13 +580,15 @@ class AggregateScalarSensorDataResource(SensorDataResource):
             href += '{&aggtime}'
         return href
 
-    def serialize_list(self, embed, cache):
+    def serialize_list(self, embed, cache, *args, **kwargs):
         if not embed:
             return super(
                 AggregateScalarSensorDataResource,
                 self).serialize_list(
                 embed,
-                cache)
+                cache,
+                *args,
+                **kwargs)
 
         if 'aggtime' not in self._filters:
             raise BadRequestException(
@@ -320,32 +602,7 @@ class AggregateScalarSensorDataResource(SensorDataResource):
             },
             'dataType': 'float'
         }
-        request_time = timezone.now()
-
-        if 'timestamp__gte' in self._filters:
-            try:
-                page_start = datetime.utcfromtimestamp(
-                    float(self._filters['timestamp__gte'])).replace(
-                        tzinfo=timezone.utc)
-            except ValueError:
-                raise BadRequestException(
-                    "Invalid timestamp format for lower bound of date range.")
-        else:
-            page_start = request_time - self.default_timespan()
-
-        if 'timestamp__lt' in self._filters:
-            try:
-                page_end = datetime.utcfromtimestamp(
-                    float(self._filters['timestamp__lt'])).replace(
-                        tzinfo=timezone.utc)
-            except ValueError:
-                raise BadRequestException(
-                    "Invalid timestamp format for upper bound of date range.")
-        else:
-            page_end = request_time
-
-        self._filters['timestamp__gte'] = page_start
-        self._filters['timestamp__lt'] = page_end
+        page_start, page_end = self.get_page_bounds()
         objs = influx_client.get_sensor_data(self._filters)
 
         serialized_data = self.add_page_links(serialized_data, href,
@@ -369,6 +626,187 @@ class AggregateScalarSensorDataResource(SensorDataResource):
                             cls.list_view, name=base_name + '-list'))
 
 
+class MultiSensorDataResource(SensorDataResource):
+    '''The data of several scalar sensors over the same timespan, fetched with
+    a single influx query. The sensors are the ones in a device (device_id),
+    a site (site_id) or a comma-separated list of ids (sensor_id__in). The
+    timespan and aggtime work like they do for scalar_data'''
+
+    resource_name = 'multi_sensor_data'
+    resource_type = 'multi_sensor_data'
+    # the data is keyed by sensor, which doesn't fit in a CSV
+    mime_types = Resource.mime_types + ['application/x-msgpack']
+
+    @classmethod
+    def get_link(cls, request, **filters):
+        return {
+            'title': 'Sensor Data',
+            'href': full_reverse(cls.resource_name + '-list', request) +
+            '?' + urlencode(filters)
+        }
+
+    def get_sensor_ids(self):
+        if 'sensor_id__in' in self._filters:
+            try:
+                sensor_ids = [int(sensor_id) for sensor_id in
+                              self._filters['sensor_id__in'].split(',')]
+                for sensor_id in sensor_ids:
+                    sensor_map.get(sensor_id)
+            except (ValueError, ScalarSensor.DoesNotExist):
+                raise BadRequestException(
+                    'sensor_id__in has to be a list of sensor ids')
+            return sensor_ids
+        if 'sensor_id' in self._filters:
+            try:
+                sensor_map.get(self._filters['sensor_id'])
+            except (ValueError, ScalarSensor.DoesNotExist):
+                raise BadRequestException('Invalid sensor_id')
+            return [int(self._filters['sensor_id'])]
+        queryset = ScalarSensor.objects.order_by('id')
+        try:
+            if 'device_id' in self._filters:
+                queryset = queryset.filter(
+                    device_id=int(self._filters['device_id']))
+            elif 'site_id' in self._filters:
+                queryset = queryset.filter(
+                    device__site_id=int(self._filters['site_id']))
+            else:
+                raise BadRequestException(
+                    'Give a sensor_id, device_id, site_id or sensor_id__in')
+        except ValueError:
+            raise BadRequestException('Invalid device_id or site_id')
+        return list(queryset.values_list('id', flat=True))
+
+    def get_cache_tags(self):
+        if self._state == 'list' and 'sensor_id__in' in self._filters:
+            return ['sensor-%d' % sensor_id
+                    for sensor_id in self.get_sensor_ids()]
+        return super(MultiSensorDataResource, self).get_cache_tags()
+
+    def serialize_data_point(self, obj):
+        if 'aggtime' in self._filters:
+            return {
+                'max': obj['max'],
+                'min': obj['min'],
+                'mean': obj['mean'],
+                'count': obj['count'],
+                'timestamp': obj['time']}
+        return {
+            'value': obj['value'],
+            'timestamp': obj['time']}
+
+    def serialize_list(self, embed, cache, *args, **kwargs):
+        if not embed:
+            return super(
+                MultiSensorDataResource,
+                self).serialize_list(
+                embed,
+                cache,
+                *args,
+                **kwargs)
+
+        href = self.get_list_href()
+        export_href = self.get_export_href()
+        serialized_data = {
+            '_links': {
+                'curies': CHAIN_CURIES
+            },
+            'dataType': 'float'
+        }
+        sensor_ids = self.get_sensor_ids()
+        page_start, page_end = self.get_page_bounds()
+        if sensor_ids:
+            objs = influx_client.get_many_sensors_data(sensor_ids,
+                                                       self._filters)
+        else:
+            objs = {}
+
+        serialized_data = self.add_page_links(serialized_data, href,
+                                              page_start, page_end)
+        serialized_data['_links']['ch:export'] = {
+            'title': 'Export',
+            'href': self.update_href(
+                export_href, timestamp__gte=self.format_time(page_start),
+                timestamp__lt=self.format_time(page_end)),
+        }
+        serialized_data['sensors'] = dict(
+            (str(sensor_id), {
+                '_links': {
+                    'ch:sensor': {'href': full_reverse(
+                        'scalar_sensors-single', self._request,
+                        args=(sensor_id,))}
+                },
+                'data': [self.serialize_data_point(obj)
+                         for obj in objs.get(str(sensor_id), [])]
+            })
+            for sensor_id in sensor_ids)
+        return serialized_data
+
+    def get_export_href(self):
+        return full_reverse(self.resource_name + '-export', self._request) + \
+            '?' + urlencode(self._filters.items())
+
+    def get_export_bounds(self, sensor_ids):
+        '''Returns the timespan to export, which by default is all of the
+        sensors' data'''
+        if 'timestamp__gte' in self._filters:
+            start = export.parse_bound(self._filters['timestamp__gte'])
+            if start is None:
+                raise BadRequestException(
+                    "Invalid timestamp format for lower bound of date range.")
+        else:
+            first_time = influx_client.get_first_time(sensor_ids,
+                                                      self._filters)
+            start = parse_datetime(first_time) if first_time \
+                else timezone.now()
+        if 'timestamp__lt' in self._filters:
+            end = export.parse_bound(self._filters['timestamp__lt'])
+            if end is None:
+                raise BadRequestException(
+                    "Invalid timestamp format for upper bound of date range.")
+        else:
+            end = timezone.now()
+        return start, end
+
+    @classmethod
+    def export_view(cls, request):
+        '''Streams all the data of the sensors in the given timespan as CSV
+        or newline-delimited JSON (see export)'''
+        filters = request.GET.dict()
+        format = filters.pop('format', 'csv')
+        if format not in export.FORMATS:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                'format has to be one of %s' %
+                                ', '.join(sorted(export.FORMATS)), request)
+        resource = cls(is_list=True, request=request, filters=filters)
+        try:
+            # check aggtime up front, once the response starts streaming
+            # it's too late to report errors
+            influx_client.get_measurement(filters)
+            sensor_ids = resource.get_sensor_ids()
+            if sensor_ids:
+                start, end = resource.get_export_bounds(sensor_ids)
+            else:
+                start = end = timezone.now()
+        except BadRequestException as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST, e.message, request)
+        response = StreamingHttpResponse(
+            export.iter_export(influx_client, sensor_ids, filters, start, end,
+                               settings.EXPORT_SLICE_POINTS, format),
+            content_type=export.FORMATS[format])
+        response['Content-Disposition'] = \
+            'attachment; filename="sensor_data.%s"' % format
+        return response
+
+    @classmethod
+    def urls(cls):
+        base_name = cls.resource_name
+        return patterns('',
+                        url(r'^$',
+                            cls.list_view, name=base_name + '-list'),
+                        url(r'^export$',
+                            cls.export_view, name=base_name + '-export'))
+
 
 class ScalarSensorResource(Resource):
 
@@ -381,7 +819,9 @@ class ScalarSensorResource(Resource):
 
     # for now, name is hardcoded as the only attribute of metric and unit
     stub_fields = {'metric': 'name', 'unit': 'name'}
-    queryset = ScalarSensor.objects
+    # the sensors link to their devices and may have a location, so those
+    # are fetched with them
+    queryset = ScalarSensor.objects.select_related('device', 'geo_location')
 
     related_fields = {
         'ch:dataHistory': CollectionField(ScalarSensorDataResource,
@@ -405,24 +845,47 @@ class ScalarSensorResource(Resource):
         data['sensor-type'] = "scalar"
         if embed:
             data['dataType'] = 'float'
-            # this is hammering the influx server, we should switch it
-            # over to doing a single bulk query. For now disabling the
-            # data to get things up and running
-            if not kwargs.get('include_data', True):
+            # the latest value comes from the latest value store
+            if not self.includes_latest_value(**kwargs):
                 return data
             else:
-                last_data = influx_client.get_last_sensor_data(self._obj.id)
-                if last_data:
-                    # column name returned by last() selector is last
-                    data['value'] = last_data[0]['last']
-                    data['updated'] = last_data[0]['time']
+                latest = latest_values.get(self._obj.id)
+                if latest:
+                    data['value'] = latest['value']
+                    data['updated'] = latest['updated']
         return data
 
+    @classmethod
+    def includes_latest_value(cls, fields=None, include_data=True, **kwargs):
+        '''The latest value is skipped if it's turned off or the fields asked
+        for don't include it'''
+        return include_data and (fields is None or
+                                 bool(fields & set(['value', 'updated'])))
+
+    @classmethod
+    def prepare_items(cls, objs, **kwargs):
+        '''Looks up the latest values of the sensors that aren't in the store
+        yet with a query per site, rather than one per sensor'''
+        if not cls.includes_latest_value(**kwargs):
+            return
+        site_sensor_ids = {}
+        for sensor in objs:
+            site_id = sensor_map.get(sensor.id)[1]
+            site_sensor_ids.setdefault(site_id, []).append(sensor.id)
+        for site_id, sensor_ids in site_sensor_ids.items():
+            latest_values.get_many(sensor_ids, site_id)
+
+    def get_cache_tags(self):
+        # the sensor's latest value is included, so it needs to be tagged
+        # like the data streams as well
+        return ['sensor-%s' % self._obj.id]
+
     def get_tags(self):
+        device_id, site_id = sensor_map.get(self._obj.id)
         return ['sensor-%s' % self._obj.id,
                 'scalar_sensor-%s' % self._obj.id,
-                'device-%s' % self._obj.device_id,
-                'site-%s' % self._obj.device.site_id]
+                'device-%s' % device_id,
+                'site-%s' % site_id]
 
 
 class PresenceDataResource(SensorDataResource):
@@ -440,12 +903,14 @@ class PresenceDataResource(SensorDataResource):
             # we want to default to the last page, not the first page
             pass
 
-    def serialize_single(self, embed, cache):
+    def serialize_single(self, embed, cache, *args, **kwargs):
         serialized_data = super(
             PresenceDataResource,
             self).serialize_single(
             embed,
-            cache)
+            cache,
+            *args,
+            **kwargs)
         if 'person' in serialized_data:
             del serialized_data['person']
         if 'sensor' in serialized_data:
@@ -465,7 +930,7 @@ class PresenceDataResource(SensorDataResource):
                     self._obj.sensor), 'title': "%s->%s" %
                 (self._obj.sensor.device.name, self._obj.sensor.metric)}}
 
-    def serialize_list(self, embed, cache):
+    def serialize_list(self, embed, cache, *args, **kwargs):
         '''a "list" of SensorData resources is actually represented
         as a single resource with a list of data points'''
         if not embed:
@@ -473,7 +938,9 @@ class PresenceDataResource(SensorDataResource):
                 PresenceDataResource,
                 self).serialize_list(
                 embed,
-                cache)
+                cache,
+                *args,
+                **kwargs)
 
         href = self.get_list_href()
 
@@ -627,23 +1094,34 @@ class PresenceSensorResource(Resource):
         data['_links'].update(self.get_additional_links())
         return data
 
-    def get_additional_links(self):
-        links = {}
+    def get_last_visit(self):
+        '''Returns the sensor's latest presence data, or None. It's used for
+        both the links and the embedded resources, so it's only looked up
+        once'''
+        try:
+            return self._last_visit
+        except AttributeError:
+            pass
         last_data = self._obj.presence_data.order_by(
             'timestamp').reverse()[:1]
-        if last_data:
+        self._last_visit = last_data[0] if last_data else None
+        return self._last_visit
+
+    def get_additional_links(self):
+        links = {}
+        last_visit = self.get_last_visit()
+        if last_visit:
             links['last-visit'] = {
                 'href': self.get_presense_data_url(
-                    last_data[0]), 'title': "%s at %s" %
-                (last_data[0].person, last_data[0].timestamp.isoformat())}
+                    last_visit), 'title': "%s at %s" %
+                (last_visit.person, last_visit.timestamp.isoformat())}
         return links
 
     def get_additional_embedded(self):
         embedded = {}
-        last_data = self._obj.presence_data.order_by(
-            'timestamp').reverse()[:1]
-        if last_data:
-            embedded['last-visit'] = PresenceDataResource(obj=last_data[0], request=self._request)\
+        last_visit = self.get_last_visit()
+        if last_visit:
+            embedded['last-visit'] = PresenceDataResource(obj=last_visit, request=self._request)\
                 .serialize_single(False, {})
         return embedded
 
@@ -801,7 +1279,7 @@ class MixedSensorResource(Resource):
     # for now, name is hardcoded as the only attribute of metric and unit
     stub_fields = {'metric': 'name'}
 
-    queryset = ScalarSensor.objects
+    queryset = ScalarSensor.objects.select_related('device', 'geo_location')
 
     available_sensor_types = {
         'scalar': {
@@ -841,7 +1319,24 @@ class MixedSensorResource(Resource):
 
     @classmethod
     def create_list(cls, data, req):
-        raise Exception("Not yet implemented.")
+        # scalar sensors are the only type that can currently be created, so
+        # the whole list goes to ScalarSensorResource in one batch
+        errors = []
+        items = []
+        for index, item in enumerate(data):
+            if isinstance(item, dict):
+                sensor_type = item.get(u'sensor-type', 'scalar')
+                if sensor_type != 'scalar':
+                    errors.append({'index': index,
+                                   'message': 'Unrecognized sensor type.'})
+                item = dict((k, v) for k, v in item.items()
+                            if k != u'sensor-type')
+            items.append(item)
+        if errors:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                'Error storing objects. None of the given '
+                                'objects were created', req, errors=errors)
+        return ScalarSensorResource.create_list(items, req)
 
     @classmethod
     def create_single(cls, data, req):
@@ -868,11 +1363,22 @@ class MixedSensorResource(Resource):
             **kwargs)
         if embed:
             pass
-        if '_links' in data:
+        if '_links' in data and wanted('items', kwargs.get('links')):
             data['_links'].update(self.get_links())
             data['totalCount'] = len(data['_links']['items'])
         return data
 
+    def get_item_resource(self, obj):
+        return self.map_model_to_resource()[type(obj)](
+            obj=obj, request=self._request)
+
+    @classmethod
+    def prepare_items(cls, objs, **kwargs):
+        for sensor_type in cls.available_sensor_types.values():
+            sensor_type['resource'].prepare_items(
+                [obj for obj in objs if type(obj) == sensor_type['model']],
+                **kwargs)
+
     def serialize_list(self, embed, cache, *args, **kwargs):
         data = super(
             MixedSensorResource,
@@ -883,25 +1389,21 @@ class MixedSensorResource(Resource):
             **kwargs)
         if embed:
             pass
-        if '_links' in data:
+        # the item links may have been left out with the links parameter
+        if '_links' in data and 'items' in data['_links']:
             data['_links'].update(self.get_links())
             data['totalCount'] = len(data['_links']['items'])
         return data
 
     def get_links(self):
-        mapped_model_to_res = self.map_model_to_resource()
         sensors = self.query_models()
         items = []
         for sensor in sensors:
-            items.append(
-                {
-                    'href': (
-                        mapped_model_to_res[
-                            type(sensor)](
-                            obj=sensor,
-                            request=self._request)).get_single_href(),
-                    'title': "%s" %
-                    sensor})
+            # the item resources get their titles from the stub cache rather
+            # than querying each sensor's metric
+            sensor_resource = self.get_item_resource(sensor)
+            items.append({'href': sensor_resource.get_single_href(),
+                          'title': sensor_resource.get_title()})
         return {'items': items}
 
     def map_model_to_resource(self):
@@ -920,9 +1422,10 @@ class MixedSensorResource(Resource):
         return results
 
     def get_tags(self):
+        device_id, site_id = sensor_map.get(self._obj.id)
         return ['sensor-%s' % self._obj.id,
-                'device-%s' % self._obj.device_id,
-                'site-%s' % self._obj.device.site_id]
+                'device-%s' % device_id,
+                'site-%s' % site_id]
 
 
 class DeviceResource(Resource):
@@ -943,13 +1446,166 @@ class DeviceResource(Resource):
         'ch:site': ResourceField('chain.core.resources.SiteResource', 'site'),
         'ch:metadata': MetadataCollectionField(MetadataResource)
     }
-    queryset = Device.objects
+    # the devices link to their sites and may have a location, so those are
+    # fetched with them
+    queryset = Device.objects.select_related('site', 'geo_location')
 
     def get_tags(self):
         # sometimes the site_id field is unicode? weird
         return ['device-%d' % self._obj.id,
                 'site-%s' % self._obj.site_id]
 
+    def serialize_single(self, embed, cache, *args, **kwargs):
+        data = super(DeviceResource, self).serialize_single(embed, cache,
+                                                            *args, **kwargs)
+        if embed and '_links' in data:
+            links = kwargs.get('links')
+            if wanted('ch:deviceData', links):
+                data['_links']['ch:deviceData'] = {
+                    'title': 'Add Data',
+                    'href': full_reverse('device-data', self._request,
+                                         args=(self._obj.id,))
+                }
+            if wanted('ch:sensorData', links):
+                data['_links']['ch:sensorData'] = \
+                    MultiSensorDataResource.get_link(self._request,
+                                                     device_id=self._obj.id)
+        return data
+
+    @classmethod
+    def find_sensors(cls, device_id, units, request):
+        '''Returns a dict of the ids of the device's sensors for the given
+        metrics, creating any that don't exist yet with the unit given for
+        them in units (None if none was given)'''
+        by_metric = dict(ScalarSensor.objects.filter(device_id=device_id)
+                         .values_list('metric__name', 'id'))
+        new_metrics = [metric for metric in units if metric not in by_metric]
+        if not new_metrics:
+            return by_metric
+        missing_units = [metric for metric in new_metrics
+                         if not units[metric]]
+        if missing_units:
+            raise BadRequestException(
+                'A unit is needed to create the sensors for %s' %
+                ', '.join(sorted(missing_units)))
+        device = Device.objects.get(id=device_id)
+        stubs = ScalarSensorResource.find_stub_objects(
+            [{'metric': metric, 'unit': units[metric]}
+             for metric in new_metrics])
+        new_sensors = []
+        for metric in new_metrics:
+            sensor = ScalarSensor(device=device,
+                                  metric=stubs['metric'][metric],
+                                  unit=stubs['unit'][units[metric]])
+            try:
+                with transaction.atomic():
+                    sensor.save()
+                new_sensors.append(sensor)
+            except IntegrityError:
+                # another request created it in the meantime
+                sensor = ScalarSensor.objects.get(
+                    device=device, metric=stubs['metric'][metric])
+            by_metric[metric] = sensor.id
+        ScalarSensorResource.publish_list(
+            [ScalarSensorResource(obj=new_sensor, request=request)
+             for new_sensor in new_sensors],
+            ['device-%d' % device.id])
+        return by_metric
+
+    @classmethod
+    @csrf_exempt
+    def device_data_view(cls, request, id):
+        '''Takes readings of any number of the device's metrics taken at the
+        same time, e.g.
+
+            {"timestamp": "2015-03-04T12:00:00Z",
+             "data": {"temperature": {"value": 21.5, "unit": "celsius"}}}
+
+        and adds them to the sensors' data, creating any sensors the device
+        doesn't have yet'''
+        if request.method != 'POST':
+            return render_error(HTTP_STATUS_METHOD_NOT_ALLOWED,
+                                'Device data has to be POSTed', request)
+        try:
+            body = json.loads(request.body)
+        except ValueError:
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST,
+                "The create operation could not be performed because the "
+                "data provided in the request body cannot be parsed as "
+                "legal JSON.", request)
+        readings = body.get('data') if isinstance(body, dict) else None
+        if not isinstance(readings, dict) or not readings:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                'Expected a "data" object of readings keyed '
+                                'by metric', request)
+        errors = []
+        units = {}
+        for metric, reading in readings.items():
+            try:
+                ScalarSensorDataResource.sanitize_field_value(
+                    'value', reading['value'])
+                units[metric] = reading.get('unit')
+            except (KeyError, TypeError, ValueError, AttributeError):
+                errors.append({'metric': metric,
+                               'message': 'Missing or invalid value'})
+        if errors:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                'Error storing data. None of it was stored',
+                                request, errors)
+        try:
+            # all the readings get exactly the same timestamp
+            timestamp = ScalarSensorDataResource.sanitize_field_value(
+                'timestamp', body.get('timestamp')).isoformat()
+        except AmbiguousTimeError:
+            return render_error(
+                400, 'Error storing data. Timestamp is ambiguous', request)
+        except (TypeError, ValueError, AttributeError):
+            return render_error(
+                400, 'Error storing data. Timestamp is invalid', request)
+        try:
+            sensor_ids = cls.find_sensors(int(id), units, request)
+        except Device.DoesNotExist:
+            return render_error(HTTP_STATUS_NOT_FOUND, 'Resource not found',
+                                request)
+        except BadRequestException as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST, e.message, request)
+        data_resources = [
+            ScalarSensorDataResource(
+                data={'value': reading['value'], 'timestamp': timestamp},
+                request=request, filters={'sensor_id': sensor_ids[metric]})
+            for metric, reading in readings.items()]
+        try:
+            queued = ScalarSensorDataResource.save_batch(data_resources)
+        except IntegrityError:
+            return render_error(
+                400, 'Error storing data. Either required fields are '
+                'missing data or a matching object already exists',
+                request)
+        response_data = {
+            '_links': {
+                'self': {'href': full_reverse('device-data', request,
+                                              args=(id,))},
+                'ch:device': {'href': full_reverse('devices-single', request,
+                                                   args=(id,))},
+                'curies': CHAIN_CURIES,
+            },
+            'timestamp': timestamp,
+            'data': dict((metric, resource.serialize_stream())
+                         for metric, resource in zip(readings.keys(),
+                                                     data_resources)),
+        }
+        return cls.render_response(
+            response_data, request,
+            status=HTTP_STATUS_ACCEPTED if queued else HTTP_STATUS_CREATED)
+
+    @classmethod
+    def urls(cls):
+        base_patterns = super(DeviceResource, cls).urls()
+        base_patterns.append(
+            url(r'^(\d+)/data$', cls.device_data_view, name='device-data'))
+        return base_patterns
+
 
 class SiteResource(Resource):
 
@@ -967,11 +1623,12 @@ class SiteResource(Resource):
         # 'ch:people': CollectionField(PersonResource, reverse_name='site'),
         'ch:metadata': MetadataCollectionField(MetadataResource)
     }
-    queryset = Site.objects
+    queryset = Site.objects.select_related('geo_location')
 
-    def serialize_single(self, embed, cache):
-        data = super(SiteResource, self).serialize_single(embed, cache)
-        if embed:
+    def serialize_single(self, embed, cache, *args, **kwargs):
+        data = super(SiteResource, self).serialize_single(embed, cache,
+                                                          *args, **kwargs)
+        if embed and '_links' in data:
             stream = self._obj.raw_zmq_stream
             if stream:
                 data['_links']['rawZMQStream'] = {
@@ -982,6 +1639,9 @@ class SiteResource(Resource):
                 'href': full_reverse('site-summary', self._request,
                                      args=(self._obj.id,))
             }
+            data['_links']['ch:sensorData'] = \
+                MultiSensorDataResource.get_link(self._request,
+                                                 site_id=self._obj.id)
         return data
 
     def get_filled_schema(self):
@@ -1015,48 +1675,20 @@ class SiteResource(Resource):
         }
         return schema
 
-    # cache for 1hr
+    # the summary is materialized and kept current as the site changes (see
+    # site_summary), so clients should revalidate (cheaply) every time
     @classmethod
-    @cache_control(max_age=3600)
+    @cache_control(max_age=0, must_revalidate=True)
     def site_summary_view(cls, request, id):
-        #filters = request.GET.dict()
-        devices = Device.objects.filter(site_id=id).select_related(
-            'sensors',
-            'sensors__metric',
-            'sensors__unit'
-        )
         response = {
             '_links': {
                 'self': {'href': full_reverse('site-summary', request,
                                               args=(id,))},
             },
-            'devices': []
+            'devices': site_summary.render(int(id), request)
         }
-        sensor_data_list = influx_client.get_last_data_from_all_sensors(id)
-        sensor_data_dict = {}
-        for data_point in sensor_data_list:
-            sensor_data_dict[int(data_point['sensor_id'])] = (data_point['last_value'], data_point['time'])
-        for device in devices:
-            dev_resource = DeviceResource(obj=device, request=request)
-            dev_data = dev_resource.serialize(rels=False)
-            dev_data['href'] = dev_resource.get_single_href()
-            response['devices'].append(dev_data)
-            dev_data['sensors'] = []
-            for sensor in device.sensors.all():
-                sensor_resource = ScalarSensorResource(
-                    obj=sensor,
-                    request=request)
-                sensor_data = sensor_resource.serialize(rels=False, include_data=False)
-                try:
-                    sensor_data['value'] = sensor_data_dict[sensor.id][0]
-                    sensor_data['updated'] = sensor_data_dict[sensor.id][1]
-                except KeyError:
-                    # looks like we don't have any data for this sensor
-                    pass
-                sensor_data['href'] = sensor_resource.get_single_href()
-                dev_data['sensors'].append(sensor_data)
-                sensor_data['data'] = []
-        return cls.render_response(response, request)
+        return conditional_response(request,
+                                    cls.render_response(response, request))
 
     @classmethod
     def urls(cls):
@@ -1089,7 +1721,8 @@ class ApiRootResource(Resource):
     def single_view(cls, request):
         resource = cls(request=request)
         response_data = resource.serialize()
-        return cls.render_response(response_data, request)
+        return conditional_response(
+            request, cls.render_response(response_data, request))
 
 
 # URL Setup:
@@ -1115,6 +1748,7 @@ resources = [
     MetadataResource,
     ScalarSensorDataResource,
     AggregateScalarSensorDataResource,
+    MultiSensorDataResource,
     ScalarSensorResource,
     # Disable all the person/presence stuff, which isn't being used anymore
     # PresenceDataResource,
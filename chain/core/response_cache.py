@@ -0,0 +1,123 @@
+'''A server-side cache of rendered API responses.
+
+Each cached response records the stream tags (e.g. site-1, device-4) of the
+resources it was built from, and publishing to any of those tags invalidates
+it. This way the views don't need to know which responses depend on which
+objects.
+
+Rather than tracking which responses carry which tag, we store the time each
+tag was last published. A cached response is only used if none of its tags
+have been published since we started building it. If we've lost track of a
+tag (e.g. it was evicted) we can't tell whether the response is stale, so it
+isn't used either.
+
+The backend is a regular Django cache, chosen with the RESPONSE_CACHE setting.
+When running several worker processes it needs to be one they all share, like
+memcached (the default), or invalidations from one worker won't be seen by the
+others.'''
+
+from django.conf import settings
+from django.core.cache import get_cache
+import hashlib
+import time
+
+# headers that are stored along with the content of a cached response
+CACHED_HEADERS = ['ETag', 'Link', 'Vary']
+
+_backend = None
+
+
+def enabled():
+    return settings.RESPONSE_CACHE is not None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = get_cache(settings.RESPONSE_CACHE)
+    return _backend
+
+
+def tag_key(tag):
+    return 'tag:%s' % tag
+
+
+def response_key(request):
+    '''Cached responses are keyed on the full URL (the responses contain
+    absolute links, so the host matters) and the Accept header'''
+    key = u'%s %s' % (request.build_absolute_uri(),
+                      request.META.get('HTTP_ACCEPT', ''))
+    return 'response:%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def start(request):
+    '''Marks the start of building a cacheable response, so that resources
+    serialized for it can record their tags'''
+    request.response_cache_tags = set()
+    request.response_cache_started = time.time()
+
+
+def add_tags(request, tags):
+    '''Records tags for the response being built for the given request. Does
+    nothing if the response isn't going to be cached'''
+    try:
+        request.response_cache_tags.update(tags)
+    except AttributeError:
+        pass
+
+
+def lookup(request):
+    '''Returns the cached entry for the given request, or None if there isn't
+    one or it's stale'''
+    backend = get_backend()
+    entry = backend.get(response_key(request))
+    if entry is None:
+        return None
+    tag_keys = [tag_key(tag) for tag in entry['tags']]
+    published = backend.get_many(tag_keys)
+    if len(published) < len(tag_keys):
+        return None
+    if max(published.values()) > entry['started']:
+        return None
+    return entry
+
+
+def store(request, response, timeout=None):
+    '''Stores the response for the given request, tagged with all the tags
+    recorded while building it. Responses without any tags are never cached,
+    as nothing would ever invalidate them'''
+    tags = getattr(request, 'response_cache_tags', None)
+    if not tags:
+        return
+    backend = get_backend()
+    timeout = timeout or settings.RESPONSE_CACHE_TIMEOUT
+    started = request.response_cache_started
+    for tag in tags:
+        # any tag we haven't got a publish time for gets the start time of
+        # this response. That way older responses carrying the tag won't be
+        # used, but this one will be
+        backend.add(tag_key(tag), started, timeout)
+    entry = {
+        'content': response.content,
+        'content_type': response['Content-Type'],
+        'headers': dict((header, response[header])
+                        for header in CACHED_HEADERS
+                        if response.has_header(header)),
+        'tags': list(tags),
+        'started': started,
+    }
+    backend.set(response_key(request), entry, timeout)
+
+
+def invalidate(tags):
+    '''Invalidates all the cached responses carrying any of the given tags'''
+    if not enabled() or not tags:
+        return
+    now = time.time()
+    get_backend().set_many(dict((tag_key(tag), now) for tag in tags),
+                           settings.RESPONSE_CACHE_TIMEOUT)
+
+
+def clear():
+    if enabled():
+        get_backend().clear()
@@ -0,0 +1,172 @@
+'''An in-process map from scalar sensor ids to the ids of their device and
+site. Every posted data point gets tagged with these in Influx and on the
+streams, so looking them up in the database for each point adds up quickly.
+
+The map is two arrays indexed by id, sensor -> device and device -> site,
+loaded in bulk with one query each. Sensors and devices created or moved in
+this process are updated through post_save, and ones that aren't in the map
+yet (e.g. created by another process) are loaded individually.
+
+When a sensor or device is moved (or deleted) a new generation of the map is
+announced in the cache given by the SENSOR_MAP_CACHE setting, which is shared
+by the processes. Each process checks it at most every
+GENERATION_CHECK_INTERVAL seconds and reloads its map when it has changed.
+The whole map is also reloaded every SENSOR_MAP_MAX_AGE seconds, in case the
+announcement was lost (or SENSOR_MAP_CACHE is None).'''
+
+from array import array
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models.signals import post_init, post_save, post_delete
+from chain.core.models import ScalarSensor, Device
+from chain.core.latest_values import DUMMY_CACHE
+import time
+import uuid
+
+# in seconds
+GENERATION_CHECK_INTERVAL = 1
+GENERATION_KEY = 'sensor-map-generation'
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = get_cache(settings.SENSOR_MAP_CACHE or DUMMY_CACHE)
+    return _backend
+
+
+def announce_generation():
+    '''Tells the other processes that their maps are out of date'''
+    get_backend().set(GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def set_item(ids, index, value):
+    '''Sets ids[index], growing the array with zeros (no id) if necessary.
+    Ids set from request data (e.g. a site_id query parameter) can still be
+    strings when post_save is sent, so they're converted'''
+    index = int(index)
+    if index >= len(ids):
+        ids.extend([0] * (index + 1 - len(ids)))
+    ids[index] = int(value)
+
+
+class SensorMap(object):
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._device_ids = None
+        self._site_ids = None
+        self._loaded_at = None
+        self._generation = None
+        self._checked_at = None
+
+    def load(self):
+        # read first, so changes made while loading make it load again
+        generation = get_backend().get(GENERATION_KEY)
+        device_ids = array('i')
+        site_ids = array('i')
+        for sensor_id, device_id in ScalarSensor.objects.values_list(
+                'id', 'device_id').order_by('-id'):
+            set_item(device_ids, sensor_id, device_id)
+        for device_id, site_id in Device.objects.values_list(
+                'id', 'site_id').order_by('-id'):
+            set_item(site_ids, device_id, site_id)
+        self._device_ids = device_ids
+        self._site_ids = site_ids
+        self._generation = generation
+        self._loaded_at = self._checked_at = time.time()
+
+    def _lookup(self, ids, id):
+        try:
+            return ids[id]
+        except IndexError:
+            return 0
+
+    def check_age(self):
+        now = time.time()
+        if self._loaded_at is None or \
+                now - self._loaded_at > settings.SENSOR_MAP_MAX_AGE:
+            self.load()
+        elif now - self._checked_at >= GENERATION_CHECK_INTERVAL:
+            self._checked_at = now
+            if get_backend().get(GENERATION_KEY) != self._generation:
+                self.load()
+
+    def get(self, sensor_id):
+        '''Returns a (device_id, site_id) tuple for the given sensor id.
+        Raises ScalarSensor.DoesNotExist if there's no such sensor'''
+        sensor_id = int(sensor_id)
+        self.check_age()
+        device_id = self._lookup(self._device_ids, sensor_id)
+        site_id = self._lookup(self._site_ids, device_id)
+        if not device_id or not site_id:
+            device_id, site_id = ScalarSensor.objects.values_list(
+                'device_id', 'device__site_id').get(id=sensor_id)
+            set_item(self._device_ids, sensor_id, device_id)
+            set_item(self._site_ids, device_id, site_id)
+        return device_id, site_id
+
+    def get_site_id(self, device_id):
+        '''Returns the id of the given device's site. Raises
+        Device.DoesNotExist if there's no such device'''
+        device_id = int(device_id)
+        self.check_age()
+        site_id = self._lookup(self._site_ids, device_id)
+        if not site_id:
+            site_id = Device.objects.values_list(
+                'site_id', flat=True).get(id=device_id)
+            set_item(self._site_ids, device_id, site_id)
+        return site_id
+
+    def sensor_loaded(self, sender, instance, **kwargs):
+        instance._map_device_id = instance.__dict__.get('device_id')
+
+    def sensor_saved(self, sender, instance, **kwargs):
+        if self._loaded_at is not None:
+            set_item(self._device_ids, instance.id, instance.device_id)
+        if was_moved(getattr(instance, '_map_device_id', None),
+                     instance.device_id):
+            announce_generation()
+        instance._map_device_id = instance.device_id
+
+    def sensor_deleted(self, sender, instance, **kwargs):
+        if self._loaded_at is not None:
+            set_item(self._device_ids, instance.id, 0)
+        announce_generation()
+
+    def device_loaded(self, sender, instance, **kwargs):
+        instance._map_site_id = instance.__dict__.get('site_id')
+
+    def device_saved(self, sender, instance, **kwargs):
+        if self._loaded_at is not None:
+            set_item(self._site_ids, instance.id, instance.site_id)
+        if was_moved(getattr(instance, '_map_site_id', None),
+                     instance.site_id):
+            announce_generation()
+        instance._map_site_id = instance.site_id
+
+    def device_deleted(self, sender, instance, **kwargs):
+        if self._loaded_at is not None:
+            set_item(self._site_ids, instance.id, 0)
+        announce_generation()
+
+
+def was_moved(old_id, new_id):
+    '''Whether an object loaded with the first parent id was saved with the
+    second. New objects aren't in the other processes' maps, so creating one
+    isn't a move'''
+    return old_id is not None and int(old_id) != int(new_id)
+
+
+sensor_map = SensorMap()
+
+post_init.connect(sensor_map.sensor_loaded, sender=ScalarSensor)
+post_save.connect(sensor_map.sensor_saved, sender=ScalarSensor)
+post_delete.connect(sensor_map.sensor_deleted, sender=ScalarSensor)
+post_init.connect(sensor_map.device_loaded, sender=Device)
+post_save.connect(sensor_map.device_saved, sender=Device)
+post_delete.connect(sensor_map.device_deleted, sender=Device)
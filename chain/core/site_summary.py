@@ -0,0 +1,206 @@
+'''Materialized site summaries, as served by the site summary view.
+
+Each site's summary (its devices and their sensors) is built with a query for
+the devices and one for the sensors, and kept until a device or sensor in the
+site changes. The post_save and post_delete signals of devices and sensors
+just mark the site stale, and its summary gets rebuilt the next time it's
+asked for. That keeps saving cheap, even for a batch of sensors created at
+once, and needs nothing more of the cache than get and set. Devices and
+sensors remember the site or device they were loaded with, so moving one
+marks both sites stale without looking it up first. The latest values of the
+sensors come from the latest value store when it's rendered, and any that
+aren't in it yet are looked up with a single LAST() query for the whole site.
+
+Summaries are stored in the Django cache chosen with the SITE_SUMMARY_CACHE
+setting, which needs to be shared by all the worker processes. With it set to
+None the summary is built for every request.
+
+The signals are sent as the changes are made, which can be inside a
+transaction. Transactions opened with changes_in_transaction() mark the sites
+they changed stale again once they're over: if it was rolled back, the
+summaries mustn't keep the changes, and if it was committed, a summary built
+by another process while it was open won't have them. Changes made in other
+transactions can be missed until the summary times out.'''
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_init, post_save, post_delete
+from chain.core.models import Device, ScalarSensor
+from chain.core.sensor_map import sensor_map
+from chain.core import latest_values
+from contextlib import contextmanager
+import threading
+import time
+
+_backend = None
+
+_local = threading.local()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = get_cache(settings.SITE_SUMMARY_CACHE or
+                             latest_values.DUMMY_CACHE)
+    return _backend
+
+
+def summary_key(site_id):
+    return 'site-summary:%s' % site_id
+
+
+def stale_key(site_id):
+    return 'site-summary-stale:%s' % site_id
+
+
+def serialize(resource_class, obj):
+    '''Serializes an object for the summary. The href is relative, as the
+    summary is shared between requests for different hosts'''
+    data = resource_class(obj=obj).serialize(rels=False, include_data=False)
+    data['href'] = reverse(resource_class.resource_name + '-single',
+                           args=(obj.id,))
+    return data
+
+
+def serialize_device(device):
+    from chain.core.resources import DeviceResource
+    return serialize(DeviceResource, device)
+
+
+def serialize_sensor(sensor):
+    from chain.core.resources import ScalarSensorResource
+    return serialize(ScalarSensorResource, sensor)
+
+
+def build(site_id):
+    '''Builds the summary for the given site and stores it'''
+    backend = get_backend()
+    built = time.time()
+    devices = {}
+    for device in Device.objects.filter(
+            site_id=site_id).select_related('geo_location'):
+        devices[device.id] = dict(serialize_device(device), sensors={})
+    for sensor in ScalarSensor.objects.filter(
+            device__site_id=site_id).select_related('geo_location'):
+        devices[sensor.device_id]['sensors'][sensor.id] = \
+            serialize_sensor(sensor)
+    summary = {'built': built, 'devices': devices}
+    # changes made from now on will mark the summary stale
+    backend.add(stale_key(site_id), built, settings.SITE_SUMMARY_TIMEOUT)
+    backend.set(summary_key(site_id), summary, settings.SITE_SUMMARY_TIMEOUT)
+    return summary
+
+
+def get(site_id):
+    '''Returns the summary for the given site, or None if it hasn't been
+    built or is stale. If the stale marker has been lost we can't tell, so
+    the summary isn't used either'''
+    found = get_backend().get_many([summary_key(site_id), stale_key(site_id)])
+    summary = found.get(summary_key(site_id))
+    stale = found.get(stale_key(site_id))
+    if summary is None or stale is None or stale > summary['built']:
+        return None
+    return summary
+
+
+@contextmanager
+def changes_in_transaction():
+    '''Marks the sites changed in the block stale again when it's over,
+    whether it completes or raises. The transaction should be opened inside
+    the block, so that it's over by then'''
+    _local.changed = set()
+    try:
+        yield
+    finally:
+        changed, _local.changed = _local.changed, None
+        for site_id in changed:
+            mark_stale(site_id)
+
+
+def mark_stale(site_id):
+    '''Marks the site's summary stale. Inside changes_in_transaction() each
+    site is only marked once, as it's marked again at the end'''
+    changed = getattr(_local, 'changed', None)
+    if changed is not None:
+        if site_id in changed:
+            return
+        changed.add(site_id)
+    get_backend().set(stale_key(site_id), time.time(),
+                      settings.SITE_SUMMARY_TIMEOUT)
+
+
+def render(site_id, request):
+    '''Returns the list of devices in the given site's summary with their
+    sensors and latest values, building the summary if necessary'''
+    summary = get(site_id) or build(site_id)
+    devices = sorted(summary['devices'].values(),
+                     key=lambda device: device['name'])
+    values = latest_values.get_many([sensor_id for device in devices
+                                     for sensor_id in device['sensors']],
+                                    site_id)
+    rendered = []
+    for device in devices:
+        device = dict(device,
+                      href=request.build_absolute_uri(device['href']))
+        sensors = []
+        for sensor_id, sensor in sorted(device['sensors'].items()):
+            sensor = dict(sensor,
+                          href=request.build_absolute_uri(sensor['href']),
+                          data=[])
+            if 'value' in values[sensor_id]:
+                sensor['value'] = values[sensor_id]['value']
+                sensor['updated'] = values[sensor_id]['updated']
+            sensors.append(sensor)
+        device['sensors'] = sensors
+        rendered.append(device)
+    return rendered
+
+
+def clear():
+    get_backend().clear()
+
+
+# keeping the summaries up to date. post_init records the site or device an
+# object was loaded with (without touching deferred fields). Note that foreign
+# keys set from query parameters can still be strings, so ids go through
+# int()
+
+def device_loaded(sender, instance, **kwargs):
+    instance._summary_site_id = instance.__dict__.get('site_id')
+
+
+def device_changed(sender, instance, **kwargs):
+    site_ids = set([int(instance.site_id)])
+    old_site_id = getattr(instance, '_summary_site_id', None)
+    if old_site_id is not None:
+        site_ids.add(int(old_site_id))
+    for site_id in site_ids:
+        mark_stale(site_id)
+    instance._summary_site_id = instance.site_id
+
+
+def sensor_loaded(sender, instance, **kwargs):
+    instance._summary_device_id = instance.__dict__.get('device_id')
+
+
+def sensor_changed(sender, instance, **kwargs):
+    device_ids = set([int(instance.device_id)])
+    old_device_id = getattr(instance, '_summary_device_id', None)
+    if old_device_id is not None:
+        device_ids.add(int(old_device_id))
+    for device_id in device_ids:
+        try:
+            mark_stale(sensor_map.get_site_id(device_id))
+        except Device.DoesNotExist:
+            # the device is gone, and its site was marked along with it
+            pass
+    instance._summary_device_id = instance.device_id
+
+
+post_init.connect(device_loaded, sender=Device)
+post_save.connect(device_changed, sender=Device)
+post_delete.connect(device_changed, sender=Device)
+post_init.connect(sensor_loaded, sender=ScalarSensor)
+post_save.connect(sensor_changed, sender=ScalarSensor)
+post_delete.connect(sensor_changed, sender=ScalarSensor)
@@ -0,0 +1,119 @@
+'''A process-local cache of the objects that resources' stub fields point to,
+e.g. the Metric and Unit of a sensor. These tables are tiny and hardly ever
+change, but without this every sensor that gets created or serialized looks
+them up again.
+
+Each cache loads its whole table the first time it's used, and is kept up to
+date by the model's post_save and post_delete signals. Objects created in
+other processes are fetched from the database the first time they're asked
+for. Objects renamed or deleted in other processes are only noticed when this
+process restarts or the cache is cleared, which is fine for tables like these.
+'''
+
+from django.db.models.signals import post_save, post_delete
+from django.utils.encoding import smart_text
+
+
+class StubCache(object):
+
+    '''Interns the objects of one model, looked up by id or by the value of
+    one of their fields (e.g. name)'''
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self._by_id = None
+        self._by_value = None
+        post_save.connect(self._saved, sender=model, weak=False)
+        post_delete.connect(self._deleted, sender=model, weak=False)
+
+    def _warm(self):
+        if self._by_id is None:
+            self._by_id = {}
+            self._by_value = {}
+            for obj in self.model.objects.all():
+                self.add(obj)
+
+    def add(self, obj):
+        '''Adds a saved object to the cache'''
+        if self._by_id is None:
+            # it'll get loaded when we warm up
+            return
+        old_obj = self._by_id.get(obj.id)
+        if old_obj is not None:
+            self._by_value.pop(smart_text(getattr(old_obj, self.field)), None)
+        self._by_id[obj.id] = obj
+        self._by_value[smart_text(getattr(obj, self.field))] = obj
+
+    def remove(self, obj):
+        if self._by_id is None:
+            return
+        old_obj = self._by_id.pop(obj.id, None)
+        if old_obj is not None:
+            self._by_value.pop(smart_text(getattr(old_obj, self.field)), None)
+
+    def clear(self):
+        self._by_id = None
+        self._by_value = None
+
+    def get_by_id(self, id):
+        '''Returns the object with the given id. Raises DoesNotExist if there
+        isn't one, like following a foreign key would'''
+        self._warm()
+        try:
+            return self._by_id[id]
+        except KeyError:
+            obj = self.model.objects.get(id=id)
+            self.add(obj)
+            return obj
+
+    def get_by_value(self, value):
+        '''Returns the object whose field matches the given value, or None if
+        it isn't in the cache. Once warmed up the cache has the whole table,
+        so that usually means there's no such object'''
+        self._warm()
+        return self._by_value.get(smart_text(value))
+
+    def get_many_by_value(self, values):
+        '''Returns a dict of the objects matching any of the given values,
+        keyed by the values as text. Objects missing from the cache are looked
+        up with one query'''
+        self._warm()
+        found = {}
+        missing = set()
+        for value in values:
+            value = smart_text(value)
+            if value in self._by_value:
+                found[value] = self._by_value[value]
+            else:
+                missing.add(value)
+        if missing:
+            lookup = {self.field + '__in': missing}
+            for obj in self.model.objects.filter(**lookup):
+                self.add(obj)
+                found[smart_text(getattr(obj, self.field))] = obj
+        return found
+
+    def _saved(self, sender, instance, **kwargs):
+        self.add(instance)
+
+    def _deleted(self, sender, instance, **kwargs):
+        self.remove(instance)
+
+
+_caches = {}
+
+
+def get_stub_cache(model, field):
+    try:
+        return _caches[(model, field)]
+    except KeyError:
+        cache = _caches[(model, field)] = StubCache(model, field)
+        return cache
+
+
+def clear():
+    '''Empties all the stub caches, e.g. after rolling back a transaction that
+    might have created stub objects'''
+    for cache in _caches.values():
+        cache.clear()
@@ -1,12 +1,34 @@
 from django.test import TestCase
+from django.test.client import Client
 from datetime import datetime, timedelta
 import random
 import json
 import zmq
+import msgpack
 from django.utils.timezone import make_aware, utc, now
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
 from pytz import AmbiguousTimeError
 import re
 import time
+import calendar
+import csv
+import urllib
+import logging
+import tempfile
+import shutil
+import subprocess
+import threading
+import requests
+import os
+import cProfile
+import pstats
+from StringIO import StringIO
+from django.core.management import call_command
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client.multiprocess import MultiProcessCollector
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+from contextlib import contextmanager
 
 fake_zmq_socket = None
 
@@ -42,6 +64,19 @@ class FakeZMQSocket(object):
     def clear(self):
         self.sent_msgs = {}
 
+class FakeQueueSocket(object):
+
+    '''Stands in for the sockets that queue data for the ingest workers'''
+
+    def __init__(self, full=False):
+        self.full = full
+        self.queued = []
+
+    def send(self, msg, flags=0):
+        if self.full:
+            raise zmq.Again()
+        self.queued.append(json.loads(msg))
+
 # monkey patch so we can check what messages the API is sending
 # anything that imports chain.api should come after this
 zmq.Context = FakeZMQContext
@@ -49,10 +84,26 @@ zmq.Context = FakeZMQContext
 from chain.core.models import Unit, Metric, Device, ScalarSensor, Site, \
     PresenceSensor, Person, Metadata
 from chain.core.models import GeoLocation
-from chain.core.resources import DeviceResource
+from django.contrib.contenttypes.models import ContentType
+from chain.core.resources import DeviceResource, ScalarSensorResource
 from chain.core.api import HTTP_STATUS_SUCCESS, HTTP_STATUS_CREATED
 from chain.core.hal import HALDoc
 from chain.core import resources
+from chain.core import response_cache
+from chain.core import site_summary
+from chain.core import latest_values
+from chain.core import ingest
+from chain.core import influx_log
+from chain.core import memory
+from chain.core import profiling
+from chain import gunicorn_conf
+from chain import ingestd
+from django.test.utils import override_settings
+from chain.core import stub_cache
+from chain.core.sensor_map import sensor_map, SensorMap
+from chain.core import sensor_map as sensor_map_module
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from chain.localsettings import INFLUX_HOST, INFLUX_PORT, INFLUX_MEASUREMENT
 from chain.influx_client import InfluxClient
 
@@ -71,6 +122,51 @@ SITES_URL = BASE_API_URL + 'sites/'
 ACCEPT_TAIL = 'application/xhtml+xml,application/xml;q=0.9,\
         image/webp,*/*;q=0.8'
 
+# The most database queries and Influx requests a GET of each endpoint may
+# make, with all the caches cold and the response cache off. They hold for
+# collections of any size: QueryBudgetTests checks them with each of
+# BUDGET_SIZES items in the collections involved, and also fails if the
+# counts grow with the size, which means there's a query per item
+QUERY_BUDGETS = {
+    # endpoint: (url, database queries, influx requests)
+    'sites': ('/sites/', 2, 0),
+    'sites embedded': ('/sites/?embed=items', 2, 0),
+    'site': ('/sites/{site}', 1, 0),
+    'site summary': ('/sites/{site}/summary', 4, 1),
+    'devices': ('/devices/?site_id={site}', 2, 0),
+    'devices embedded': ('/devices/?site_id={site}&embed=items', 2, 0),
+    'device': ('/devices/{device}', 1, 0),
+    'sensors': ('/sensors/?device_id={device}', 4, 0),
+    'sensors embedded': ('/sensors/?device_id={device}&embed=items', 7, 1),
+    'sensor': ('/sensors/{sensor}', 3, 0),
+    'sensor data': ('/scalar_data/?sensor_id={sensor}', 0, 1),
+    'aggregate data': ('/aggregate_data/?sensor_id={sensor}&aggtime=1h', 0, 1),
+    'device sensor data': ('/multi_sensor_data/?device_id={device}', 1, 1),
+    'metadata': ('/metadata/?content_type_id={site_type}&object_id={site}',
+                 2, 0),
+}
+BUDGET_SIZES = [2, 20]
+
+# the tests clear the caches, so they get their own in this process rather
+# than the ones shared with a server running on the same machine
+LOCMEM_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+TEST_CACHE_SETTINGS = {
+    'CACHES': {
+        'default': {'BACKEND': LOCMEM_CACHE},
+        'responses': {'BACKEND': LOCMEM_CACHE, 'LOCATION': 'test-responses'},
+        'site_summaries': {'BACKEND': LOCMEM_CACHE,
+                           'LOCATION': 'test-site-summaries'},
+        'latest_values': {'BACKEND': LOCMEM_CACHE,
+                          'LOCATION': 'test-latest-values'},
+        'sensor_map': {'BACKEND': LOCMEM_CACHE,
+                       'LOCATION': 'test-sensor-map'},
+    },
+    'RESPONSE_CACHE': 'responses',
+    'SITE_SUMMARY_CACHE': 'site_summaries',
+    'LATEST_VALUE_CACHE': 'latest_values',
+    'SENSOR_MAP_CACHE': 'sensor_map',
+}
+
 
 def obj_from_filled_schema(schema):
     '''Creates an object corresponding to the default values provided with
@@ -131,9 +227,13 @@ class HalTests(TestCase):
                           doc['_links']['children'][1]['href'])
 
 
+@override_settings(**TEST_CACHE_SETTINGS)
 class ChainTestCase(TestCase):
 
     def setUp(self):
+        self.reset_caches()
+        stub_cache.clear()
+        sensor_map.clear()
         self.unit = Unit(name='C')
         self.unit.save()
         self.temp_metric = Metric(name='temperature')
@@ -224,6 +324,14 @@ class ChainTestCase(TestCase):
         for metadata in self.metadata:
             metadata.save()
 
+    def reset_caches(self):
+        # the backends are kept once they're made, which could have been
+        # with other settings
+        for cache_module in [response_cache, site_summary, latest_values]:
+            cache_module._backend = None
+            cache_module.clear()
+        sensor_map_module._backend = None
+
 
     def get_resource(self, url, mime_type='application/hal+json',
                      expect_status_code=HTTP_STATUS_SUCCESS,
@@ -257,6 +365,31 @@ class ChainTestCase(TestCase):
     def create_resource(self, url, resource):
         return self.post_resource(url, resource, HTTP_STATUS_CREATED)
 
+    @contextmanager
+    def influx_calls(self, method_name):
+        '''Records the arguments of each call to the given method of the
+        InfluxClient'''
+        calls = []
+        method = getattr(resources.influx_client, method_name)
+        setattr(resources.influx_client, method_name,
+                lambda *args: calls.append(args) or method(*args))
+        try:
+            yield calls
+        finally:
+            delattr(resources.influx_client, method_name)
+
+    @contextmanager
+    def request_costs(self):
+        '''Records the database queries and Influx requests made inside the
+        block. The dict it gives has them under 'queries' and 'influx' once
+        the block is done'''
+        costs = {}
+        with CaptureQueriesContext(connection) as queries, \
+                self.influx_calls('request') as influx:
+            yield costs
+        costs['queries'] = queries.captured_queries
+        costs['influx'] = influx
+
     def update_resource(self, url, resource):
         return self.post_resource(url, resource, HTTP_STATUS_SUCCESS)
 
@@ -382,6 +515,568 @@ class CacheTests(ChainTestCase):
         summary = self.get_resource(site.links['ch:siteSummary'].href,
                                     should_cache=True)
 
+class ConditionalGetTests(ChainTestCase):
+
+    def get_response(self, url, **headers):
+        return self.client.get(url, HTTP_ACCEPT='application/hal+json',
+                               HTTP_HOST='localhost', **headers)
+
+    def test_site_should_have_etag(self):
+        site = self.get_a_site()
+        response = self.get_response(site.links.self.href)
+        self.assertTrue(response.has_header('ETag'))
+
+    def test_matching_etag_should_return_not_modified(self):
+        site = self.get_a_site()
+        response = self.get_response(site.links.self.href)
+        response = self.get_response(site.links.self.href,
+                                     HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+    def test_edited_resource_should_not_match_old_etag(self):
+        site = self.get_a_site()
+        old_etag = self.get_response(site.links.self.href)['ETag']
+        edit_href = site.links.editForm.href
+        new_site = obj_from_filled_schema(self.get_resource(edit_href))
+        new_site['name'] = 'Some New Name'
+        self.update_resource(edit_href, new_site)
+        response = self.get_response(site.links.self.href,
+                                     HTTP_IF_NONE_MATCH=old_etag)
+        self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+        self.assertNotEqual(response['ETag'], old_etag)
+
+    def test_etag_should_depend_on_representation(self):
+        site = self.get_a_site()
+        hal_etag = self.get_response(site.links.self.href)['ETag']
+        html_etag = self.client.get(site.links.self.href,
+                                    HTTP_ACCEPT='text/html',
+                                    HTTP_HOST='localhost')['ETag']
+        self.assertNotEqual(hal_etag, html_etag)
+
+    def test_backfilled_sensor_data_should_not_look_unmodified(self):
+        sensor = self.get_a_sensor()
+        data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        # a client that fetched the page just now, before a point from a
+        # minute ago was backfilled, still has to get the point
+        self.create_resource(data.links.createForm.href, {
+            'value': 99.5,
+            'timestamp': (now() - timedelta(minutes=1)).isoformat()})
+        response = self.get_response(data.links.self.href,
+                                     HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+
+
+class ResponseCacheTests(ChainTestCase):
+
+    def test_cached_response_should_skip_database(self):
+        site = self.get_a_site()
+        # changing the database directly doesn't invalidate anything, so
+        # we should still see the cached version
+        Site.objects.filter(name=site.name).update(name='Sneaky New Name')
+        cached_site = self.get_resource(site.links.self.href)
+        self.assertEqual(cached_site.name, site.name)
+
+    def test_editing_should_invalidate_cached_response(self):
+        site = self.get_a_site()
+        edit_href = site.links.editForm.href
+        new_site = obj_from_filled_schema(self.get_resource(edit_href))
+        new_site['name'] = 'Some New Name'
+        self.update_resource(edit_href, new_site)
+        site = self.get_resource(site.links.self.href)
+        self.assertEqual(site.name, 'Some New Name')
+
+    def test_creating_should_invalidate_cached_collection(self):
+        site = self.get_a_site()
+        devices_href = site.links['ch:devices'].href
+        devices = self.get_resource(devices_href)
+        self.create_resource(devices.links.createForm.href,
+                             {'name': 'Another Thermostat'})
+        new_devices = self.get_resource(devices_href)
+        self.assertEqual(new_devices.totalCount, devices.totalCount + 1)
+
+    def test_posting_data_should_invalidate_cached_sensor(self):
+        sensor = self.get_a_sensor()
+        data_href = sensor.links['ch:dataHistory'].href
+        data = self.get_resource(data_href)
+        self.create_resource(data.links.createForm.href,
+                             {'value': 74.5, 'timestamp': now().isoformat()})
+        sensor = self.get_resource(sensor.links.self.href)
+        self.assertEqual(sensor.value, 74.5)
+        data = self.get_resource(data_href)
+        self.assertEqual(data.data[-1]['value'], 74.5)
+
+    def test_cached_response_should_answer_conditional_get(self):
+        site = self.get_a_site()
+        response = self.client.get(site.links.self.href,
+                                   HTTP_ACCEPT='application/hal+json',
+                                   HTTP_HOST='localhost')
+        response = self.client.get(site.links.self.href,
+                                   HTTP_ACCEPT='application/hal+json',
+                                   HTTP_HOST='localhost',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(RESPONSE_CACHE=None)
+class QueryBudgetTests(ChainTestCase):
+
+    def fill_collections(self, size):
+        '''Adds sites, devices, sensors and metadata, each with a location
+        where they can have one, until the collections in QUERY_BUDGETS have
+        the given number of items'''
+        def location():
+            loc = GeoLocation(latitude=42.36, longitude=-71.09)
+            loc.save()
+            return loc
+        if not hasattr(self, 'budget_site'):
+            self.budget_site = Site(name='Budget Site 0',
+                                    geo_location=location())
+            self.budget_site.save()
+        site = self.budget_site
+        while Site.objects.count() < size:
+            Site(name='Budget Site %d' % Site.objects.count(),
+                 geo_location=location()).save()
+        while site.devices.count() < size:
+            Device(name='Budget Device %d' % site.devices.count(),
+                   site=site, geo_location=location()).save()
+        device = site.devices.order_by('id')[0]
+        while device.sensors.count() < size:
+            metric = Metric(name='budget %d' % device.sensors.count())
+            metric.save()
+            sensor = ScalarSensor(device=device, metric=metric,
+                                  unit=self.unit, geo_location=location())
+            sensor.save()
+            resources.influx_client.post_data(site.id, device.id, sensor.id,
+                                              21.5, now())
+        site_type = ContentType.objects.get_for_model(Site)
+        metadata = Metadata.objects.filter(content_type=site_type,
+                                           object_id=site.id)
+        while metadata.count() < size:
+            Metadata(key='budget %d' % metadata.count(), value='1',
+                     content_object=site).save()
+        return {
+            'site': site.id,
+            'site_type': site_type.id,
+            'device': device.id,
+            'sensor': device.sensors.order_by('id')[0].id,
+        }
+
+    def get_costs(self, url):
+        '''Returns the number of database queries and Influx requests a GET
+        of the given URL makes with all the caches cold, and the queries'''
+        latest_values.clear()
+        site_summary.clear()
+        stub_cache.clear()
+        sensor_map.clear()
+        with self.request_costs() as costs:
+            self.get_resource(url)
+        return (len(costs['queries']), len(costs['influx']),
+                [query['sql'] for query in costs['queries']])
+
+    def test_endpoints_should_stay_within_their_query_budgets(self):
+        counts = dict((endpoint, []) for endpoint in QUERY_BUDGETS)
+        failures = []
+        for size in BUDGET_SIZES:
+            ids = self.fill_collections(size)
+            for endpoint, (url, queries, influx) in \
+                    sorted(QUERY_BUDGETS.items()):
+                made, requested, sql = self.get_costs(url.format(**ids))
+                counts[endpoint].append((made, requested))
+                if made > queries or requested > influx:
+                    failures.append(
+                        '%s with %d items made %d queries and %d Influx '
+                        'requests, the budget is %d and %d:\n    %s' % (
+                            endpoint, size, made, requested, queries, influx,
+                            '\n    '.join(sql)))
+        for endpoint, endpoint_counts in sorted(counts.items()):
+            first_queries, first_influx = endpoint_counts[0]
+            if any(made > first_queries or requested > first_influx
+                   for made, requested in endpoint_counts[1:]):
+                failures.append(
+                    '%s made more queries with more items: %s' % (
+                        endpoint, ', '.join(
+                            '%d items: %d queries, %d Influx requests' % (
+                                size, made, requested)
+                            for size, (made, requested) in
+                            zip(BUDGET_SIZES, endpoint_counts))))
+        if failures:
+            self.fail('\n'.join(failures))
+
+
+class ServerTimingTests(ChainTestCase):
+
+    def get_timed(self, url, **settings):
+        # the middleware is only loaded with the client's first request
+        with self.settings(**settings):
+            return Client().get(url, HTTP_HOST='localhost')
+
+    def test_responses_should_only_have_server_timing_if_enabled(self):
+        sensor = self.get_a_sensor()
+        # different timespans, so the responses aren't cached
+        href = sensor.links['ch:dataHistory'].href + \
+            '&last=3&timestamp__lt=%d' % random.randint(1, 1000000000)
+        response = self.get_timed(href)
+        self.assertNotIn('Server-Timing', response)
+        response = self.get_timed(href + '1', SERVER_TIMING=True)
+        entries = dict(entry.split(';', 1)
+                       for entry in response['Server-Timing'].split(', '))
+        self.assertIn('total', entries)
+        self.assertIn('desc="1 renders"', entries['render'])
+        self.assertIn('desc="1 requests"', entries['influx'])
+
+    def test_sampled_requests_should_be_logged(self):
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        logger = logging.getLogger('chain.core.timing')
+        logger.addHandler(handler)
+        try:
+            response = self.get_timed(BASE_API_URL, SERVER_TIMING_LOG_RATE=1)
+        finally:
+            logger.removeHandler(handler)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(len(logged), 1)
+        entry = json.loads(logged[0].getMessage())
+        self.assertEqual(entry['path'], BASE_API_URL)
+        self.assertEqual(entry['timings']['render']['count'], 1)
+
+
+class InfluxLogTests(ChainTestCase):
+
+    @contextmanager
+    def influx_log(self):
+        logged = []
+        handler = logging.Handler()
+        handler.emit = lambda record: logged.append(
+            json.loads(record.getMessage()))
+        logger = logging.getLogger('chain.core.influx_log')
+        logger.addHandler(handler)
+        try:
+            yield logged
+        finally:
+            logger.removeHandler(handler)
+
+    def test_slow_queries_should_be_logged_with_the_request(self):
+        sensor = self.get_a_sensor()
+        href = sensor.links['ch:dataHistory'].href + '&last=1'
+        with self.settings(INFLUX_SLOW_QUERY_TIME=0), \
+                self.influx_log() as logged:
+            self.get_resource(href)
+        self.assertEqual(len(logged), 1)
+        entry = logged[0]
+        self.assertTrue(entry['slow'])
+        self.assertEqual(entry['view'], 'scalar_data-list')
+        self.assertEqual(entry['path'], href[len('http://localhost'):])
+        self.assertTrue(entry['query'].startswith('SELECT * FROM'))
+        self.assertEqual(entry['rows'], 1)
+        self.assertGreater(entry['bytes'], 0)
+        self.assertIn('ms', entry)
+
+    def test_fast_queries_should_only_be_logged_when_sampled(self):
+        sensor = self.get_a_sensor()
+        href = sensor.links['ch:dataHistory'].href
+        with self.settings(INFLUX_SLOW_QUERY_TIME=60,
+                           INFLUX_QUERY_LOG_RATE=0), \
+                self.influx_log() as logged:
+            self.get_resource(href + '&last=1')
+        self.assertEqual(logged, [])
+        with self.settings(INFLUX_SLOW_QUERY_TIME=60,
+                           INFLUX_QUERY_LOG_RATE=1), \
+                self.influx_log() as logged:
+            self.get_resource(href + '&last=2')
+        self.assertEqual(len(logged), 1)
+        self.assertFalse(logged[0]['slow'])
+        self.assertEqual(logged[0]['rate'], 1)
+
+    def test_logged_queries_should_only_be_parsed_once(self):
+        sensor = self.get_a_sensor()
+        href = sensor.links['ch:dataHistory'].href + '&last=1'
+        parsed = []
+        original = requests.Response.json
+
+        def json(response, **kwargs):
+            parsed.append(response.url)
+            return original(response, **kwargs)
+        requests.Response.json = json
+        self.addCleanup(setattr, requests.Response, 'json', original)
+        with self.settings(INFLUX_SLOW_QUERY_TIME=0), \
+                self.influx_log() as logged:
+            self.get_resource(href)
+        self.assertEqual(len(logged), 1)
+        self.assertEqual(logged[0]['rows'], 1)
+        self.assertEqual(len(parsed), 1)
+
+    def test_export_queries_should_be_logged_with_the_request(self):
+        device = self.get_a_device()
+        data = self.get_resource(device.links['ch:sensorData'].href)
+        export_url = data.links['ch:export'].href.split('?')[0] + \
+            '?device_id=' + device.links.self.href.rsplit('/', 1)[1]
+        with self.settings(INFLUX_SLOW_QUERY_TIME=0), \
+                self.influx_log() as logged:
+            response = self.client.get(export_url, HTTP_HOST='localhost')
+            ''.join(response.streaming_content)
+        self.assertTrue(any(entry['query'].startswith('SELECT *')
+                            for entry in logged))
+        for entry in logged:
+            self.assertEqual(entry.get('view'), 'multi_sensor_data-export')
+
+    def test_top_queries_should_add_up_queries_that_differ_in_values(self):
+        lines = [
+            'some other line',
+            json.dumps({'slow': True, 'endpoint': 'query', 'ms': 1500.0,
+                        'query': "SELECT * FROM sensordata WHERE "
+                                 "sensor_id = '1' AND time >= 100",
+                        'rows': 10, 'bytes': 1000, 'view': 'a'}),
+            json.dumps({'slow': False, 'rate': 0.1, 'endpoint': 'query',
+                        'ms': 10.0,
+                        'query': "SELECT * FROM sensordata WHERE "
+                                 "sensor_id = '22' AND time >= 200",
+                        'rows': 1, 'bytes': 100, 'view': 'b'}),
+            json.dumps({'slow': True, 'endpoint': 'write', 'ms': 2000.0,
+                        'points': 500}),
+        ]
+        queries = influx_log.top_queries(influx_log.read_entries(lines))
+        self.assertEqual([totals['query'] for totals in queries], [
+            'write',
+            'SELECT * FROM sensordata WHERE sensor_id = ? AND time >= ?'])
+        totals = queries[1]
+        # the sampled query stands in for ten
+        self.assertEqual(totals['count'], 11)
+        self.assertEqual(totals['slow'], 1)
+        self.assertEqual(totals['ms'], 1600)
+        self.assertEqual(totals['max_ms'], 1500)
+        self.assertEqual(totals['views'], {'a': 1, 'b': 10})
+
+    def test_top_queries_command_should_report_the_log(self):
+        log = tempfile.NamedTemporaryFile()
+        log.write(json.dumps({'slow': True, 'endpoint': 'query', 'ms': 1500,
+                              'query': "SHOW DATABASES", 'rows': 1,
+                              'bytes': 100}) + '\n')
+        log.flush()
+        output = StringIO()
+        call_command('influx_top_queries', log.name, stdout=output)
+        self.assertIn('SHOW DATABASES', output.getvalue())
+        self.assertIn('1 log entries, 1 slow', output.getvalue())
+
+
+class ProfilingTests(ChainTestCase):
+
+    def get_profiled(self, url, key='secret', **extra):
+        # the middleware is only loaded with the client's first request
+        with self.settings(PROFILING_KEY='secret'):
+            return Client().get(url, HTTP_HOST='localhost',
+                                HTTP_ACCEPT='application/json',
+                                HTTP_X_CHAIN_PROFILE=key, **extra)
+
+    def test_profiled_requests_should_get_a_report(self):
+        sensor = self.get_a_sensor()
+        response = self.get_profiled(sensor.links['ch:dataHistory'].href)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertIn('Status 200', response.content)
+        for area in ['Resource.serialize', 'InfluxClient.request',
+                     'rendering JSON', 'By cumulative time']:
+            self.assertIn(area, response.content)
+
+    def test_areas_should_only_count_their_own_functions(self):
+        profile = cProfile.Profile()
+        profile.runcall(int)
+        stats = pstats.Stats(profile)
+        # the fields' serialize methods are in the same file, and are called
+        # by Resource.serialize, so counting them would count time twice
+        stats.stats = {
+            profiling.stats_key('chain.core.api', 'Resource.serialize'):
+            (2, 2, 0.1, 0.5, {}),
+            profiling.stats_key('chain.core.api', 'CollectionField.serialize'):
+            (4, 4, 0.1, 0.2, {}),
+            profiling.stats_key('chain.core.api', 'render_json'):
+            (1, 1, 0.1, 0.1, {}),
+        }
+        times = dict((label, (seconds, calls)) for label, seconds, calls in
+                     profiling.area_times(stats))
+        self.assertEqual(times['Resource.serialize'], (0.5, 2))
+        self.assertEqual(times['rendering JSON'], (0.1, 1))
+        self.assertEqual(times['InfluxClient.request'], (0.0, 0))
+
+    def test_profiled_requests_should_skip_the_response_cache(self):
+        self.get_resource(SITES_URL)
+        response = self.get_profiled(SITES_URL)
+        self.assertIn('Resource.serialize', response.content)
+        self.assertNotRegexpMatches(response.content,
+                                    r'Resource.serialize +0.0 ms +0 calls')
+
+    def test_stats_should_be_saved_if_asked_for(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(PROFILING_DIR=directory):
+                self.get_profiled(SITES_URL)
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].endswith('-sites-list.prof'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_requests_should_only_be_profiled_when_allowed(self):
+        response = self.get_profiled(SITES_URL, key='wrong')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        response = self.get_profiled(SITES_URL, REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        # behind nginx the client's address is in X-Forwarded-For
+        response = self.get_profiled(SITES_URL,
+                                     HTTP_X_FORWARDED_FOR='10.1.2.3')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        with self.settings(PROFILING_KEY=None):
+            response = Client().get(SITES_URL, HTTP_HOST='localhost',
+                                    HTTP_ACCEPT='application/json',
+                                    HTTP_X_CHAIN_PROFILE='None')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+
+class Leaked(object):
+    pass
+
+
+class MemoryTests(ChainTestCase):
+
+    def get_reports(self, **extra):
+        response = self.client.get('/debug/memory', HTTP_HOST='localhost',
+                                   **extra)
+        self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+        return json.loads(response.content)['workers']
+
+    def test_memory_report_should_show_this_worker(self):
+        reports = self.get_reports()
+        self.assertEqual(len(reports), 1)
+        report = reports[0]
+        self.assertEqual(report['pid'], os.getpid())
+        self.assertTrue(report['running'])
+        self.assertGreater(report['rss'], 0)
+        self.assertGreater(report['objects'], 0)
+        self.assertEqual(report['trend'][-1]['rss'], report['rss'])
+        self.assertIn('lazy_refs', report['caches'])
+
+    def test_objects_made_between_snapshots_should_show_as_growth(self):
+        memory.take_snapshot()
+        leaked = [Leaked() for _ in range(5000)]
+        report = memory.take_snapshot()
+        growth = dict((change['type'], change['change'])
+                      for change in report['recent_growth'])
+        self.assertGreaterEqual(growth['chain.core.tests.Leaked'],
+                                len(leaked))
+
+    def test_requests_should_be_snapshotted_once_per_interval(self):
+        with self.settings(MEMORY_SNAPSHOT_INTERVAL=3600):
+            client = Client()
+            memory.take_snapshot()
+            requests = memory._requests
+            trend = len(memory._trend)
+            for _ in range(3):
+                client.get(BASE_API_URL, HTTP_HOST='localhost')
+        self.assertEqual(memory._requests, requests + 3)
+        self.assertEqual(len(memory._trend), trend)
+
+    def test_reports_of_all_workers_should_be_shown(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # a worker that has since exited
+            with open(os.path.join(directory, '999999.json'), 'w') as f:
+                json.dump({'pid': 999999}, f)
+            with self.settings(MEMORY_DIAGNOSTICS_DIR=directory):
+                reports = self.get_reports()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([(report['pid'], report['running'])
+                          for report in reports],
+                         [(os.getpid(), True), (999999, False)])
+
+    def test_memory_report_should_only_be_shown_to_internal_ips(self):
+        response = self.client.get('/debug/memory', HTTP_HOST='localhost',
+                                   HTTP_X_FORWARDED_FOR='10.1.2.3')
+        self.assertEqual(response.status_code, 403)
+
+
+class MetricsTests(ChainTestCase):
+
+    def get_count(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_should_be_counted_by_view(self):
+        labels = {'view': 'api-root', 'method': 'GET', 'status': '200'}
+        count = self.get_count('chain_requests_total', **labels)
+        self.get_resource(BASE_API_URL)
+        self.assertEqual(self.get_count('chain_requests_total', **labels),
+                         count + 1)
+        response = self.client.get('/metrics', HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+        self.assertIn('chain_requests_total{', response.content)
+        self.assertIn('chain_request_duration_seconds_bucket{',
+                      response.content)
+
+    def test_posting_data_should_count_influx_writes_and_messages(self):
+        sensor = self.get_a_sensor()
+        data_url = self.get_resource(
+            sensor.links['ch:dataHistory'].href).links.createForm.href
+        writes = self.get_count('chain_influx_requests_total',
+                                endpoint='write')
+        points = self.get_count('chain_points_written_total')
+        messages = self.get_count('chain_stream_messages_published_total')
+        self.create_resource(data_url, {'value': 25})
+        self.assertEqual(self.get_count('chain_influx_requests_total',
+                                        endpoint='write'), writes + 1)
+        self.assertEqual(self.get_count('chain_points_written_total'),
+                         points + 1)
+        self.assertGreater(
+            self.get_count('chain_stream_messages_published_total'),
+            messages)
+
+
+    def test_exited_workers_metrics_should_be_added_up_in_one_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for pid, count in [(101, 3), (102, 2)]:
+            for metric_type, values in [
+                    ('counter', [('chain_requests', 'chain_requests_total',
+                                  {'view': 'x'}, count)]),
+                    ('histogram', [('chain_latency', 'chain_latency_bucket',
+                                    {'view': 'x', 'le': '0.1'}, count),
+                                   ('chain_latency', 'chain_latency_sum',
+                                    {'view': 'x'}, 0.01 * count)]),
+                    ('gauge_livesum', [('chain_open', 'chain_open', {}, 1)])]:
+                values_file = MmapedDict(os.path.join(
+                    directory, '%s_%d.db' % (metric_type, pid)))
+                for metric_name, name, labels, value in values:
+                    values_file.write_value(
+                        mmap_key(metric_name, name, labels.keys(),
+                                 labels.values()), value)
+                values_file.close()
+        gunicorn_conf.add_to_exited(directory, 101)
+        gunicorn_conf.add_to_exited(directory, 102)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['counter_exited.db', 'histogram_exited.db'])
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, path=directory)
+        self.assertEqual(registry.get_sample_value(
+            'chain_requests_total', {'view': 'x'}), 5)
+        self.assertEqual(registry.get_sample_value(
+            'chain_latency_bucket', {'view': 'x', 'le': '0.1'}), 5)
+        self.assertAlmostEqual(registry.get_sample_value(
+            'chain_latency_sum', {'view': 'x'}), 0.05)
+
+    def test_starting_should_only_remove_stopped_processes_metrics(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        stopped = subprocess.Popen(['true'])
+        stopped.wait()
+        names = ['counter_%d.db' % os.getpid(),
+                 'gauge_livesum_%d.db' % os.getpid(),
+                 'counter_%d.db' % stopped.pid,
+                 'counter_exited.db']
+        for name in names:
+            open(os.path.join(directory, name), 'w').close()
+        gunicorn_conf.remove_stopped(directory)
+        self.assertEqual(sorted(os.listdir(directory)), sorted(names[:2]))
+
 class DefaultMIMETests(ChainTestCase):
 
     def test_root_should_supply_json_if_no_accept_header(self):
@@ -709,6 +1404,84 @@ class ApiSitesTests(ChainTestCase):
         self.assertIn('href', summary_dev)
         self.assertIn('href', summary_dev['sensors'][0])
 
+    def test_site_summary_should_not_be_rebuilt_for_each_request(self):
+        site = self.get_a_site()
+        self.get_resource(site.links['ch:siteSummary'].href)
+        with self.assertNumQueries(0):
+            self.get_resource(site.links['ch:siteSummary'].href)
+
+    def test_site_summary_should_follow_device_and_sensor_changes(self):
+        site = self.get_a_site()
+        summary_url = site.links['ch:siteSummary'].href
+        self.get_resource(summary_url)
+        devices = self.get_resource(site.links['ch:devices'].href)
+        device = self.create_resource(devices.links.createForm.href,
+                                      {'name': 'Summary Test Device'})
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        sensor = self.create_resource(sensors.links.createForm.href,
+                                      {'metric': 'humidity', 'unit': 'C'})
+        edit_href = device.links.editForm.href
+        new_device = obj_from_filled_schema(self.get_resource(edit_href))
+        new_device['name'] = 'Renamed Summary Device'
+        self.update_resource(edit_href, new_device)
+        # rebuilt with a query for the devices and one for the sensors
+        with self.assertNumQueries(2):
+            summary = self.get_resource(summary_url)
+        summary_dev = [dev for dev in summary.devices
+                       if dev['href'] == device.links.self.href][0]
+        self.assertEqual(summary_dev['name'], 'Renamed Summary Device')
+        self.assertEqual([s['href'] for s in summary_dev['sensors']],
+                         [sensor.links.self.href])
+
+    def test_site_summaries_should_follow_devices_moving_sites(self):
+        summary_urls = [site.links['ch:siteSummary'].href
+                        for site in [self.get_resource(item.href) for item in
+                                     self.get_sites().links['items']]]
+        for summary_url in summary_urls:
+            self.get_resource(summary_url)
+        device = Device.objects.get(id=self.devices[0].id)
+        device.site = self.sites[1]
+        device.save()
+        for site, summary_url in zip(self.sites, summary_urls):
+            summary = self.get_resource(summary_url)
+            self.assertEqual(
+                device.name in [dev['name'] for dev in summary.devices],
+                site == self.sites[1])
+
+    def test_site_summary_should_have_posted_data(self):
+        site = self.get_a_site()
+        summary_url = site.links['ch:siteSummary'].href
+        sensor = self.get_a_sensor()
+        self.get_resource(summary_url)
+        data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        timestamp = now().replace(microsecond=250000)
+        self.create_resource(data.links.createForm.href, {
+            'value': 42, 'timestamp': timestamp.isoformat()})
+        summary = self.get_resource(summary_url)
+        summary_sensor = [s for dev in summary.devices
+                          for s in dev['sensors']
+                          if s['href'] == sensor.links.self.href][0]
+        self.assertEqual(summary_sensor['value'], 42)
+        self.assertEqual(summary_sensor['updated'],
+                         timestamp.astimezone(utc).strftime(
+                             '%Y-%m-%dT%H:%M:%S.25Z'))
+
+    @override_settings(SITE_SUMMARY_CACHE=None, LATEST_VALUE_CACHE=None)
+    def test_site_summary_should_work_with_its_caches_off(self):
+        self.reset_caches()
+        site = self.get_a_site()
+        summary_url = site.links['ch:siteSummary'].href
+        sensor = self.get_a_sensor()
+        self.get_resource(summary_url)
+        data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        self.create_resource(data.links.createForm.href, {
+            'value': 43, 'timestamp': now().isoformat()})
+        summary = self.get_resource(summary_url)
+        summary_sensor = [s for dev in summary.devices
+                          for s in dev['sensors']
+                          if s['href'] == sensor.links.self.href][0]
+        self.assertEqual(summary_sensor['value'], 43)
+
 
 class ApiDeviceTests(ChainTestCase):
 
@@ -758,6 +1531,96 @@ class ApiDeviceTests(ChainTestCase):
         db_site = Site.objects.get(name=site['name'])
         self.assertEqual(db_device.site, db_site)
 
+    def test_posted_device_should_be_added_to_a_loaded_sensor_map(self):
+        site = self.get_a_site()
+        sensor_map.load()
+        devices = self.get_resource(site.links['ch:devices'].href)
+        self.create_resource(devices.links.createForm.href,
+                             {'name': 'Mapped Thermostat'})
+        db_device = Device.objects.get(name='Mapped Thermostat')
+        db_sensor = ScalarSensor.objects.create(
+            device=db_device, metric=self.temp_metric, unit=self.unit)
+        self.assertEqual((db_device.id, db_device.site_id),
+                         sensor_map.get(db_sensor.id))
+
+    def test_sensor_maps_should_follow_devices_moved_elsewhere(self):
+        self.addCleanup(setattr, sensor_map_module,
+                        'GENERATION_CHECK_INTERVAL',
+                        sensor_map_module.GENERATION_CHECK_INTERVAL)
+        sensor_map_module.GENERATION_CHECK_INTERVAL = 0
+        # it isn't told about saves, like another process's map
+        other_map = SensorMap()
+        sensor = ScalarSensor.objects.all()[0]
+        device = sensor.device
+        self.assertEqual(device.site_id, other_map.get(sensor.id)[1])
+        device.site = Site.objects.exclude(id=device.site_id)[0]
+        device.save()
+        self.assertEqual(device.site_id, other_map.get(sensor.id)[1])
+
+    def test_lists_of_devices_should_be_postable(self):
+        site = self.get_a_site()
+        devices = self.get_resource(site.links['ch:devices'].href)
+        new_devices = [{
+            'name': 'Bulk Thermostat %d' % i,
+            'geoLocation': {'latitude': 42.36, 'longitude': -71.09},
+        } for i in range(10)]
+        response = self.create_resource(devices.links.createForm.href,
+                                        new_devices)
+        self.assertEqual(10, len(response))
+        db_devices = Device.objects.filter(name__startswith='Bulk Thermostat')
+        self.assertEqual(10, db_devices.count())
+        for db_device in db_devices:
+            self.assertEqual(site.name, db_device.site.name)
+            self.assertEqual(42.36, db_device.geo_location.latitude)
+
+    def test_bad_device_in_list_should_not_create_any(self):
+        site = self.get_a_site()
+        devices = self.get_resource(site.links['ch:devices'].href)
+        new_devices = [{'name': 'Bulk Thermostat 1'},
+                       {'description': 'No name'},
+                       {'name': 'Bulk Thermostat 1'}]
+        response = self.client.post(devices.links.createForm.href,
+                                    json.dumps(new_devices),
+                                    content_type='application/hal+json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        errors = json.loads(response.content)['errors']
+        self.assertEqual([1], [error['index'] for error in errors])
+        self.assertFalse(Device.objects.filter(
+            name__startswith='Bulk Thermostat').exists())
+
+    def test_duplicate_devices_in_list_should_be_reported(self):
+        site = self.get_a_site()
+        devices = self.get_resource(site.links['ch:devices'].href)
+        new_devices = [{'name': 'Bulk Thermostat 1'},
+                       {'name': 'Bulk Thermostat 1'}]
+        response = self.client.post(devices.links.createForm.href,
+                                    json.dumps(new_devices),
+                                    content_type='application/hal+json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        errors = json.loads(response.content)['errors']
+        self.assertEqual([1], [error['index'] for error in errors])
+        self.assertFalse(Device.objects.filter(
+            name__startswith='Bulk Thermostat').exists())
+
+    def test_devices_rolled_back_should_not_be_in_the_site_summary(self):
+        site = self.get_a_site()
+        summary_url = site.links['ch:siteSummary'].href
+        self.get_resource(summary_url)
+        devices = self.get_resource(site.links['ch:devices'].href)
+        # the first one gets saved before the duplicate fails
+        new_devices = [{'name': 'Bulk Thermostat 1'},
+                       {'name': 'Bulk Thermostat 1'}]
+        response = self.client.post(devices.links.createForm.href,
+                                    json.dumps(new_devices),
+                                    content_type='application/hal+json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        summary = self.get_resource(summary_url)
+        self.assertNotIn('Bulk Thermostat 1',
+                         [device['name'] for device in summary.devices])
+
     def test_device_create_form_should_return_schema(self):
         devices = self.get_devices()
         device_schema = self.get_resource(devices.links.createForm.href)
@@ -837,6 +1700,128 @@ class ApiScalarSensorTests(ChainTestCase):
                                              device__name=device.name)
         self.assertEqual('Smoots', db_sensor.unit.name)
 
+    def test_lists_of_sensors_should_be_postable(self):
+        device = self.get_a_device()
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        new_sensors = [{'sensor-type': 'scalar',
+                        'metric': 'Bulk Metric %d' % i,
+                        'unit': 'Smoots'} for i in range(20)]
+        response = self.create_resource(sensors.links['createForm'].href,
+                                        new_sensors)
+        self.assertEqual(20, len(response))
+        self.assertEqual('Bulk Metric 0', response[0].metric)
+        db_sensors = ScalarSensor.objects.filter(
+            metric__name__startswith='Bulk Metric', device__name=device.name)
+        self.assertEqual(20, db_sensors.count())
+        self.assertEqual(1, Unit.objects.filter(name='Smoots').count())
+
+    def test_sensors_should_be_postable_when_their_metric_just_appeared(self):
+        device = self.get_a_device()
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        # another request creates the metric after this one looked for it
+        metrics = ScalarSensorResource.get_stub_cache('metric')
+        metrics.get_many_by_value = lambda values: {}
+        self.addCleanup(delattr, metrics, 'get_many_by_value')
+        Metric.objects.create(name='Racing Metric')
+        response = self.create_resource(sensors.links['createForm'].href, [
+            {'metric': 'Racing Metric', 'unit': 'Smoots'},
+            {'metric': 'Other Racing Metric', 'unit': 'Smoots'}])
+        self.assertEqual(2, len(response))
+        self.assertEqual(1, Metric.objects.filter(
+            name='Racing Metric').count())
+
+    def test_sensor_metric_and_unit_should_come_from_stub_cache(self):
+        sensors = self.get_sensors()
+        self.get_resource(sensors.links.items[0].href)
+        with CaptureQueriesContext(connection) as queries:
+            self.get_resource(sensors.links.items[1].href)
+            self.create_resource(sensors.links.createForm.href, {
+                'metric': 'Bridge Length', 'unit': 'C'})
+        tables = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('FROM "core_metric"', tables)
+        self.assertNotIn('FROM "core_unit"', tables)
+        self.assertTrue(Metric.objects.filter(name='Bridge Length').exists())
+
+    def test_sparse_sensor_lists_should_not_query_influx(self):
+        device = self.get_a_device()
+        with self.influx_calls('get_last_sensor_data') as influx_calls:
+            sensors = self.get_resource(device.links['ch:sensors'].href +
+                                        '&embed=items&fields=metric'
+                                        '&links=none')
+        self.assertEqual(influx_calls, [])
+        self.assertNotIn('_links', sensors)
+        self.assertEqual(len(sensors.embedded['items']), sensors.totalCount)
+        for sensor in sensors.embedded['items']:
+            self.assertEqual(sensor.keys(), ['metric'])
+
+    def test_sensor_value_should_come_from_latest_value_store(self):
+        sensor = self.get_a_sensor()
+        data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        timestamp = now().replace(microsecond=0)
+        with self.influx_calls('get_last_sensor_data') as influx_calls:
+            self.create_resource(data.links.createForm.href, {
+                'value': 17.5, 'timestamp': timestamp.isoformat()})
+            sensor = self.get_resource(sensor.links.self.href)
+        self.assertEqual(influx_calls, [])
+        self.assertEqual(sensor.value, 17.5)
+        self.assertEqual(sensor.updated,
+                         timestamp.astimezone(utc).strftime(
+                             '%Y-%m-%dT%H:%M:%SZ'))
+
+    def test_older_data_should_not_replace_latest_value(self):
+        sensor = self.get_a_sensor()
+        data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        timestamp = now()
+        self.create_resource(data.links.createForm.href, {
+            'value': 17.5, 'timestamp': timestamp.isoformat()})
+        self.create_resource(data.links.createForm.href, {
+            'value': 3.0,
+            'timestamp': (timestamp - timedelta(hours=1)).isoformat()})
+        sensor = self.get_resource(sensor.links.self.href)
+        self.assertEqual(sensor.value, 17.5)
+
+    def test_concurrently_stored_points_should_keep_the_newest(self):
+        sensor_id = ScalarSensor.objects.all()[0].id
+        backend = latest_values.get_backend()
+        timestamp = now()
+        latest_values.get(sensor_id)
+        latest_values.store(sensor_id, 1.0, timestamp)
+        get = backend.get
+
+        def slow_get(key, *args, **kwargs):
+            entry = get(key, *args, **kwargs)
+            # another worker stores its point while this one compares
+            if threading.current_thread().name == 'slow':
+                time.sleep(0.1)
+            return entry
+        backend.get = slow_get
+        self.addCleanup(delattr, backend, 'get')
+        slow = threading.Thread(
+            name='slow', target=latest_values.store,
+            args=(sensor_id, 2.0, timestamp + timedelta(seconds=1)))
+        slow.start()
+        time.sleep(0.02)
+        latest_values.store(sensor_id, 3.0, timestamp + timedelta(seconds=2))
+        slow.join()
+        self.assertEqual(latest_values.get(sensor_id)['value'], 3.0)
+
+    def test_sensor_links_should_be_selectable(self):
+        sensor = self.get_a_sensor()
+        sparse = self.get_resource(sensor.links.self.href +
+                                   '?links=self,ch:device&include_data=false')
+        self.assertEqual(set(sparse.links.keys()),
+                         set(['self', 'ch:device', 'curies']))
+        self.assertEqual(sparse.metric, sensor.metric)
+        self.assertNotIn('value', sparse)
+
+    def test_sensor_device_should_be_embeddable(self):
+        sensor = self.get_a_sensor()
+        device = self.get_resource(sensor.links['ch:device'].href)
+        sensor = self.get_resource(sensor.links.self.href +
+                                   '?embed=ch:device')
+        self.assertIn('ch:device', sensor.links)
+        self.assertEqual(sensor.embedded['ch:device'].name, device.name)
+
     def test_sensors_should_be_postable_to_newly_posted_device(self):
         site = self.get_a_site()
         devices = self.get_resource(site.links['ch:devices'].href)
@@ -1117,6 +2102,460 @@ class ApiScalarSensorDataTests(ChainTestCase):
                              fake_zmq_socket.sent_msgs[tag][0]['_links']['ch:sensor']['href'])
 
 
+    def test_posting_data_should_not_query_database(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        self.create_resource(data_url, {'value': 23})
+        with self.assertNumQueries(0):
+            self.create_resource(data_url, {'value': 24})
+
+    def test_posting_data_should_follow_moved_devices(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        self.create_resource(data_url, {'value': 23})
+        db_sensor = ScalarSensor.objects.get(id=sensor_data.links.createForm.
+                                             href.rsplit('=', 1)[1])
+        new_site = Site.objects.exclude(id=db_sensor.device.site_id)[0]
+        db_sensor.device.site = new_site
+        db_sensor.device.save()
+        fake_zmq_socket.clear()
+        self.create_resource(data_url, {'value': 24})
+        self.assertIn('site-%d' % new_site.id, fake_zmq_socket.sent_msgs)
+
+    def use_ingest_socket(self, socket):
+        ingest._sockets = [socket]
+        self.addCleanup(setattr, ingest, '_sockets', None)
+
+    @override_settings(ASYNC_INGEST_URLS=['tcp://127.0.0.1:31420'])
+    def test_posted_data_should_be_queued_for_ingest_workers(self):
+        socket = FakeQueueSocket()
+        self.use_ingest_socket(socket)
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        timestamp = now()
+        self.post_resource(sensor_data.links.createForm.href,
+                           {'value': 31.5, 'timestamp': timestamp.isoformat()},
+                           202)
+        self.assertEqual(len(socket.queued), 1)
+        self.assertEqual(socket.queued[0]['value'], 31.5)
+        fake_zmq_socket.clear()
+        ingestd.ingest(socket.queued)
+        self.assertIn('sensor-%d' % socket.queued[0]['sensor_id'],
+                      fake_zmq_socket.sent_msgs)
+        sensor = self.get_resource(sensor.links.self.href)
+        self.assertEqual(sensor.value, 31.5)
+        sensor_data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        self.assertIn(31.5, [point['value'] for point in sensor_data.data])
+
+    @override_settings(ASYNC_INGEST_URLS=['tcp://127.0.0.1:31420'])
+    def test_data_should_be_written_directly_if_not_queued(self):
+        self.use_ingest_socket(FakeQueueSocket(full=True))
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        self.post_resource(sensor_data.links.createForm.href,
+                           [{'value': 32.5}], HTTP_STATUS_CREATED)
+        sensor = self.get_resource(sensor.links.self.href)
+        self.assertEqual(sensor.value, 32.5)
+
+    def test_posting_non_finite_values_should_fail(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        for data in [{'value': 'nan'}, {'value': 'inf'}, {'value': '-inf'},
+                     {'value': 'abc'}, [{'value': 1}, {'value': 'nan'}]]:
+            response = self.client.post(sensor_data.links.createForm.href,
+                                        json.dumps(data),
+                                        content_type='application/json',
+                                        HTTP_HOST='localhost')
+            self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+
+    def queue_points(self, values):
+        socket = FakeQueueSocket()
+        self.use_ingest_socket(socket)
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        self.post_resource(sensor_data.links.createForm.href,
+                           [{'value': value} for value in values], 202)
+        return sensor, socket.queued
+
+    @override_settings(ASYNC_INGEST_URLS=['tcp://127.0.0.1:31420'])
+    def test_ingest_should_only_drop_the_points_influx_refuses(self):
+        sensor, queued = self.queue_points([61.5, 62.5, 63.5])
+        # one that got past the API somehow
+        queued[1]['value'] = float('nan')
+        with self.influx_calls('post_data_batch') as calls:
+            ingestd.ingest(queued)
+        # the batch, then halves until the bad point is alone, none again
+        self.assertEqual(len(calls), 5)
+        sensor_data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        values = [point['value'] for point in sensor_data.data]
+        self.assertIn(61.5, values)
+        self.assertIn(63.5, values)
+
+    @override_settings(ASYNC_INGEST_URLS=['tcp://127.0.0.1:31420'])
+    def test_ingest_should_not_write_again_if_publishing_fails(self):
+        sensor, queued = self.queue_points([64.5])
+
+        def fail(*args):
+            raise ValueError('publishing failed')
+        self.addCleanup(setattr, latest_values, 'store', latest_values.store)
+        latest_values.store = fail
+        with self.influx_calls('post_data_batch') as calls:
+            ingestd.ingest(queued)
+        self.assertEqual(len(calls), 1)
+
+    def bulk_upload(self, body, content_type, expect_status_code=200,
+                    **params):
+        url = SCALAR_DATA_URL + 'bulk'
+        if params:
+            url += '?' + urllib.urlencode(params)
+        response = self.client.post(url, body, content_type=content_type,
+                                    HTTP_ACCEPT='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, expect_status_code)
+        return json.loads(response.content)
+
+    def test_bulk_csv_upload_should_write_data(self):
+        sensor = self.get_a_sensor()
+        sensor_id = int(sensor.links.self.href.rsplit('/', 1)[1])
+        timestamp = now()
+        body = 'sensor_id,timestamp,value\n%d,%s,41.5\n%d,%d,42.5\n' % (
+            sensor_id, (timestamp - timedelta(minutes=1)).isoformat(),
+            sensor_id, calendar.timegm(timestamp.utctimetuple()))
+        with self.settings(BULK_UPLOAD_BATCH_SIZE=1):
+            with self.influx_calls('post_data_batch') as calls:
+                result = self.bulk_upload(body, 'text/csv')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(result['written'], 2)
+        self.assertEqual(result['errorCount'], 0)
+        sensor = self.get_resource(sensor.links.self.href)
+        self.assertEqual(sensor.value, 42.5)
+        sensor_data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        values = [point['value'] for point in sensor_data.data]
+        self.assertIn(41.5, values)
+        self.assertIn(42.5, values)
+
+    def test_bulk_line_protocol_upload_should_report_bad_lines(self):
+        sensor = self.get_a_sensor()
+        sensor_id = int(sensor.links.self.href.rsplit('/', 1)[1])
+        timestamp = calendar.timegm(now().utctimetuple())
+        body = '\n'.join([
+            'sensordata,sensor_id=%d value=43.5 %d' % (sensor_id, timestamp),
+            'sensordata,sensor_id=%d value=abc %d' % (sensor_id, timestamp),
+            'sensordata,sensor_id=999999 value=1 %d' % timestamp,
+            'sensordata value=1'])
+        result = self.bulk_upload(body, 'text/plain', precision='s')
+        self.assertEqual(result['lines'], 4)
+        self.assertEqual(result['written'], 1)
+        self.assertEqual(result['errorCount'], 3)
+        self.assertEqual([2, 3, 4],
+                         [error['line'] for error in result['errors']])
+        sensor = self.get_resource(sensor.links.self.href)
+        self.assertEqual(sensor.value, 43.5)
+
+    def test_device_data_should_create_sensors_and_write_one_batch(self):
+        device = self.get_a_device()
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        existing = self.get_resource(sensors.links['items'][0].href)
+        readings = {
+            existing.metric: {'value': 51.5},
+            'device_data_test': {'value': 52.5, 'unit': 'widgets'},
+        }
+        data_url = device.links['ch:deviceData'].href
+        fake_zmq_socket.clear()
+        with self.influx_calls('post_data_batch') as calls:
+            response = self.post_resource(data_url, {'data': readings},
+                                          HTTP_STATUS_CREATED)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(calls[0][0]), 2)
+        self.assertEqual(response['data']['device_data_test']['value'], 52.5)
+        new_sensor = ScalarSensor.objects.get(
+            device_id=device.links.self.href.rsplit('/', 1)[1],
+            metric__name='device_data_test')
+        self.assertEqual(new_sensor.unit.name, 'widgets')
+        self.assertEqual(52.5, fake_zmq_socket.sent_msgs[
+            'sensor-%d' % new_sensor.id][-1]['value'])
+        existing = self.get_resource(existing.links.self.href)
+        self.assertEqual(existing.value, 51.5)
+        # once the sensors exist it only takes a query to find them
+        with self.assertNumQueries(1):
+            self.post_resource(data_url, {'data': readings},
+                               HTTP_STATUS_CREATED)
+
+    def test_device_sensor_data_should_be_fetched_with_one_query(self):
+        device = self.get_a_device()
+        readings = {'multi_query_a': {'value': 61.5, 'unit': 'widgets'},
+                    'multi_query_b': {'value': 62.5, 'unit': 'widgets'}}
+        response = self.post_resource(device.links['ch:deviceData'].href,
+                                      {'data': readings}, HTTP_STATUS_CREATED)
+        sensor_hrefs = dict(
+            (metric, response['data'][metric]['_links']['ch:sensor']['href'])
+            for metric in readings)
+        with self.influx_calls('get') as calls:
+            data = self.get_resource(device.links['ch:sensorData'].href)
+        self.assertEqual(len(calls), 1)
+        by_href = dict((sensor['_links']['ch:sensor']['href'], sensor)
+                       for sensor in data['sensors'].values())
+        for metric, href in sensor_hrefs.items():
+            self.assertIn(readings[metric]['value'],
+                          [point['value'] for point in by_href[href]['data']])
+        sensor_id = sensor_hrefs['multi_query_a'].rsplit('/', 1)[1]
+        data = self.get_resource(
+            data.links['self'].href.split('?')[0] + '?sensor_id__in=' +
+            sensor_id)
+        self.assertEqual([sensor_id], data['sensors'].keys())
+        self.assertIn(61.5, [point['value']
+                             for point in data['sensors'][sensor_id]['data']])
+
+    def test_sensor_data_of_invalid_devices_and_sites_should_fail(self):
+        device = self.get_a_device()
+        data = self.get_resource(device.links['ch:sensorData'].href)
+        data_url = data.links['self'].href.split('?')[0]
+        export_url = data.links['ch:export'].href.split('?')[0]
+        for url in [data_url, export_url]:
+            for param in ['device_id', 'site_id']:
+                response = self.client.get(url + '?%s=abc' % param,
+                                           HTTP_HOST='localhost')
+                self.assertEqual(response.status_code,
+                                 HTTP_STATUS_BAD_REQUEST, url + param)
+
+    def test_device_data_should_be_exported_in_slices(self):
+        device = self.get_a_device()
+        device_id = device.links.self.href.rsplit('/', 1)[1]
+        self.post_resource(
+            device.links['ch:deviceData'].href,
+            {'data': {'export_a': {'value': 0, 'unit': 'widgets'},
+                      'export_b': {'value': 0, 'unit': 'widgets'}}},
+            HTTP_STATUS_CREATED)
+        # influx isn't cleared between test runs, which reuse sensor ids, and
+        # what they rolled up would change the slices
+        for sensor in ScalarSensor.objects.filter(device_id=device_id):
+            resources.influx_client.get(
+                "DROP SERIES WHERE sensor_id = '%s'" % sensor.id, True)
+        start = now() - timedelta(days=3)
+        # influx isn't cleared between tests, so tell our data apart
+        base = random.randint(1000, 1000000)
+        values = []
+        for hours in range(0, 72, 12):
+            timestamp = start + timedelta(hours=hours)
+            values += [base + hours, -base - hours]
+            self.post_resource(
+                device.links['ch:deviceData'].href,
+                {'timestamp': timestamp.isoformat(),
+                 'data': {'export_a': {'value': values[-2], 'unit': 'widgets'},
+                          'export_b': {'value': values[-1], 'unit': 'widgets'}}},
+                HTTP_STATUS_CREATED)
+        data = self.get_resource(device.links['ch:sensorData'].href)
+        export_url = data.links['ch:export'].href.split('?')[0]
+
+        def export(**params):
+            params['device_id'] = device_id
+            response = self.client.get(
+                export_url + '?' + urllib.urlencode(params),
+                HTTP_HOST='localhost')
+            self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+            return ''.join(response.streaming_content).splitlines()
+
+        # there are 12 data points, so that's 6 slices
+        with self.settings(EXPORT_SLICE_POINTS=2):
+            with self.influx_calls('get') as calls:
+                rows = list(csv.reader(export(
+                    timestamp__gte=calendar.timegm(start.utctimetuple()))))
+        self.assertEqual(
+            len([call for call in calls if call[0].startswith('SELECT *')]),
+            6)
+        self.assertEqual(rows[0], ['sensor_id', 'timestamp', 'value'])
+        self.assertEqual(
+            sorted(float(row[2]) for row in rows[1:]
+                   if float(row[2]) in values),
+            sorted(values))
+        timestamps = [parse_datetime(row[1]) for row in rows[1:]]
+        self.assertEqual(timestamps, sorted(timestamps))
+        # resuming from the last timestamp gets its data points again
+        lines = export(timestamp__gte=rows[-1][1], format='ndjson')
+        self.assertEqual(len(lines), timestamps.count(timestamps[-1]))
+        self.assertEqual(json.loads(lines[0])['timestamp'], rows[-1][1])
+
+    def test_export_slices_should_follow_the_density_of_the_data(self):
+        device = self.get_a_device()
+        response = self.post_resource(
+            device.links['ch:deviceData'].href,
+            {'data': {'export_density': {'value': 0, 'unit': 'widgets'}}},
+            HTTP_STATUS_CREATED)
+        sensor_href = response['data']['export_density']['_links'][
+            'ch:sensor']['href']
+        sensor_id = sensor_href.rsplit('/', 1)[1]
+        db_sensor = ScalarSensor.objects.get(id=sensor_id)
+        # influx isn't cleared between test runs, which reuse sensor ids
+        resources.influx_client.get(
+            "DROP SERIES WHERE sensor_id = '%s'" % sensor_id, True)
+        # a point an hour for 30 days, all rolled up, then 15 a minute for
+        # an hour that isn't
+        start = now().replace(minute=0, second=0, microsecond=0) - \
+            timedelta(days=30, hours=2)
+        timestamps = [start + timedelta(hours=hours, minutes=30)
+                      for hours in range(24 * 30)]
+        timestamps += [timestamps[-1] + timedelta(minutes=30, seconds=seconds)
+                       for seconds in range(0, 3600, 4)]
+        resources.influx_client.post_data_batch([
+            (db_sensor.device.site_id, db_sensor.device_id, sensor_id,
+             index, timestamp)
+            for index, timestamp in enumerate(timestamps)])
+        rolled_up_until = InfluxClient.convert_timestamp(
+            start + timedelta(days=30))
+        resources.influx_client.post('query', '''
+            SELECT max("value"), min("value"), mean("value"), count("value"), sum("value")
+            INTO "{0}" FROM "{1}" WHERE "time" < {2} AND "time" >= {3}
+            GROUP BY "sensor_id", time(1h), *'''.format(
+            INFLUX_MEASUREMENT + '_1h', INFLUX_MEASUREMENT, rolled_up_until,
+            InfluxClient.convert_timestamp(start)), True)
+        data = self.get_resource(device.links['ch:sensorData'].href)
+        export_url = data.links['ch:export'].href.split('?')[0] + \
+            '?sensor_id=' + sensor_id
+
+        with self.settings(EXPORT_SLICE_POINTS=500):
+            with self.influx_calls('get') as calls:
+                response = self.client.get(export_url, HTTP_HOST='localhost')
+                rows = list(csv.reader(
+                    ''.join(response.streaming_content).splitlines()))
+        self.assertEqual(len(rows), len(timestamps) + 1)
+        # the month of hourly points takes 2 slices, as does the last hour
+        # (900 points)
+        self.assertEqual(
+            len([call for call in calls if call[0].startswith('SELECT *')]),
+            4)
+
+    def test_export_slices_should_cut_up_dense_hours(self):
+        device = self.get_a_device()
+        response = self.post_resource(
+            device.links['ch:deviceData'].href,
+            {'data': {'export_dense': {'value': 0, 'unit': 'widgets'}}},
+            HTTP_STATUS_CREATED)
+        sensor_id = response['data']['export_dense']['_links'][
+            'ch:sensor']['href'].rsplit('/', 1)[1]
+        db_sensor = ScalarSensor.objects.get(id=sensor_id)
+        # influx isn't cleared between test runs, which reuse sensor ids
+        resources.influx_client.get(
+            "DROP SERIES WHERE sensor_id = '%s'" % sensor_id, True)
+        # a point an hour for a day, then 900 in an hour, all rolled up
+        start = now().replace(minute=0, second=0, microsecond=0) - \
+            timedelta(hours=30)
+        timestamps = [start + timedelta(hours=hours, minutes=30)
+                      for hours in range(24)]
+        timestamps += [start + timedelta(hours=26, seconds=seconds)
+                       for seconds in range(2, 3600, 4)]
+        resources.influx_client.post_data_batch([
+            (db_sensor.device.site_id, db_sensor.device_id, sensor_id,
+             index, timestamp)
+            for index, timestamp in enumerate(timestamps)])
+        resources.influx_client.post('query', '''
+            SELECT max("value"), min("value"), mean("value"), count("value"), sum("value")
+            INTO "{0}" FROM "{1}" WHERE "time" < {2} AND "time" >= {3}
+            GROUP BY "sensor_id", time(1h), *'''.format(
+            INFLUX_MEASUREMENT + '_1h', INFLUX_MEASUREMENT,
+            InfluxClient.convert_timestamp(start + timedelta(hours=27)),
+            InfluxClient.convert_timestamp(start)), True)
+        data = self.get_resource(device.links['ch:sensorData'].href)
+        export_url = data.links['ch:export'].href.split('?')[0] + \
+            '?sensor_id=' + sensor_id
+
+        slice_sizes = []
+        get_slice = resources.influx_client.get_many_sensors_data_by_time
+
+        def get_many_sensors_data_by_time(*args, **kwargs):
+            rows = get_slice(*args, **kwargs)
+            slice_sizes.append(len(rows))
+            return rows
+        resources.influx_client.get_many_sensors_data_by_time = \
+            get_many_sensors_data_by_time
+        self.addCleanup(delattr, resources.influx_client,
+                        'get_many_sensors_data_by_time')
+        with self.settings(EXPORT_SLICE_POINTS=100):
+            response = self.client.get(export_url, HTTP_HOST='localhost')
+            rows = list(csv.reader(
+                ''.join(response.streaming_content).splitlines()))
+        self.assertEqual(len(rows), len(timestamps) + 1)
+        self.assertEqual(sum(slice_sizes), len(timestamps))
+        self.assertLessEqual(max(slice_sizes), 100)
+        # the day of hourly points, then the dense hour in 9 slices
+        self.assertEqual(len([size for size in slice_sizes if size]), 10)
+
+    def test_sensor_data_pages_should_hold_the_requested_points(self):
+        device = self.get_a_device()
+        response = self.post_resource(
+            device.links['ch:deviceData'].href,
+            {'data': {'density_metric': {'value': 0, 'unit': 'widgets'}}},
+            HTTP_STATUS_CREATED)
+        sensor = self.get_resource(
+            response['data']['density_metric']['_links']['ch:sensor']['href'])
+        sensor_id = sensor.links.self.href.rsplit('/', 1)[1]
+        db_sensor = ScalarSensor.objects.get(id=sensor_id)
+        # influx isn't cleared between test runs, which reuse sensor ids
+        resources.influx_client.get(
+            "DROP SERIES WHERE sensor_id = '%s'" % sensor_id, True)
+        # one point per hour, and only the older 20 hours are rolled up
+        start = now().replace(minute=0, second=0, microsecond=0) - \
+            timedelta(hours=40)
+        timestamps = [start + timedelta(hours=hours, minutes=30)
+                      for hours in range(30)]
+        resources.influx_client.post_data_batch([
+            (db_sensor.device.site_id, db_sensor.device_id, sensor_id,
+             hours, timestamp)
+            for hours, timestamp in enumerate(timestamps)])
+        rolled_up_until = InfluxClient.convert_timestamp(
+            start + timedelta(hours=20))
+        resources.influx_client.post('query', '''
+            SELECT max("value"), min("value"), mean("value"), count("value"), sum("value")
+            INTO "{0}" FROM "{1}" WHERE "time" < {2} AND "time" >= {3}
+            GROUP BY "sensor_id", time(1h), *'''.format(
+            INFLUX_MEASUREMENT + '_1h', INFLUX_MEASUREMENT, rolled_up_until,
+            InfluxClient.convert_timestamp(start)), True)
+        href = sensor.links['ch:dataHistory'].href
+
+        def values(page):
+            return [point['value'] for point in page.data]
+
+        page = self.get_resource(href + '&last=5')
+        self.assertEqual(values(page), range(25, 30))
+        page = self.get_resource(page.links.previous.href)
+        self.assertEqual(values(page), range(20, 25))
+
+        page = self.get_resource(href + '&points=15')
+        self.assertEqual(values(page), range(15, 30))
+        page = self.get_resource(page.links.previous.href)
+        self.assertEqual(values(page), range(0, 15))
+        page = self.get_resource(page.links.next.href)
+        self.assertEqual(values(page), range(15, 30))
+        self.get_resource(href + '&points=15&aggtime=1h',
+                          expect_status_code=HTTP_STATUS_BAD_REQUEST,
+                          check_mime_type=False,
+                          check_vary_header=False)
+        self.get_resource(href + '&last=2&aggtime=1h',
+                          expect_status_code=HTTP_STATUS_BAD_REQUEST,
+                          check_mime_type=False,
+                          check_vary_header=False)
+        self.get_resource(href + '&last=0',
+                          expect_status_code=HTTP_STATUS_BAD_REQUEST,
+                          check_mime_type=False,
+                          check_vary_header=False)
+
+    def test_device_data_should_need_units_for_new_sensors(self):
+        device = self.get_a_device()
+        response = self.client.post(
+            device.links['ch:deviceData'].href,
+            json.dumps({'data': {'no_unit_metric': {'value': 1}}}),
+            content_type='application/json', HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        self.assertFalse(ScalarSensor.objects.filter(
+            metric__name='no_unit_metric').exists())
+
     def test_posting_data_should_sanitize_args_for_response(self):
         fake_zmq_socket.clear()
         sensor = self.get_a_sensor()
@@ -1388,6 +2827,20 @@ class CollectionFilteringTests(ChainTestCase):
         self.assertIn('previous', next_devs.links)
         self.assertNotIn('next', next_devs.links)
 
+    def test_pages_should_keep_sparse_fieldsets(self):
+        site = self.get_a_site()
+        devices = self.get_resource(site.links['ch:devices'].href)
+        create_url = devices.links['createForm'].href
+        for i in range(0, DeviceResource.page_size + 1):
+            dev = {'name': 'test dev %d' % i}
+            self.create_resource(create_url, dev)
+        devs = self.get_resource(site.links['ch:devices'].href +
+                                 '&embed=items&fields=name&links=next')
+        self.assertEqual(sorted(devs.links.keys()), ['curies', 'next'])
+        next_devs = self.get_resource(devs.links.next.href)
+        for item in next_devs.embedded['items']:
+            self.assertEqual(item.keys(), ['name'])
+
 
 class HTMLTests(ChainTestCase):
 
@@ -1398,6 +2851,70 @@ class HTMLTests(ChainTestCase):
         self.assertTrue(res.endswith("</html>"))
 
 
+class ContentNegotiationTests(ChainTestCase):
+
+    def test_accept_header_q_values_should_be_honored(self):
+        response = self.client.get(
+            BASE_API_URL,
+            HTTP_ACCEPT='text/html;q=0.5, application/json',
+            HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_zero_q_value_should_exclude_type(self):
+        response = self.client.get(
+            BASE_API_URL,
+            HTTP_ACCEPT='application/hal+json;q=0, application/json;q=0, */*',
+            HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+        self.assertEqual(response['Content-Type'], 'text/html')
+
+    def test_json_wildcard_should_prefer_hal_json(self):
+        for accept, mime_type in [
+                ('*/json', 'application/hal+json'),
+                ('text/html;q=0.5, */json', 'application/hal+json'),
+                ('application/json', 'application/json'),
+                ('application/json;q=0, */*', 'application/hal+json'),
+                ('application/hal+json;q=0, */json', 'application/json'),
+                ('*/*;q=0.1, */json', 'application/hal+json')]:
+            response = self.client.get(BASE_API_URL, HTTP_ACCEPT=accept,
+                                       HTTP_HOST='localhost')
+            self.assertEqual(response['Content-Type'], mime_type, accept)
+
+    def test_sensor_data_should_be_available_as_csv(self):
+        sensor = self.get_a_sensor()
+        href = sensor.links['ch:dataHistory'].href
+        json_data = self.get_resource(href)
+        csv_data = self.get_resource(href, mime_type='text/csv')
+        lines = csv_data.strip().splitlines()
+        self.assertEqual(lines[0], 'timestamp,value')
+        self.assertEqual(len(lines) - 1, len(json_data.data))
+
+    def test_csv_sensor_data_should_have_link_header(self):
+        sensor = self.get_a_sensor()
+        response = self.client.get(sensor.links['ch:dataHistory'].href,
+                                   HTTP_ACCEPT='text/csv',
+                                   HTTP_HOST='localhost')
+        self.assertIn('rel="next"', response['Link'])
+        self.assertIn('rel="previous"', response['Link'])
+
+    def test_sensor_data_should_be_available_as_msgpack(self):
+        sensor = self.get_a_sensor()
+        href = sensor.links['ch:dataHistory'].href
+        json_data = self.get_resource(href)
+        packed = self.get_resource(href, mime_type='application/x-msgpack')
+        unpacked = msgpack.unpackb(packed, encoding='utf-8')
+        self.assertEqual(unpacked['data'], json_data.data)
+
+    def test_non_data_resources_should_not_be_csv(self):
+        site = self.get_a_site()
+        response = self.client.get(site.links.self.href,
+                                   HTTP_ACCEPT='text/csv',
+                                   HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_NOT_ACCEPTABLE)
+
+
+@override_settings(**TEST_CACHE_SETTINGS)
 class ErrorTests(TestCase):
 
     def test_unsupported_mime_types_should_return_406_status(self):
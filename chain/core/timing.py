@@ -0,0 +1,109 @@
+'''Timing of where each request spends its time, so we can tell what makes an
+endpoint slow without attaching a profiler to production.
+
+While a request is being handled, the time spent (and the number of calls)
+in each phase is added up: database queries, requests to Influx, ZMQ messages
+and rendering the response body. They're sent back in a Server-Timing header
+(which browser dev tools show), and a random sample of requests can also be
+logged to the chain.core.timing logger as one JSON object per line.
+
+Both are turned off by default with the SERVER_TIMING and
+SERVER_TIMING_LOG_RATE settings, in which case the middleware isn't loaded at
+all and timing a phase is just a check that no request is being timed.'''
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from contextlib import contextmanager
+import threading
+import logging
+import random
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+# what the call counts of each phase are counting, for the header
+COUNT_NAMES = {
+    'db': 'queries',
+    'influx': 'requests',
+    'zmq': 'messages',
+    'render': 'renders',
+}
+
+_local = threading.local()
+
+
+def add(name, seconds, count=1):
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        total = timings.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += count
+
+
+@contextmanager
+def phase(name):
+    '''Adds the time spent in the with block to the given phase of the
+    request being timed, if there is one'''
+    if getattr(_local, 'timings', None) is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        add(name, time.time() - start)
+
+
+def format_header(timings):
+    entries = []
+    for name, (seconds, count) in sorted(timings.items()):
+        entry = '%s;dur=%.1f' % (name, seconds * 1000)
+        if name in COUNT_NAMES:
+            entry += ';desc="%d %s"' % (count, COUNT_NAMES[name])
+        entries.append(entry)
+    return ', '.join(entries)
+
+
+class ServerTimingMiddleware(object):
+    '''Times each request and reports it in a Server-Timing header and/or
+    the log. It should be the first middleware, so the total includes the
+    others'''
+
+    def __init__(self):
+        if not settings.SERVER_TIMING and not settings.SERVER_TIMING_LOG_RATE:
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        _local.timings = {}
+        _local.start = time.time()
+        # Django only records the queries (with their times) when DEBUG is
+        # on, unless we ask it to
+        connection.use_debug_cursor = True
+
+    def process_response(self, request, response):
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return response
+        _local.timings = None
+        connection.use_debug_cursor = None
+        # the queries are reset at the start of each request
+        if connection.queries:
+            timings['db'] = [sum(float(query['time'])
+                                 for query in connection.queries),
+                             len(connection.queries)]
+        timings['total'] = [time.time() - _local.start, 1]
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = format_header(timings)
+        if random.random() < settings.SERVER_TIMING_LOG_RATE:
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.get_full_path(),
+                'status': response.status_code,
+                'timings': dict((name, {'ms': round(seconds * 1000, 1),
+                                        'count': count})
+                                for name, (seconds, count)
+                                in timings.items()),
+            }))
+        return response
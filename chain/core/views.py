@@ -1 +1,28 @@
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CONTENT_TYPE_LATEST
+from chain.core.metrics import render
+from chain.core.profiling import client_ip
+from chain.core import memory as memory_diagnostics
+import json
+
+
+def metrics(request):
+    '''Serves the metrics for Prometheus to scrape'''
+    return HttpResponse(render(), content_type=CONTENT_TYPE_LATEST)
+
+
+def memory(request):
+    '''Takes a memory snapshot of this worker, and serves the reports of all
+    the workers (see chain/core/memory.py)'''
+    if client_ip(request) not in settings.INTERNAL_IPS:
+        return HttpResponseForbidden()
+    report = memory_diagnostics.take_snapshot()
+    if settings.MEMORY_DIAGNOSTICS_DIR:
+        reports = memory_diagnostics.read_reports(
+            settings.MEMORY_DIAGNOSTICS_DIR)
+    else:
+        report['running'] = True
+        reports = [report]
+    return HttpResponse(json.dumps({'workers': reports}, indent=2),
+                        content_type='application/json')
@@ -0,0 +1,91 @@
+'''Gunicorn settings for the API server, used with
+`gunicorn -c python:chain.gunicorn_conf` (see chain_webserver.conf).
+
+The workers keep their metrics in files in prometheus_multiproc_dir, named
+by their pid (see chain/core/metrics.py), and with --max-requests gunicorn
+replaces them every few hundred requests. When a worker exits, its counters
+and histograms are added to the totals of the workers that exited before it,
+kept in one file of each type, so the directory (and the time /metrics takes
+to read it) doesn't grow with every worker that's replaced. Its gauges only
+count while it's alive, so they're dropped.
+
+When the server starts, the metrics of processes that aren't running any
+more are removed, so counting starts over. The ingest workers keep their
+metrics in the same directory, and theirs are kept as long as they run.'''
+
+from prometheus_client import multiprocess
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+from chain.core.memory import is_running
+import glob
+import os
+
+# the types of metrics that still count once their process has exited
+KEPT_TYPES = ['counter', 'histogram']
+# the files where the exited processes' metrics are added up are named with
+# this instead of a pid
+EXITED = 'exited'
+
+
+def metrics_dir():
+    return os.environ.get('prometheus_multiproc_dir')
+
+
+def file_pid(filename):
+    '''The pid in the name of a metrics file, e.g. 123 for counter_123.db, or
+    None for the exited processes' files'''
+    pid = os.path.basename(filename)[:-len('.db')].rsplit('_', 1)[-1]
+    return int(pid) if pid.isdigit() else None
+
+
+def remove_stopped(directory):
+    '''Removes the metrics files of the processes that aren't running'''
+    for filename in glob.glob(os.path.join(directory, '*.db')):
+        pid = file_pid(filename)
+        if pid is None or not is_running(pid):
+            os.remove(filename)
+
+
+def add_to_exited(directory, pid):
+    '''Adds the counters and histograms of a process that has exited to the
+    exited processes' totals, and removes its files'''
+    multiprocess.mark_process_dead(pid, directory)
+    for metric_type in KEPT_TYPES:
+        filename = os.path.join(directory, '%s_%d.db' % (metric_type, pid))
+        if not os.path.exists(filename):
+            continue
+        exited = os.path.join(directory, '%s_%s.db' % (metric_type, EXITED))
+        files = [filename]
+        if os.path.exists(exited):
+            files.append(exited)
+        # the histograms' buckets are kept as they are in the files, rather
+        # than adding up each bucket and the ones below it
+        metrics = multiprocess.MultiProcessCollector.merge(files,
+                                                           accumulate=False)
+        # written next to it, and swapped in at once so /metrics doesn't see
+        # it half done. Not ending in .db keeps /metrics from reading it
+        totals_filename = exited + '.new'
+        if os.path.exists(totals_filename):
+            os.remove(totals_filename)
+        totals = MmapedDict(totals_filename)
+        try:
+            for metric in metrics:
+                for sample in metric.samples:
+                    totals.write_value(
+                        mmap_key(metric.name, sample.name,
+                                 sample.labels.keys(),
+                                 sample.labels.values()),
+                        sample.value)
+        finally:
+            totals.close()
+        os.rename(totals_filename, exited)
+        os.remove(filename)
+
+
+def on_starting(server):
+    if metrics_dir():
+        remove_stopped(metrics_dir())
+
+
+def child_exit(server, worker):
+    if metrics_dir():
+        add_to_exited(metrics_dir(), worker.pid)
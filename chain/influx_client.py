@@ -4,12 +4,22 @@ from datetime import datetime
 from django.db import IntegrityError
 import itertools
 from time import sleep
-from chain.core.api import BadRequestException
+import time
+from chain.core.api import BadRequestException, HTTP_STATUS_BAD_REQUEST
+from chain.core import timing
+from chain.core import metrics
+from chain.core import influx_log
 
 EPOCH = UTC.localize(datetime.utcfromtimestamp(0))
 
 HTTP_STATUS_SUCCESSFUL_WRITE = 204
 
+
+class RejectedWrite(IntegrityError):
+    '''Influx refused the data itself (a 400), rather than failing to store
+    it, so writing it again won't help'''
+
+
 class InfluxClient(object):
 
     def __init__(self, host, port, database, measurement):
@@ -20,16 +30,47 @@ class InfluxClient(object):
         # Persist TCP connection
         self._session = requests
         self._url = 'http://' + self._host + ':' + self._port
+        self._database_ready = False
 
-        if self._database not in self.get_databases():
-            self.get('CREATE DATABASE ' + self._database)
+    def ensure_database(self):
+        '''Creates the database if it doesn't exist yet. This happens on first
+        use rather than when the client is created, so importing the
+        resources doesn't need Influx to be up'''
+        if not self._database_ready:
+            if self._database not in self.get_databases():
+                self.get('CREATE DATABASE ' + self._database)
+            self._database_ready = True
 
     def request(self, method, url, params=None, data=None, headers=None):
-        response = self._session.request(method=method,
-                                         url=url,
-                                         params=params,
-                                         data=data,
-                                         headers=headers)
+        # write or query
+        endpoint = url.rsplit('/', 1)[1]
+        metrics.INFLUX_REQUESTS.labels(endpoint).inc()
+        start = time.time()
+        try:
+            with timing.phase('influx'), \
+                    metrics.INFLUX_LATENCY.labels(endpoint).time():
+                response = self._session.request(method=method,
+                                                 url=url,
+                                                 params=params,
+                                                 data=data,
+                                                 headers=headers)
+        except requests.RequestException as e:
+            metrics.INFLUX_ERRORS.labels(endpoint).inc()
+            influx_log.record(endpoint, params, data, None,
+                              time.time() - start, e.__class__.__name__)
+            raise
+        seconds = time.time() - start
+        if response.status_code >= 400:
+            metrics.INFLUX_ERRORS.labels(endpoint).inc()
+        # queries are parsed once, here, for both the log and the caller
+        response.results = None
+        if endpoint == 'query':
+            try:
+                response.results = response.json()
+            except ValueError:
+                pass
+        influx_log.record(endpoint, params, data, response, seconds,
+                          results=response.results)
         return response
 
     def post(self, endpoint, data, query=False):
@@ -39,13 +80,15 @@ class InfluxClient(object):
             url = self._url + '/query'
         if query:
             data = {'q': data}
+        self.ensure_database()
         response = self.request('POST',
                                 url,
                                 {'db': self._database},
                                 data)
         return response
 
-    def post_data(self, site_id, device_id, sensor_id, value, timestamp=None):
+    def format_point(self, site_id, device_id, sensor_id, value, timestamp=None):
+        '''Formats a data point in the line protocol'''
         timestamp = InfluxClient.convert_timestamp(timestamp)
         data = '{0},sensor_id={1},site_id={2},device_id={3} value={4}'.format(self._measurement,
                                                                               sensor_id,
@@ -54,14 +97,33 @@ class InfluxClient(object):
                                                                               value)
         if timestamp:
             data += ' ' + str(timestamp)
+        return data
+
+    def post_data(self, site_id, device_id, sensor_id, value, timestamp=None):
+        data = self.format_point(site_id, device_id, sensor_id, value, timestamp)
+        response = self.post('write', data)
+        if response.status_code != HTTP_STATUS_SUCCESSFUL_WRITE:
+            raise IntegrityError('Error storing data')
+        metrics.POINTS_WRITTEN.inc()
+        return response
+
+    def post_data_batch(self, points):
+        '''Writes a list of (site_id, device_id, sensor_id, value, timestamp)
+        tuples in a single request. Raises RejectedWrite if Influx refuses
+        them, in which case none of them were written'''
+        data = '\n'.join(self.format_point(*point) for point in points)
         response = self.post('write', data)
+        if response.status_code == HTTP_STATUS_BAD_REQUEST:
+            raise RejectedWrite('Error storing data: %s' % response.text)
         if response.status_code != HTTP_STATUS_SUCCESSFUL_WRITE:
             raise IntegrityError('Error storing data')
+        metrics.POINTS_WRITTEN.inc(len(points))
         return response
 
     def get(self, query, database=False):
         # database arguement should be true for any sensor data queries
         if database:
+            self.ensure_database()
             response = self.request('GET',
                                     self._url + '/query',
                                     {'db': self._database,'q': query})
@@ -72,21 +134,26 @@ class InfluxClient(object):
 
         return response
 
-    def get_sensor_data(self, filters):
-        timestamp_gte = InfluxClient.convert_timestamp(filters['timestamp__gte'])
-        timestamp_lt = InfluxClient.convert_timestamp(filters['timestamp__lt'])
+    def get_measurement(self, filters):
+        '''Returns the measurement to query for the given filters, either the
+        raw data or one of the rollups'''
         if 'aggtime' not in filters:
-            measurement = self._measurement
+            return self._measurement
         # arguements are unicode strings
         elif filters['aggtime'] == u'1h':
-            measurement = self._measurement + '_1h'
+            return self._measurement + '_1h'
         elif filters['aggtime'] == u'1d':
-            measurement = self._measurement + '_1d'
+            return self._measurement + '_1d'
         elif filters['aggtime'] == u'1w':
-            measurement = self._measurement + '_1w'
+            return self._measurement + '_1w'
         else:
             raise BadRequestException('Invalid argument for aggtime. Must be 1h, 1d, or 1w')
 
+    def get_sensor_data(self, filters):
+        timestamp_gte = InfluxClient.convert_timestamp(filters['timestamp__gte'])
+        timestamp_lt = InfluxClient.convert_timestamp(filters['timestamp__lt'])
+        measurement = self.get_measurement(filters)
+
         query = "SELECT * FROM {0} WHERE sensor_id = \'{1}\' AND time >= {2} AND time < {3}".format(measurement,
                                                                                                     filters['sensor_id'],
                                                                                                     timestamp_gte,
@@ -94,6 +161,130 @@ class InfluxClient(object):
         result = self.get_values(self.get(query, True))
         return result
 
+    def sensors_query(self, sensor_ids, filters):
+        '''Returns a query for the data of all the given sensors in the
+        timespan given by the filters'''
+        timestamp_gte = InfluxClient.convert_timestamp(filters['timestamp__gte'])
+        timestamp_lt = InfluxClient.convert_timestamp(filters['timestamp__lt'])
+        measurement = self.get_measurement(filters)
+        sensor_pattern = '|'.join(str(int(sensor_id)) for sensor_id in sensor_ids)
+        return "SELECT * FROM {0} WHERE sensor_id =~ /^({1})$/ AND time >= {2} AND time < {3}".format(measurement,
+                                                                                                       sensor_pattern,
+                                                                                                       timestamp_gte,
+                                                                                                       timestamp_lt)
+
+    def get_many_sensors_data(self, sensor_ids, filters):
+        '''Gets the data of all the given sensors in the timespan given by the
+        filters with a single query. Returns a dict of lists of data points
+        keyed by sensor id (as a string)'''
+        query = self.sensors_query(sensor_ids, filters) + " GROUP BY sensor_id"
+        return self.get_grouped_values(self.get(query, True), 'sensor_id')
+
+    def get_many_sensors_data_by_time(self, sensor_ids, filters):
+        '''Like get_many_sensors_data, but returns a single list of data
+        points in time order, each with its sensor_id'''
+        return self.get_values(self.get(self.sensors_query(sensor_ids, filters), True))
+
+    def get_first_time(self, sensor_ids, filters):
+        '''Returns the time of the first data point of any of the given
+        sensors (in the measurement chosen by the filters) as a string, or
+        None if there isn't any'''
+        measurement = self.get_measurement(filters)
+        # the aggregates don't have a value field, but they all have a count
+        field = 'value' if measurement == self._measurement else 'count'
+        sensor_pattern = '|'.join(str(int(sensor_id)) for sensor_id in sensor_ids)
+        query = "SELECT FIRST({0}) FROM {1} WHERE sensor_id =~ /^({2})$/".format(field,
+                                                                                measurement,
+                                                                                sensor_pattern)
+        result = self.get_values(self.get(query, True))
+        return result[0]['time'] if result else None
+
+    def time_conditions(self, start=None, end=None):
+        '''Returns the WHERE conditions for the (optional) bounds of a
+        timespan, to add to a query that already has one'''
+        conditions = ''
+        if start is not None:
+            conditions += ' AND time >= {0}'.format(InfluxClient.convert_timestamp(start))
+        if end is not None:
+            conditions += ' AND time < {0}'.format(InfluxClient.convert_timestamp(end))
+        return conditions
+
+    def get_last_points(self, sensor_id, count, filters):
+        '''Gets the newest count data points of the sensor (in the measurement
+        chosen by the filters) from before timestamp__lt if it's given, newest
+        first'''
+        query = "SELECT * FROM {0} WHERE sensor_id = \'{1}\'{2} ORDER BY time DESC LIMIT {3}".format(
+            self.get_measurement(filters),
+            sensor_id,
+            self.time_conditions(end=filters.get('timestamp__lt')),
+            int(count))
+        return self.get_values(self.get(query, True))
+
+    def get_hourly_counts(self, sensor_id, limit, start=None, end=None,
+                          backward=False):
+        '''Gets up to limit rows of the sensor's hourly rollup in the given
+        timespan, going forward from its start or backward from its end.
+        Hours without data don't have rows, so each row has a count of at
+        least 1'''
+        query = "SELECT count FROM {0}_1h WHERE sensor_id = \'{1}\'{2} ORDER BY time {3} LIMIT {4}".format(
+            self._measurement,
+            sensor_id,
+            self.time_conditions(start, end),
+            'DESC' if backward else 'ASC',
+            int(limit))
+        return self.get_values(self.get(query, True))
+
+    def get_many_sensors_hourly_counts(self, sensor_ids, limit, start=None,
+                                       end=None):
+        '''Gets up to limit rows of the given sensors' hourly rollups in the
+        given timespan, in time order. Each row is one sensor's count for
+        one hour'''
+        sensor_pattern = '|'.join(str(int(sensor_id)) for sensor_id in sensor_ids)
+        query = "SELECT count FROM {0}_1h WHERE sensor_id =~ /^({1})$/{2} ORDER BY time ASC LIMIT {3}".format(
+            self._measurement,
+            sensor_pattern,
+            self.time_conditions(start, end),
+            int(limit))
+        return self.get_values(self.get(query, True))
+
+    def get_nth_time(self, sensor_id, n, start=None, end=None, backward=False):
+        '''Returns the time of the sensor's nth raw data point (counting from
+        1) in the given timespan, going forward from its start or backward
+        from its end, as a string, or None if there aren't that many'''
+        query = "SELECT value FROM {0} WHERE sensor_id = \'{1}\'{2} ORDER BY time {3} LIMIT 1 OFFSET {4}".format(
+            self._measurement,
+            sensor_id,
+            self.time_conditions(start, end),
+            'DESC' if backward else 'ASC',
+            int(n) - 1)
+        result = self.get_values(self.get(query, True))
+        return result[0]['time'] if result else None
+
+    def count_points(self, sensor_id, start=None, end=None):
+        '''Counts the sensor's raw data points in the given timespan'''
+        query = "SELECT COUNT(value) FROM {0} WHERE sensor_id = \'{1}\'{2}".format(
+            self._measurement,
+            sensor_id,
+            self.time_conditions(start, end))
+        result = self.get_values(self.get(query, True))
+        return result[0]['count'] if result else 0
+
+    def count_many_sensors_points(self, sensor_ids, filters, start=None,
+                                  end=None):
+        '''Counts the data points of all the given sensors (in the
+        measurement chosen by the filters) in the given timespan'''
+        measurement = self.get_measurement(filters)
+        # the aggregates don't have a value field, but they all have a count
+        field = 'value' if measurement == self._measurement else 'count'
+        sensor_pattern = '|'.join(str(int(sensor_id)) for sensor_id in sensor_ids)
+        query = "SELECT COUNT({0}) FROM {1} WHERE sensor_id =~ /^({2})$/{3}".format(
+            field,
+            measurement,
+            sensor_pattern,
+            self.time_conditions(start, end))
+        result = self.get_values(self.get(query, True))
+        return result[0]['count'] if result else 0
+
     def get_last_sensor_data(self, sensor_id):
         query = "SELECT LAST(value) FROM {0} WHERE sensor_id = \'{1}\'".format(self._measurement,
                                                                            sensor_id)
@@ -108,15 +299,22 @@ class InfluxClient(object):
 
     def get_databases(self):
         response = self.get('SHOW DATABASES', False)
-        series = response.json()['results'][0]['series'][0]
+        series = self.get_results(response)['results'][0]['series'][0]
         if 'values' not in series:
             # there's only a values list if there's at least one value
             return []
 
         return [sub[0] for sub in series['values']]
 
+    def get_results(self, response):
+        '''The parsed JSON of a query response, as request() parsed it'''
+        if getattr(response, 'results', None) is None:
+            # raises the error parsing it did
+            return response.json()
+        return response.results
+
     def get_values(self,response):
-        json = response.json()
+        json = self.get_results(response)
         if len(json['results'])==0:
             return []
         if 'series' not in json['results'][0]:
@@ -140,6 +338,19 @@ class InfluxClient(object):
         return result
 
 
+    def get_grouped_values(self, response, tag):
+        '''Returns the rows of each series of a GROUP BY query, in a dict keyed
+        by the value of the tag it was grouped by'''
+        json = self.get_results(response)
+        if len(json['results']) == 0:
+            return {}
+        result = {}
+        for series in json['results'][0].get('series', []):
+            columns = series['columns']
+            result[series['tags'][tag]] = [dict(itertools.izip(columns, values))
+                                           for values in series['values']]
+        return result
+
     @classmethod
     def convert_timestamp(cls, timestamp):
         if not timestamp.tzinfo:
@@ -0,0 +1,110 @@
+# run with
+#   DJANGO_SETTINGS_MODULE=chain.settings python -m chain.ingestd <number>
+# where number is the index of this worker's address in ASYNC_INGEST_URLS.
+# Run one for each address (see chain_ingestd.conf for supervisor)
+
+'''The ingest worker, which writes the sensor data that the API queues when
+async ingest is turned on (see chain/core/ingest.py). Data points are written
+to Influx in batches, then the sensors' latest values are updated and the
+points are published to the streams.'''
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from chain.core import latest_values, response_cache
+from chain.core import api, resources, metrics
+from chain.core.resources import ScalarSensorDataResource
+from chain.influx_client import RejectedWrite
+import json
+import logging
+import sys
+import time
+import zmq
+
+logger = logging.getLogger(__name__)
+
+# how many times writing a batch is tried before its data is dropped, and how
+# long to wait in between (in seconds)
+RETRIES = 3
+RETRY_WAIT = 1
+
+
+def receive_batch(socket):
+    '''Waits for a data point, then takes any more that arrive within
+    INGEST_BATCH_WAIT seconds, up to INGEST_BATCH_SIZE'''
+    points = [json.loads(socket.recv())]
+    deadline = time.time() + settings.INGEST_BATCH_WAIT
+    while len(points) < settings.INGEST_BATCH_SIZE:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not socket.poll(remaining * 1000):
+            break
+        points.append(json.loads(socket.recv()))
+    return points
+
+
+def write(points, timestamps):
+    '''Writes data points to Influx with one request. If Influx refuses
+    them, they're split in halves to find the bad points, which are dropped.
+    Returns the points written, with their timestamps'''
+    try:
+        resources.influx_client.post_data_batch([
+            (point['site_id'], point['device_id'], point['sensor_id'],
+             point['value'], timestamp)
+            for point, timestamp in zip(points, timestamps)])
+        return zip(points, timestamps)
+    except RejectedWrite as e:
+        if len(points) == 1:
+            logger.error('Dropped data point %r: %s' % (points[0], e))
+            return []
+        half = len(points) / 2
+        return write(points[:half], timestamps[:half]) + \
+            write(points[half:], timestamps[half:])
+
+
+def publish(written):
+    '''Updates the latest values of the sensors and publishes the written
+    data points to their streams'''
+    invalidated = set([ScalarSensorDataResource.resource_name])
+    for point, timestamp in written:
+        latest_values.store(point['sensor_id'], point['value'], timestamp)
+        for tag in point['tags']:
+            api.zmq_socket.send_string(tag + ' ' + point['stream'])
+            metrics.STREAM_MESSAGES.inc()
+        invalidated.update(point['tags'])
+    response_cache.invalidate(invalidated)
+
+
+def ingest(points):
+    '''Writes a batch of queued data points to Influx, updates the latest
+    values and publishes them. Only the write is tried again if it fails, so
+    the points are published once, and a batch Influx refuses isn't tried
+    again at all'''
+    timestamps = [parse_datetime(point['timestamp']) for point in points]
+    for attempt in range(RETRIES):
+        try:
+            written = write(points, timestamps)
+            break
+        except Exception:
+            logger.exception('Error writing %d data points' % len(points))
+            time.sleep(RETRY_WAIT)
+    else:
+        logger.error('Dropped %d data points' % len(points))
+        return
+    try:
+        publish(written)
+    except Exception:
+        logger.exception('Error publishing %d data points' % len(written))
+
+
+def run(url):
+    socket = zmq.Context().socket(zmq.PULL)
+    socket.bind(url)
+    logger.info('ingesting from %s' % url)
+    while True:
+        ingest(receive_batch(socket))
+
+
+if __name__ == '__main__':
+    # only needed when running as a worker, not when importing ingest()
+    import coloredlogs
+    coloredlogs.install(logging.INFO)
+    run(settings.ASYNC_INGEST_URLS[int(sys.argv[1])])
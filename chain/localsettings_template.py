@@ -43,6 +43,10 @@ LANGUAGE_CODE = 'en-us'
 ZMQ_PASSTHROUGH_URL_PULL = 'tcp://127.0.0.1:31416'
 ZMQ_PASSTHROUGH_URL_PUB = 'tcp://127.0.0.1:31417'
 
+# to queue posted data for ingest workers rather than writing it during the
+# request, give one address per worker (see chain_ingestd.conf)
+# ASYNC_INGEST_URLS = ['tcp://127.0.0.1:31420', 'tcp://127.0.0.1:31421']
+
 # leave the websocket host as None if it is the same as the Django host
 WEBSOCKET_HOST = None
 
@@ -57,3 +61,37 @@ INFLUX_PORT = '8086'
 INFLUX_DATABASE = 'chain'
 # the measurement (like a table) where the scalar sensor data will be stored
 INFLUX_MEASUREMENT = 'sensordata'
+
+# the response, site summary, latest value and sensor map caches default to
+# the memcached on this machine (see chain/settings.py). To give the responses
+# a memcached instance of their own, so they can't push the other caches'
+# entries out:
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+#     },
+#     'responses': {
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': '127.0.0.1:11212',
+#     },
+#     'site_summaries': {
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': '127.0.0.1:11211',
+#         'KEY_PREFIX': 'site_summaries',
+#     },
+#     'latest_values': {
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': '127.0.0.1:11211',
+#         'KEY_PREFIX': 'latest_values',
+#     },
+#     'sensor_map': {
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': '127.0.0.1:11211',
+#         'KEY_PREFIX': 'sensor_map',
+#     },
+# }
+# or turn them off:
+# RESPONSE_CACHE = None
+# SITE_SUMMARY_CACHE = None
+# LATEST_VALUE_CACHE = None
+# SENSOR_MAP_CACHE = None
@@ -62,6 +62,11 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # first, so its timings include the other middleware
+    'chain.core.timing.ServerTimingMiddleware',
+    'chain.core.metrics.MetricsMiddleware',
+    'chain.core.influx_log.InfluxLogMiddleware',
+    'chain.core.memory.MemoryDiagnosticsMiddleware',
     # 'debug_toolbar.middleware.DebugToolbarMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,6 +76,8 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # last, as it runs the views of the requests it profiles
+    'chain.core.profiling.ProfilingMiddleware',
 )
 
 ROOT_URLCONF = 'chain.urls'
@@ -109,9 +116,125 @@ SOUTH_TESTS_MIGRATE = False
 
 # tell the debug toolbar not to try to be too clever
 DEBUG_TOOLBAR_PATCH_SETTINGS = False
-# used to decide whether to display the debug toolbar
+# used to decide whether to display the debug toolbar, and who can profile
+# requests (see chain/core/profiling.py)
 INTERNAL_IPS = ['127.0.0.1', '18.85.58.156']
 
+# Rendered API responses are cached server-side until one of the resources
+# in them is changed through the API (see chain/core/response_cache.py). The
+# site summaries and the latest value of each sensor are kept in caches as
+# well, and the processes' sensor maps announce their changes through one.
+# With several worker processes these need to be shared between them, and the
+# locks in them need an atomic add(), so they default to the local memcached
+# (which needs python-memcached). Each has its own alias, and they can be
+# pointed at separate memcached instances so filling one can't evict the
+# others' entries. Set RESPONSE_CACHE, SITE_SUMMARY_CACHE, LATEST_VALUE_CACHE
+# or SENSOR_MAP_CACHE to None to turn that cache off.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+        'KEY_PREFIX': 'responses',
+    },
+    'site_summaries': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+        'KEY_PREFIX': 'site_summaries',
+    },
+    'latest_values': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+        'KEY_PREFIX': 'latest_values',
+    },
+    'sensor_map': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+        'KEY_PREFIX': 'sensor_map',
+    },
+}
+RESPONSE_CACHE = 'responses'
+# in seconds
+RESPONSE_CACHE_TIMEOUT = 3600
+
+# each process keeps a map from sensors to their devices and sites, and
+# reloads it when another process announces in this cache that it moved some
+# (see chain/core/sensor_map.py)
+SENSOR_MAP_CACHE = 'sensor_map'
+# how often (in seconds) the map is reloaded even without an announcement
+SENSOR_MAP_MAX_AGE = 300
+
+# site summaries are kept up to date in this cache (see
+# chain/core/site_summary.py)
+SITE_SUMMARY_CACHE = 'site_summaries'
+# in seconds
+SITE_SUMMARY_TIMEOUT = 3600
+
+# the latest value of each sensor is stored in this cache as data is posted
+# (see chain/core/latest_values.py)
+LATEST_VALUE_CACHE = 'latest_values'
+# in seconds. Values that time out are looked up in Influx again
+LATEST_VALUE_TIMEOUT = 86400
+
+# addresses of the ingest workers (chain/ingestd.py). When any are given,
+# posted sensor data is queued for them and the API responds with 202
+# Accepted instead of writing it to Influx itself (see chain/core/ingest.py)
+ASYNC_INGEST_URLS = []
+# how many data points each web worker can have queued for an ingest worker
+# before it starts writing them itself
+ASYNC_INGEST_QUEUE_SIZE = 1000
+# ingest workers write up to INGEST_BATCH_SIZE data points at a time, waiting
+# up to INGEST_BATCH_WAIT seconds for a batch to fill up
+INGEST_BATCH_SIZE = 500
+INGEST_BATCH_WAIT = 0.1
+
+# bulk uploads (chain/core/bulk_upload.py) are written to Influx this many
+# data points at a time, and report the errors of up to this many lines
+BULK_UPLOAD_BATCH_SIZE = 5000
+BULK_UPLOAD_MAX_ERRORS = 100
+
+# exports (chain/core/export.py) fetch the data from Influx in slices of about
+# this many data points
+EXPORT_SLICE_POINTS = 10000
+
+# the most data points that can be asked for with the last and points
+# parameters of a sensor's data
+DATA_PAGE_MAX_POINTS = 10000
+
+# add a Server-Timing header to each response with how long it spent on
+# database queries, Influx, ZMQ and rendering (see chain/core/timing.py)
+SERVER_TIMING = False
+# the fraction of requests (0 to 1) whose timings are logged to the
+# chain.core.timing logger
+SERVER_TIMING_LOG_RATE = 0
+
+# requests to Influx that take longer than this (in seconds) are logged to
+# the chain.core.influx_log logger with the API request that made them (see
+# chain/core/influx_log.py). None turns the slow query log off
+INFLUX_SLOW_QUERY_TIME = 1.0
+# the fraction of the faster requests to Influx (0 to 1) that are logged too
+INFLUX_QUERY_LOG_RATE = 0
+
+# a request sent with an X-Chain-Profile header holding this key, from one of
+# the INTERNAL_IPS, is run under cProfile and answered with a report of where
+# it spent its time (see chain/core/profiling.py). None turns profiling off
+PROFILING_KEY = None
+# a directory to also save the raw stats of the profiled requests in
+PROFILING_DIR = None
+
+# each web worker takes a snapshot of its memory (resident size, objects by
+# type and cache sizes) after the first request of every this many seconds,
+# for /debug/memory (see chain/core/memory.py). None turns the snapshots off
+MEMORY_SNAPSHOT_INTERVAL = None
+# growth is measured from the first snapshot after a worker has handled this
+# many requests, once its caches are warm
+MEMORY_WARMUP_REQUESTS = 500
+# a directory the workers save their memory reports in, so /debug/memory can
+# show all of them and not just the one that handles it
+MEMORY_DIAGNOSTICS_DIR = None
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
@@ -136,6 +259,10 @@ LOGGING = {
             'level': 'DEBUG',
             'class': 'logging.NullHandler',
         },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         # Silence SuspiciousOperation.DisallowedHost exception ('Invalid
@@ -150,6 +277,16 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'chain.core.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'chain.core.influx_log': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 
@@ -9,6 +9,8 @@ admin.autodiscover()
 urlpatterns = patterns(
     '',
     url(r'^', include(resources.urls)),
+    url(r'^metrics$', 'chain.core.views.metrics', name='metrics'),
+    url(r'^debug/memory$', 'chain.core.views.memory', name='memory'),
     # Examples:
     # url(r'^$', 'chain.views.home', name='home'),
     # url(r'^chain/', include('chain.foo.urls')),
@@ -10,6 +10,8 @@ from flask import Flask
 from flask_sockets import Sockets
 from zmq_passthrough import passthrough
 from chain.settings import ZMQ_PASSTHROUGH_URL_PUB
+from prometheus_client import Counter, Gauge, generate_latest, \
+    CONTENT_TYPE_LATEST
 import logging
 import coloredlogs
 
@@ -28,6 +30,26 @@ zmq_socks_tag = {}
 tag_zmq_sock = {}
 tag_subscribers = {}
 
+SUBSCRIBERS = Gauge('chain_websocket_subscribers',
+                    'Connected websocket clients')
+SUBSCRIBERS.set_function(
+    lambda: sum(len(subscribers) for subscribers in tag_subscribers.values()))
+TAGS = Gauge('chain_websocket_tags', 'Tags with at least one subscriber')
+TAGS.set_function(lambda: len(tag_subscribers))
+MESSAGES_RECEIVED = Counter('chain_websocket_messages_received_total',
+                            'Messages received from the ZMQ streams')
+MESSAGES_SENT = Counter('chain_websocket_messages_sent_total',
+                        'Messages fanned out to websocket clients')
+SEND_ERRORS = Counter('chain_websocket_send_errors_total',
+                      'Messages that couldn\'t be sent to a websocket client')
+
+
+@app.route('/metrics')
+def metrics():
+    '''Serves the metrics for Prometheus to scrape. Tags look like
+    site-1, so this doesn't get in the way of the websocket route'''
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
 @websockets.route('/<tag>')
 def site_socket(ws, tag):
     logger.info('ws client connected for tag "%s"' % tag)
@@ -96,11 +118,14 @@ def select_zmq_socks():
             logger.info('Reading from socket on tag "%s".' % tag)
             msg_tag, _, msg = zmq_sock.recv().partition(" ")
             logger.info('Received on tag "%s": %s' % (msg_tag, msg))
+            MESSAGES_RECEIVED.inc()
             to_remove = set()
             for ws in tag_subscribers[tag]:
                 try:
                     ws.send(msg)
+                    MESSAGES_SENT.inc()
                 except Exception as e:
+                    SEND_ERRORS.inc()
                     logger.info('Caught Error sending to client: %s' % e)
                     try:
                         ws.close()
@@ -29,6 +29,7 @@ sudo apt-get --yes --force-yes install python-dev libpq-dev python-pip
 sudo apt-get --yes --force-yes install nginx
 sudo apt-get --yes --force-yes install influxdb
 sudo apt-get --yes --force-yes install supervisor
+sudo apt-get --yes --force-yes install memcached
 sudo apt-get --yes --force-yes install apache2-utils
 sudo apt-get --yes --force-yes install postgresql-10 postgresql-contrib
 # sudo apt-get --yes --force-yes install libzmq-dev
@@ -25,6 +25,7 @@ setup(
         'south==0.8.4',
         'jinja2==2.7.2',
         'mimeparse==0.1.3',
+        'msgpack-python==0.4.6',
         'django-debug-toolbar==1.0.1',
         'gunicorn==19.9.0',
         'chainclient>=0.1',
@@ -36,6 +37,8 @@ setup(
         'flask==0.12.4',
         'websocket-client==0.12.0',
         'python-dateutil',
-        'pytz'
+        'pytz',
+        'prometheus_client==0.7.1',
+        'python-memcached==1.59'
     ]
 )